@@ -0,0 +1,94 @@
+"""
+Synthetic bot exports for benchmarks.
+
+Every input gets a label drawn from a Zipf-like distribution (`skew` 0 means
+uniform label sizes) or stays unlabeled, and a text built from a few words of
+its label's topic plus a filler word or two, so inputs of one label score
+higher with each other than with the rest. A `duplicates` fraction of the inputs repeat
+the text of an earlier input, like real exports do.
+
+Run `python -m benchmarks.exports out.json --n 10000 --labels 50`
+"""
+import argparse
+import numpy as np
+import ujson
+
+# Words per label topic and in the shared filler vocabulary.
+TOPIC_WORDS = 6
+FILLER_WORDS = 2000
+
+
+def words(rng: np.random.Generator, count: int) -> list:
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    lengths = rng.integers(3, 10, size=count)
+    return ["".join(rng.choice(letters, size=length)) for length in lengths]
+
+
+def generate_export(n: int, labels: int = 50, skew: float = 1.0,
+                    duplicates: float = 0.05, unlabeled: float = 0.2,
+                    seed: int = 0) -> dict:
+    """Generate an export in the format the service accepts.
+
+    Args:
+        n (int): the number of inputs.
+        labels (int, optional): the number of labels. Defaults to 50.
+        skew (float, optional): the Zipf exponent of the label sizes, 0 for
+        equally sized labels. Defaults to 1.0.
+        duplicates (float, optional): the fraction of inputs repeating an
+        earlier text. Defaults to 0.05.
+        unlabeled (float, optional): the fraction of unlabeled inputs.
+        Defaults to 0.2.
+        seed (int, optional): the random seed. Defaults to 0.
+
+    Returns:
+        dict: `{"inputs": {id: {"input": text, "classifier": {"label": label}}}}`
+        plus a `bot` object the service skips.
+    """
+    rng = np.random.default_rng(seed)
+    topics = [words(rng, TOPIC_WORDS) for _ in range(max(labels, 1))]
+    filler = words(rng, FILLER_WORDS)
+    weights = 1 / np.arange(1, len(topics) + 1) ** skew
+    topic_of = rng.choice(len(topics), size=n, p=weights / weights.sum())
+    is_unlabeled = rng.random(n) < unlabeled if labels else np.ones(n, dtype=bool)
+    is_duplicate = rng.random(n) < duplicates
+    texts, inputs = [], {}
+    for i in range(n):
+        if is_duplicate[i] and texts:
+            text = texts[rng.integers(len(texts))]
+        else:
+            topic = topics[topic_of[i]]
+            sentence = (list(rng.choice(topic, size=rng.integers(3, 6), replace=False))
+                        + list(rng.choice(filler, size=rng.integers(1, 3))))
+            rng.shuffle(sentence)
+            text = " ".join(sentence)
+        texts.append(text)
+        label = None if is_unlabeled[i] else f"label_{topic_of[i]}"
+        inputs[f"input_{i:07d}"] = {"input": text, "classifier": {"label": label}}
+    return {"bot": {"name": "benchmark", "seed": seed}, "inputs": inputs}
+
+
+def write_export(file_path: str, n: int, **kwargs) -> str:
+    """Generate an export (see `generate_export`) and write it to a file.
+    """
+    with open(file_path, "w") as file:
+        ujson.dump(generate_export(n, **kwargs), file)
+    return file_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("file")
+    parser.add_argument("--n", type=int, default=10_000)
+    parser.add_argument("--labels", type=int, default=50)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--duplicates", type=float, default=0.05)
+    parser.add_argument("--unlabeled", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_export(args.file, args.n, labels=args.labels, skew=args.skew,
+                 duplicates=args.duplicates, unlabeled=args.unlabeled,
+                 seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
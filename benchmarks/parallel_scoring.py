@@ -0,0 +1,61 @@
+"""
+Speedup of the sharded multi-process pair scoring on a synthetic matrix.
+
+Scores the full upper triangle of an n x dim matrix of random unit vectors
+in-process (BLAS decides its own threading) and then with a process pool of
+each worker count, BLAS pinned to one thread per worker. The speedup of a
+worker count is measured against the same matrix scored by one worker, every
+pool is started before it's timed.
+
+Run `python -m benchmarks.parallel_scoring --n 50000 --workers 1 2 4 8 16`
+"""
+import argparse
+import os
+import time
+import numpy as np
+from modules import parallel, scoring
+
+
+def synthetic_matrix(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    matrix = np.random.default_rng(seed).standard_normal((n, dim), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix
+
+
+def run(blocks) -> tuple:
+    start = time.perf_counter()
+    pairs = sum(len(scores) for _, _, scores in blocks)
+    return time.perf_counter() - start, pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--n", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--threshold", type=float, default=0.3)
+    parser.add_argument("--block-size", type=int, default=scoring.DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=[1, 2, 4, 8, os.cpu_count()])
+    args = parser.parse_args()
+
+    matrix = synthetic_matrix(args.n, args.dim)
+    print(f"n={args.n} dim={args.dim} threshold={args.threshold} "
+          f"pairs scored={args.n * (args.n - 1) // 2:,} cpus={os.cpu_count()}")
+
+    seconds, pairs = run(scoring.iter_pair_blocks(
+        matrix, args.threshold, block_size=args.block_size))
+    print(f"{'in-process':>12} {seconds:9.2f}s {pairs:>12,} pairs")
+
+    baseline = None
+    for workers in sorted(set(args.workers) | {1}):
+        # Start the pool first, spawning it isn't part of the scoring time.
+        run(parallel.iter_pair_blocks(matrix[:2], args.threshold, workers=workers))
+        seconds, pairs = run(parallel.iter_pair_blocks(
+            matrix, args.threshold, workers=workers, block_size=args.block_size))
+        baseline = baseline or seconds
+        print(f"{workers:>4} workers {seconds:9.2f}s {pairs:>12,} pairs "
+              f"speedup {baseline / seconds:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmarks of quantized pair scoring against exact scoring.
+
+For every export size the labeled and unlabeled matrices are embedded once
+with the local fake encoder, then scored exactly (float32) and over float16
+and int8 copies (see `modules.quantized`). Reported per precision: the bytes
+of the scanned matrix, the scoring time and speedup over float32, the
+re-scoring margin, and how the result differs from the exact one (missing
+and extra pairs, largest score difference). The candidates are re-scored
+with the float32 tile multiply, missing or extra pairs and score differences
+would come from BLAS summing the gathered candidate rows in another order.
+
+Run `python -m benchmarks.quantized --sizes 10000 30000`
+"""
+import argparse
+import datetime
+import os
+import platform
+import time
+import numpy as np
+import ujson
+from benchmarks import exports
+from benchmarks.suite import RESULTS_DIR, git_state
+
+PRECISIONS = ("float32", "float16", "int8")
+
+
+def pairs(blocks) -> tuple:
+    blocks = list(blocks)
+    if not blocks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    rows, cols, scores = (np.concatenate(column) for column in zip(*blocks))
+    return rows.astype(np.int64) << 32 | cols, scores
+
+
+def run_matrix(matrix: np.ndarray, codes: np.ndarray, threshold: float,
+               block_size: int) -> dict:
+    """Score one matrix in every precision.
+
+    Returns:
+        dict: the results per precision.
+    """
+    from modules import quantized, scoring
+
+    report = {}
+    for precision in PRECISIONS:
+        start = time.perf_counter()
+        if precision == "float32":
+            nbytes, margin = matrix.nbytes, 0.0
+            keys, scores = pairs(scoring.iter_pair_blocks(
+                matrix, threshold, codes, block_size))
+        else:
+            table = quantized.QuantizedMatrix.from_matrix(matrix, precision)
+            nbytes, margin = table.nbytes, table.margin
+            keys, scores = pairs(quantized.iter_pair_blocks(
+                matrix, table, threshold, codes, block_size))
+        seconds = time.perf_counter() - start
+        if precision == "float32":
+            exact_keys, exact_scores = keys, scores
+        common, here, there = np.intersect1d(keys, exact_keys, assume_unique=True,
+                                             return_indices=True)
+        report[precision] = {
+            "seconds": seconds,
+            "speedup": report["float32"]["seconds"] / seconds if report else 1.0,
+            "matrix_bytes": nbytes, "margin": margin, "pairs": len(keys),
+            "missing": len(exact_keys) - len(common),
+            "extra": len(keys) - len(common),
+            "max_score_difference": float(np.abs(
+                scores[here] - exact_scores[there]).max()) if len(common) else 0.0}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 30_000])
+    parser.add_argument("--labels", type=int, default=50)
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--block-size", type=int, default=1024)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file, defaults to "
+                        "benchmarks/results/quantized-<time>-<commit>.json")
+    args = parser.parse_args()
+
+    os.environ.update(EMBEDDING_CACHE_DIR="", ANN_INDEX_DIR="", ENCODER="hashing",
+                      ENCODER_DIMENSIONS=str(args.dim), RESULT_CACHE_ENTRIES="0")
+    from modules import intent
+    from modules.dataset import Dataset
+
+    report = dict(git_state(), started=datetime.datetime.utcnow().isoformat(),
+                  python=platform.python_version(), numpy=np.__version__,
+                  machine=platform.machine(), cpus=os.cpu_count(),
+                  args=vars(args), runs=[])
+    for n in args.sizes:
+        dataset = Dataset.from_json(exports.generate_export(
+            n, labels=args.labels, seed=args.seed))
+        intents = intent.Intent(dataset)
+        for path, order, codes in (
+                ("labeled", dataset.labeled_order, dataset.codes[dataset.labeled_order]),
+                ("unlabeled", dataset.unlabeled_order, None)):
+            matrix = intents.batch_embed(dataset.texts.take(order))
+            run = {"path": path, "n": n, "scored": len(matrix),
+                   "precisions": run_matrix(matrix, codes, args.threshold,
+                                            args.block_size)}
+            report["runs"].append(run)
+            for precision, result in run["precisions"].items():
+                print(f"{path:>10} {n:>8} {precision:>8} "
+                      f"{result['matrix_bytes'] / 2**20:8.1f}MB "
+                      f"{result['seconds']:7.3f}s {result['speedup']:5.2f}x "
+                      f"{result['pairs']:>10,} pairs  -{result['missing']} "
+                      f"+{result['extra']}  max diff "
+                      f"{result['max_score_difference']:.2e}")
+
+    output = args.output or os.path.join(RESULTS_DIR, "quantized-{}-{}.json".format(
+        datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"),
+        (report["commit"] or "unknown")[:10]))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        ujson.dump(report, file, indent=2)
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+End-to-end benchmarks of the intent scoring paths.
+
+For every export size and scoring path a fresh process loads a synthetic
+export (see `benchmarks.exports`), embeds it with a local fake encoder, scores
+the pairs and serializes the result, timing each stage and recording the peak
+RSS. Results are written as JSON together with the commit they were measured
+on; `--compare` prints the change against an earlier results file.
+
+Paths:
+- labeled: compute_labeled_scores_fast (block scoring).
+- labeled_deprecated: compute_labeled_scores, only up to `--deprecated-max`
+  inputs since it walks every pair in Python. It maps duplicate texts to
+  their first input, so its pair count differs when the export has any.
+- labeled_prescreen: compute_labeled_scores_fast, skipping the label pairs
+  pre-screening rules out (see `modules.prescreen`). It scores every pair,
+  like labeled, when the bounds rule out too few of them.
+- unlabeled: compute_unlabeled_scores, exact.
+- unlabeled_approx: compute_unlabeled_scores with the IVF index. Its recall
+  against the exact pairs (untimed) is reported next to the timings.
+
+The embed stage runs once, the scoring stages reuse its embeddings.
+
+Run `python -m benchmarks.suite --sizes 1000 10000 100000`
+"""
+import argparse
+import datetime
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import ujson
+from benchmarks import exports
+
+PATHS = ("labeled", "labeled_deprecated", "labeled_prescreen", "unlabeled",
+         "unlabeled_approx")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(stages: dict, name: str, func, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    stages[name] = {"seconds": time.perf_counter() - start,
+                    "peak_rss_mb": peak_rss_mb()}
+    return value
+
+
+def run_case(path: str, export_file: str, threshold: float, block_size: int) -> dict:
+    """Run one path on one export, in the current process.
+
+    Returns:
+        dict: the stage timings, the pair count and the peak RSS.
+    """
+    # Imported here so the parent process stays small.
+    from modules import ann, ingest, intent, scoring
+    from modules.results import PairTable
+
+    stages, report = {}, {}
+    dataset = timed(stages, "load", ingest.load_dataset, export_file)
+    intents = intent.Intent(dataset)
+    labeled = path.startswith("labeled")
+    order = dataset.labeled_order if labeled else dataset.unlabeled_order
+    texts = dataset.texts.take(order)
+    matrix = timed(stages, "embed", intents.batch_embed, texts)
+    rows = {text: i for i, text in enumerate(texts)}
+    intents.batch_embed = lambda sentences, *args: matrix[[rows[s] for s in sentences]]
+
+    if path == "labeled_deprecated":
+        output = timed(stages, "score", intents.compute_labeled_scores, threshold)
+        timed(stages, "serialize_json", ujson.dumps, output)
+        pairs = len(output)
+    elif labeled:
+        ids, row_labels, codes, blocks = intents.labeled_blocks(
+            threshold, block_size, prescreen=path == "labeled_prescreen")
+        blocks = timed(stages, "score", list, blocks)
+        intents.labeled_blocks = lambda *args: (ids, row_labels, codes, iter(blocks))
+        timed(stages, "serialize_json", lambda: ujson.dumps(
+            intents.compute_labeled_scores_fast(threshold, block_size)))
+        timed(stages, "serialize_npz", lambda: PairTable.from_blocks(
+            iter(blocks), ids, dataset.labels, codes).to_bytes("npz"))
+        pairs = sum(len(scores) for _, _, scores in blocks)
+    else:
+        approximate = path == "unlabeled_approx"
+        ids, sentences, blocks = intents.unlabeled_blocks(
+            threshold, approximate, block_size=block_size)
+        blocks = timed(stages, "score", list, blocks)
+        intents.unlabeled_blocks = lambda *args: (ids, sentences, iter(blocks))
+        timed(stages, "serialize_json", lambda: ujson.dumps(
+            intents.compute_unlabeled_scores(threshold, approximate,
+                                             block_size=block_size)))
+        timed(stages, "serialize_npz", lambda: PairTable.from_blocks(
+            iter(blocks), ids).to_bytes("npz"))
+        pairs = sum(len(scores) for _, _, scores in blocks)
+        if approximate:
+            report = {"recall": ann.recall(
+                scoring.iter_pair_blocks(matrix, threshold, block_size=block_size),
+                iter(blocks), len(matrix))}
+    return dict(report, inputs=len(dataset), scored=len(texts), pairs=pairs,
+                stages=stages, peak_rss_mb=peak_rss_mb())
+
+
+def git_state() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {"commit": git("rev-parse", "HEAD"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def compare(current: dict, baseline_file: str):
+    """Print the relative change of every stage against an earlier run.
+    """
+    with open(baseline_file) as file:
+        baseline = ujson.load(file)
+    before = {(run["path"], run["n"]): run for run in baseline["runs"]}
+    print(f"\ncompared with {(baseline.get('commit') or '?')[:10]}")
+    for run in current["runs"]:
+        old = before.get((run["path"], run["n"]))
+        if old is None or "stages" not in run or "stages" not in old:
+            continue
+        for stage, result in run["stages"].items():
+            if stage in old["stages"]:
+                ratio = result["seconds"] / max(old["stages"][stage]["seconds"], 1e-9)
+                print(f"{run['path']:>20} {run['n']:>8} {stage:>15} "
+                      f"{ratio:6.2f}x time")
+        ratio = run["peak_rss_mb"] / max(old["peak_rss_mb"], 1e-9)
+        print(f"{run['path']:>20} {run['n']:>8} {'peak rss':>15} {ratio:6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1_000, 3_000, 10_000, 30_000, 100_000])
+    parser.add_argument("--paths", nargs="+", choices=PATHS, default=list(PATHS))
+    parser.add_argument("--deprecated-max", type=int, default=1_000)
+    parser.add_argument("--labels", type=int, default=50)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--duplicates", type=float, default=0.05)
+    parser.add_argument("--unlabeled", type=float, default=0.2)
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--block-size", type=int, default=1024)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--encoder", choices=("hashing", "http"), default="hashing",
+                        help="embed in-process or through the fake HTTP encoder")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="milliseconds the fake HTTP encoder waits per batch")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file, defaults to "
+                        "benchmarks/results/<time>-<commit>.json")
+    parser.add_argument("--compare", help="an earlier results file")
+    parser.add_argument("--case", nargs=2, metavar=("PATH", "EXPORT"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(ujson.dumps(run_case(*args.case, args.threshold, args.block_size)))
+        return
+
+    env = dict(os.environ, EMBEDDING_CACHE_DIR="", ANN_INDEX_DIR="",
+               RESULT_CACHE_ENTRIES="0",
+               SCORING_WORKERS=os.getenv("SCORING_WORKERS", "1"),
+               ENCODER_DIMENSIONS=str(args.dim), ENCODER="hashing")
+    if args.encoder == "http":
+        from scripts import fake_encoder
+        server = fake_encoder.serve(0, args.dim, args.latency / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        env.update(ENCODER="remote",
+                   ENCODER_URL=f"http://127.0.0.1:{server.server_address[1]}/")
+
+    report = dict(git_state(), started=datetime.datetime.utcnow().isoformat(),
+                  python=platform.python_version(), numpy=np.__version__,
+                  machine=platform.machine(), cpus=os.cpu_count(),
+                  args={key: value for key, value in vars(args).items()
+                        if key not in ("case", "output", "compare")},
+                  runs=[])
+    with tempfile.TemporaryDirectory() as directory:
+        for n in args.sizes:
+            export_file = exports.write_export(
+                os.path.join(directory, f"export-{n}.json"), n, labels=args.labels,
+                skew=args.skew, duplicates=args.duplicates,
+                unlabeled=args.unlabeled, seed=args.seed)
+            for path in args.paths:
+                if path == "labeled_deprecated" and n > args.deprecated_max:
+                    continue
+                child = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.suite", "--case", path,
+                     export_file, "--threshold", str(args.threshold),
+                     "--block-size", str(args.block_size)],
+                    env=env, capture_output=True, text=True)
+                if child.returncode:
+                    run = {"error": child.stderr.strip().splitlines()[-1:]}
+                else:
+                    run = ujson.loads(child.stdout.strip().splitlines()[-1])
+                report["runs"].append(dict(run, path=path, n=n))
+                print_run(report["runs"][-1])
+
+    output = args.output or os.path.join(RESULTS_DIR, "{}-{}.json".format(
+        datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"),
+        (report["commit"] or "unknown")[:10]))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        ujson.dump(report, file, indent=2)
+    print(f"results written to {output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+def print_run(run: dict):
+    if "error" in run:
+        print(f"{run['path']:>20} {run['n']:>8} failed: {run['error']}")
+        return
+    stages = " ".join(f"{stage} {result['seconds']:.3f}s"
+                      for stage, result in run["stages"].items())
+    recall = (f"  recall {run['recall']['recall']:.4f}"
+              if "recall" in run else "")
+    print(f"{run['path']:>20} {run['n']:>8} {run['pairs']:>10,} pairs "
+          f"{run['peak_rss_mb']:8.1f}MB  {stages}{recall}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,19 @@
+import logging
 import uvicorn
 import ujson
+from functools import partial
 import modules.intent as intent
 import modules.jq as jq
-from os import getenv
+import modules.admission as admission
+import modules.batching as batching
+import modules.ingest as ingest
+import modules.memo as memo
+import modules.metrics as metrics
+import modules.results as results
+from os import environ, getenv
 from typing import Optional, Any, Dict, AnyStr, List, Union
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,47 +24,255 @@ JSONObject = Dict[str, Any]
 JSONArray = List[Any]
 JSONStructure = Union[JSONArray, JSONObject]
 
+# Concurrent /similarity requests share encoder round trips.
+similarity_batcher = batching.from_env(intent.embed_async)
+
+# Concurrent requests admitted per route, the rest is answered with a 429.
+limiters = {
+    "labeled": admission.from_env("/inputs/compare/labeled", "COMPARE_MAX_CONCURRENCY", 2),
+    "unlabeled": admission.from_env("/inputs/compare/unlabeled", "COMPARE_MAX_CONCURRENCY", 2),
+    "similarity": admission.from_env("/similarity", "SIMILARITY_MAX_CONCURRENCY", 256),
+}
+RETRY_AFTER = getenv("RETRY_AFTER_SECONDS", "5")
+
+
+def check_format(format: str):
+    if format not in results.FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"format must be one of {', '.join(results.FORMATS)}")
+
+
+def admit(limiter: admission.Limiter):
+    """Take a slot of the limiter or reject the request right away.
+    """
+    try:
+        limiter.acquire()
+    except admission.Saturated as ex:
+        raise HTTPException(status_code=429, detail=str(ex),
+                            headers={"Retry-After": RETRY_AFTER})
+
+
+def stream(blocks, format: str, limiter: admission.Limiter) -> StreamingResponse:
+    """Stream result blocks to the client while they're being computed.
+
+    The blocks are computed in Starlette's thread pool and the limiter slot
+    is released once the stream ends.
+    """
+    return StreamingResponse(
+        limiter.hold(results.chunks(blocks, format)),
+        media_type=results.MEDIA_TYPES[format])
+
+
+def document(compute, *args) -> Response:
+    """Compute a complete result and encode it as one JSON document (run in
+    the compute pool, see `admission.run`).
+    """
+    return Response(results.json_bytes(compute(*args)),
+                    media_type=results.MEDIA_TYPES["json"])
+
+
+def binary(compute, format: str, *args) -> Response:
+    """Compute a columnar result table and send it as `.npz` or Arrow IPC
+    (run in the compute pool, see `admission.run`).
+    """
+    return Response(compute(*args).to_bytes(format),
+                    media_type=results.MEDIA_TYPES[format])
+
+
+def check_top_k(threshold: Optional[float], top_k: Optional[int],
+                bot_id: Optional[str] = None) -> Optional[float]:
+    """Validate the top_k parameters, returns the threshold to use: 0.6 by
+    default, no minimum score in top_k mode unless one is given.
+    """
+    if top_k is None:
+        return 0.6 if threshold is None else threshold
+    if top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k must be positive")
+    if bot_id is not None:
+        raise HTTPException(status_code=400,
+                            detail="bot_id can't be combined with top_k")
+    return threshold
+
+
+async def read_dataset(request: Request) -> intent.Dataset:
+    """Parse the export in the request body while it's being received, the
+    chunks are parsed in the compute pool (see `admission.run`).
+    """
+    try:
+        return await ingest.read_dataset(request.stream(), admission.run)
+    except (ValueError, KeyError, TypeError) as ex:
+        raise HTTPException(status_code=400, detail=f"Invalid export: {ex}")
+
+
+async def load_intents(request: Request, bot_id: Optional[str] = None) -> intent.Intent:
+    """The Intent of the export in the request body, built in the compute
+    pool (it opens the caches).
+    """
+    dataset = await read_dataset(request)
+    return await admission.run(intent.Intent, file=dataset, bot_id=bot_id)
+
+
 @app.get("/")
 async def read_root():
     return "API is running"
 
 
 @app.post("/inputs/compare/labeled")
-async def labeled_inputs(data: JSONStructure, threshold: int = 0.6):
+async def labeled_inputs(request: Request, threshold: Optional[float] = None,
+                         format: str = "json", bot_id: Optional[str] = None,
+                         top_k: Optional[int] = None, prescreen: bool = False):
     """Compute similarity matrix & scores of the sentences.
 
     Args:
-        data (JSONStructure): the JSON dataset.
-        threshold (int, optional): the threshold to check the score on
-        higher than the value = similar. Defaults to 0.6.
+        request (Request): the request, its body is the JSON dataset. It's
+        parsed incrementally, only the id, label and text of every input are
+        kept.
+        threshold (float, optional): the threshold to check the score on
+        higher than the value = similar. Defaults to 0.6, or to no minimum
+        score with top_k.
+        format (str, optional): "json" for one JSON array built in memory,
+        "ndjson" or "json-stream" to stream the pairs while they're scored,
+        "npz" or "arrow" for a columnar table (see `results.PairTable`).
+        Defaults to "json".
+        bot_id (str, optional): compare incrementally against the bot's
+        previous revision, only added or edited inputs are scored.
+        top_k (int, optional): return the top_k most similar inputs of other
+        labels for every input instead of every pair above the threshold.
+        prescreen (bool, optional): skip the label pairs that can't reach the
+        threshold according to their centroids and radii (same result).
+        Requires the in-process float32 scoring. Defaults to False.
 
     Returns:
         List[Dict[str, str]]: a list of dictionaries: 
         `[{"label1": "id1", "label2": "id2", "score": n}, ...]`
     """
-    intents = intent.Intent(file = data)
-    return intents.compute_labeled_scores_fast(threshold)
+    check_format(format)
+    threshold = check_top_k(threshold, top_k, bot_id)
+    if prescreen and (top_k is not None or bot_id is not None):
+        raise HTTPException(status_code=400,
+                            detail="prescreen can't be combined with top_k or bot_id")
+    limiter = limiters["labeled"]
+    admit(limiter)
+    streaming = False
+    try:
+        intents = await load_intents(request, bot_id)
+        if prescreen and (intents.workers > 1 or intents.precision != "float32"):
+            raise HTTPException(status_code=400, detail=(
+                "prescreen can't be combined with SCORING_WORKERS > 1 or "
+                "a SCORING_PRECISION other than float32"))
+        if format == "json":
+            return await admission.run(document, partial(
+                intents.compute_labeled_scores_fast, top_k=top_k,
+                prescreen=prescreen), threshold)
+        if format in results.BINARY_FORMATS:
+            return await admission.run(binary, partial(
+                intents.compute_labeled_table, top_k=top_k,
+                prescreen=prescreen), format, threshold)
+        streaming = True
+        return stream(intents.iter_labeled_scores(
+            threshold, top_k=top_k, prescreen=prescreen), format, limiter)
+    finally:
+        if not streaming:
+            limiter.release()
+
+
+@app.post("/inputs/compare/labels")
+async def label_overview(request: Request, threshold: Optional[float] = None):
+    """A label by label overview of the dataset, without scoring any pair.
+
+    Args:
+        request (Request): the request, its body is the JSON dataset.
+        threshold (float, optional): also list the label pairs that can hold
+        a pair at or above this threshold. Defaults to None.
+
+    Returns:
+        dict: the `labels` with their `sizes` and angular `radius` (degrees),
+        the `centroid_similarity` and score `bound` matrices (label by label)
+        and, with a threshold, the `candidates` label pairs and the fraction
+        of the cross-label pairs they hold (`pairs_scored`).
+    """
+    limiter = limiters["labeled"]
+    admit(limiter)
+    try:
+        intents = await load_intents(request)
+        return await admission.run(document, intents.label_overview, threshold)
+    finally:
+        limiter.release()
 
 
 @app.post("/inputs/compare/unlabeled")
-async def unlabeled_inputs(data: JSONStructure, threshold: int = 0.6, queue: bool = True):
+async def unlabeled_inputs(request: Request, threshold: Optional[float] = None, queue: bool = True,
+                           format: str = "json", approximate: bool = False, n_probe: int = 8,
+                           bot_id: Optional[str] = None, top_k: Optional[int] = None,
+                           clusters: bool = False, min_size: int = 2):
     """Compute the similarity matrix (scores) of unlabeled inputs.
 
     Args:
-        data (JSONStructure): the JSON dataset.
-        threshold (int, optional): the threshold to check the score on.
-        higher than the value means it'is similar. Defaults to 0.6.
+        request (Request): the request, its body is the JSON dataset. It's
+        parsed incrementally, only the id, label and text of every input are
+        kept.
+        threshold (float, optional): the threshold to check the score on.
+        higher than the value means it'is similar. Defaults to 0.6, or to no
+        minimum score with top_k.
+        format (str, optional): "json", "ndjson", "json-stream", "npz" or
+        "arrow". Defaults to "json".
+        approximate (bool, optional): search with an IVF index instead of
+        scoring every pair. Defaults to False.
+        n_probe (int, optional): inverted lists searched in approximate mode.
+        Defaults to 8.
+        bot_id (str, optional): compare incrementally against the bot's
+        previous revision (exact mode only).
+        top_k (int, optional): return the top_k most similar inputs of every
+        input instead of every pair above the threshold (exact mode only).
+        clusters (bool, optional): return the groups of inputs connected by
+        pairs above the threshold instead of the pairs ("json" only).
+        Defaults to False.
+        min_size (int, optional): the smallest cluster returned. Defaults to 2.
 
     Returns:
-        List[Dict[str, str]]: a list of dictionaries: 
-        `[{"label1": "id1", "label2": "id2", "score": n}, ...]`
+        List[Tuple[str, str, float]]: a list of `[input1, input2, score]`,
+        or with clusters a list of `{"size": n, "representative": {"id",
+        "text"}, "members": [{"id", "text"}, ...]}`, largest first.
     """
-    intents = intent.Intent(file = data)
-    return intents.compute_unlabeled_scores(threshold)
+    check_format(format)
+    threshold = check_top_k(threshold, top_k, bot_id)
+    if approximate and bot_id is not None:
+        raise HTTPException(status_code=400,
+                            detail="bot_id can't be combined with approximate")
+    if approximate and top_k is not None:
+        raise HTTPException(status_code=400,
+                            detail="top_k can't be combined with approximate")
+    if clusters and (format != "json" or top_k is not None or bot_id is not None):
+        raise HTTPException(status_code=400, detail="clusters are only returned "
+                            "as json, without top_k or bot_id")
+    limiter = limiters["unlabeled"]
+    admit(limiter)
+    streaming = False
+    try:
+        intents = await load_intents(request, bot_id)
+        if clusters:
+            return await admission.run(document, partial(
+                intents.cluster_unlabeled, min_size=min_size),
+                threshold, approximate, n_probe)
+        if format == "json":
+            return await admission.run(document, partial(
+                intents.compute_unlabeled_scores, top_k=top_k),
+                threshold, approximate, n_probe)
+        if format in results.BINARY_FORMATS:
+            return await admission.run(binary, partial(
+                intents.compute_unlabeled_table, top_k=top_k),
+                format, threshold, approximate, n_probe)
+        streaming = True
+        return stream(intents.iter_unlabeled_scores(
+            threshold, approximate, n_probe, top_k=top_k), format, limiter)
+    finally:
+        if not streaming:
+            limiter.release()
 
 
 @app.post("/similarity")
-async def unlabeled_inputs(sentence_1: str, sentence_2: str, threshold: float = 0.6):
+async def sentence_similarity(sentence_1: str, sentence_2: str, threshold: float = 0.6):
     """Compares 2 sentences and returns the similarity.
 
     Args:
@@ -66,8 +283,56 @@ async def unlabeled_inputs(sentence_1: str, sentence_2: str, threshold: float =
     Returns:
         bool: if the computed matrix score is higher than the given score parameter, return True. Otherwise return False.
     """
-    return intent.similarity(sentence_1, sentence_2, threshold)
+    limiter = limiters["similarity"]
+    admit(limiter)
+    try:
+        return await intent.similarity_async(
+            sentence_1, sentence_2, threshold, similarity_batcher)
+    finally:
+        limiter.release()
+
+
+@app.get("/similarity/stats")
+async def similarity_stats():
+    """Queue depth and batch size statistics of the /similarity batching.
+    """
+    return similarity_batcher.stats
+
+
+@app.get("/admission/stats")
+async def admission_stats():
+    """Active, admitted and rejected requests of every limited route.
+    """
+    return {limiter.name: limiter.stats for limiter in limiters.values()}
+
+
+@app.get("/results/stats")
+async def result_cache_stats():
+    """Entries, hits and misses of the compare result cache.
+    """
+    cache = memo.default_cache()
+    return cache.stats if cache is not None else {"enabled": False}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Stage timings and counters in the Prometheus text format.
+    """
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await similarity_batcher.close()
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host=getenv("HOST"), port=int(getenv("PORT")))
+    workers = int(getenv("API_WORKERS") or 1)
+    if workers > 1 and not getenv("EMBEDDING_CACHE_DIR"):
+        # The workers share their embeddings through the on-disk cache.
+        environ["EMBEDDING_CACHE_DIR"] = "embeddings"
+        logging.getLogger(__name__).warning(
+            "EMBEDDING_CACHE_DIR isn't set, the workers share ./embeddings")
+    # Several workers need the app as an import string.
+    uvicorn.run("main:app" if workers > 1 else app, host=getenv("HOST"),
+                port=int(getenv("PORT")), workers=workers)
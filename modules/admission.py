@@ -0,0 +1,143 @@
+"""Admission control for the compute-heavy API routes.
+
+Every compare route gets a `Limiter` with a fixed number of slots. A request
+that finds no free slot is rejected straight away (the API answers 429 with a
+`Retry-After` header) instead of waiting behind the running jobs, and the
+admitted jobs run in a bounded thread pool so the event loop stays free for
+cheap calls like `/` and `/similarity`.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+
+class Saturated(Exception):
+    """Raised when every slot of a limiter is taken.
+    """
+
+    def __init__(self, name: str, limit: int):
+        super().__init__(f"{name} is at its limit of {limit} concurrent requests")
+        self.name = name
+        self.limit = limit
+
+
+class Limiter():
+    """A fixed number of concurrent slots that never makes a caller wait.
+    """
+
+    def __init__(self, name: str, limit: int):
+        """Create the limiter.
+
+        Args:
+            name (str): the name used in errors and stats, e.g. the route.
+            limit (int): the number of concurrent slots.
+        """
+        if limit < 1:
+            raise ValueError("limit must be a positive integer")
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        # Slots are released from the threads streaming the responses.
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a slot.
+
+        Raises:
+            Saturated: when all slots are taken.
+        """
+        with self._lock:
+            if self.active >= self.limit:
+                self.rejected += 1
+                raise Saturated(self.name, self.limit)
+            self.active += 1
+            self.admitted += 1
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+    def hold(self, items: Iterable) -> "Held":
+        """Hand the taken slot over to a response streamed after the handler
+        returned, see `Held`.
+        """
+        return Held(self, items)
+
+    @property
+    def stats(self) -> dict:
+        return {"active": self.active, "limit": self.limit,
+                "admitted": self.admitted, "rejected": self.rejected}
+
+
+class Held():
+    """An iterator that releases its limiter slot once it's exhausted,
+    fails, is closed or is garbage collected without ever being started.
+    """
+
+    def __init__(self, limiter: Limiter, items: Iterable):
+        self._limiter = limiter
+        self._items = iter(items)
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> Iterator:
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._items)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        close = getattr(self._items, "close", None)
+        if close is not None:
+            close()
+        self._limiter.release()
+
+    def __del__(self):
+        self.close()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor() -> ThreadPoolExecutor:
+    """The pool running admitted jobs, sized by `COMPUTE_THREADS`.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("COMPUTE_THREADS", 4)),
+                thread_name_prefix="compute")
+        return _executor
+
+
+async def run(func: Callable, *args, **kwargs):
+    """Run a blocking call in the compute pool and await its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor(), functools.partial(func, *args, **kwargs))
+
+
+def from_env(name: str, variable: str, default: int) -> Limiter:
+    """A limiter whose slot count is read from an environment variable.
+    """
+    return Limiter(name, int(os.getenv(variable, default)))
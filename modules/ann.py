@@ -0,0 +1,233 @@
+"""Approximate all-pairs search with an inverted file (IVF) index.
+
+The embeddings are clustered with spherical k-means into `n_lists` inverted
+lists. To find every pair above a threshold, the members of each list are
+only scored against the members of the `n_probe` lists whose centroids are
+closest to their own, instead of against the whole matrix. Recall against
+the exact search is measured with `measure_recall`.
+
+Indexes are keyed by a fingerprint of the embedding matrix, so a bot whose
+inputs didn't change can reuse the index saved by a previous run.
+"""
+
+import hashlib
+import logging
+import os
+import numpy as np
+from typing import Iterator
+from modules import metrics, scoring
+from modules.scoring import PairBlock
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(matrix: np.ndarray) -> str:
+    """A content hash of an embedding matrix.
+    """
+    digest = hashlib.sha1(str(matrix.shape).encode())
+    digest.update(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+class IVFIndex():
+    """Inverted file index over a fixed embedding matrix.
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray,
+                 fingerprint: str = None):
+        """Wrap already computed centroids, see `build` to create an index.
+
+        Args:
+            centroids (np.ndarray): one unit vector per inverted list.
+            assignments (np.ndarray): the list of every matrix row.
+            fingerprint (str, optional): the fingerprint of the indexed matrix.
+        """
+        self.centroids = centroids
+        self.assignments = assignments
+        self.fingerprint = fingerprint
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order],
+                                 np.arange(len(centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]]
+                      for i in range(len(centroids))]
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, n_lists: int = None,
+              iterations: int = 10, seed: int = 0) -> "IVFIndex":
+        """Cluster the matrix rows with spherical k-means.
+
+        Args:
+            matrix (np.ndarray): the embeddings.
+            n_lists (int, optional): the number of inverted lists.
+            Defaults to √n.
+            iterations (int, optional): k-means iterations. Defaults to 10.
+            seed (int, optional): the seed of the initial centroids.
+            Defaults to 0.
+
+        Returns:
+            IVFIndex: the index.
+        """
+        n = len(matrix)
+        n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        logger.info(f"Building IVF index ({n_lists} lists over {n} vectors)...")
+        centroids = matrix[rng.choice(n, n_lists, replace=False)].astype(np.float32)
+        for _ in range(iterations):
+            assignments = _assign(matrix, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, matrix)
+            counts = np.bincount(assignments, minlength=n_lists)
+            # Lists that lost every member are reseeded with random rows.
+            empty = counts == 0
+            sums[empty] = matrix[rng.choice(n, int(empty.sum()))]
+            centroids = _unit(sums)
+        return cls(centroids, _assign(matrix, centroids), fingerprint(matrix))
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["centroids"], data["assignments"],
+                       str(data["fingerprint"]))
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids,
+                     assignments=self.assignments,
+                     fingerprint=np.array(self.fingerprint or ""))
+
+    def iter_pairs(self, matrix: np.ndarray, threshold: float = 0.6,
+                   n_probe: int = 8,
+                   block_size: int = scoring.DEFAULT_BLOCK_SIZE) -> Iterator[PairBlock]:
+        """Yield the pairs `i < j` above the threshold found by probing.
+
+        A pair is found when the list of `j` is among the `n_probe` lists
+        closest to the list of `i`. Every pair is yielded at most once.
+
+        Args:
+            matrix (np.ndarray): the indexed embeddings.
+            threshold (float, optional): the minimum score. Defaults to 0.6.
+            n_probe (int, optional): lists searched per list. Defaults to 8.
+            block_size (int, optional): query rows per matrix multiply.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: rows, columns and
+            scores per inverted list, ordered by row then column.
+        """
+        n_probe = min(n_probe, len(self.centroids))
+        closest = np.argsort(-(self.centroids @ self.centroids.T),
+                             axis=1, kind="stable")[:, :n_probe]
+        for list_id, members in enumerate(self.lists):
+            if not len(members):
+                continue
+            candidates = np.sort(np.concatenate(
+                [self.lists[probe] for probe in closest[list_id]]))
+            candidate_matrix = matrix[candidates]
+            rows, cols, scores = [], [], []
+            for start in range(0, len(members), block_size):
+                queries = members[start:start + block_size]
+                tile = matrix[queries] @ candidate_matrix.T
+                if metrics.enabled():
+                    # Candidates past each query (the i < j side of the tile).
+                    metrics.PAIRS_EVALUATED.inc(int(
+                        (len(candidates) - np.searchsorted(
+                            candidates, queries, side="right")).sum()))
+                mask = ((tile >= threshold)
+                        & (queries[:, None] < candidates[None, :]))
+                r, c = np.nonzero(mask)
+                rows.append(queries[r])
+                cols.append(candidates[c])
+                scores.append(tile[r, c])
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
+            scores = np.concatenate(scores)
+            order = np.lexsort((cols, rows))
+            yield rows[order], cols[order], scores[order]
+
+
+def load_or_build(matrix: np.ndarray, directory: str = None,
+                  **kwargs) -> IVFIndex:
+    """Reuse the saved index of this exact matrix, or build and save one.
+
+    Args:
+        matrix (np.ndarray): the embeddings.
+        directory (str, optional): where indexes are kept. Defaults to
+        `ANN_INDEX_DIR` in .env, without it nothing is persisted.
+        **kwargs: passed to `IVFIndex.build`.
+
+    Returns:
+        IVFIndex: the index.
+    """
+    directory = directory or os.getenv("ANN_INDEX_DIR")
+    if not directory:
+        return IVFIndex.build(matrix, **kwargs)
+    path = os.path.join(directory, f"{fingerprint(matrix)}.npz")
+    if os.path.exists(path):
+        logger.info(f"Loading IVF index {path}")
+        return IVFIndex.load(path)
+    index = IVFIndex.build(matrix, **kwargs)
+    os.makedirs(directory, exist_ok=True)
+    # Written under a temporary name so concurrent runs never read half a file.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    index.save(tmp_path)
+    os.replace(tmp_path, path)
+    return index
+
+
+def measure_recall(matrix: np.ndarray, index: IVFIndex,
+                   threshold: float = 0.6, n_probe: int = 8) -> dict:
+    """Compare the index against the exact block-matrix search.
+
+    Args:
+        matrix (np.ndarray): the indexed embeddings.
+        index (IVFIndex): the index.
+        threshold (float, optional): the minimum score. Defaults to 0.6.
+        n_probe (int, optional): lists searched per list. Defaults to 8.
+
+    Returns:
+        dict: see `recall`.
+    """
+    return recall(scoring.iter_pair_blocks(matrix, threshold),
+                  index.iter_pairs(matrix, threshold, n_probe), len(matrix))
+
+
+def recall(exact: Iterator[PairBlock], approximate: Iterator[PairBlock],
+           n: int) -> dict:
+    """Compare the pairs of an approximate search with the exact ones.
+
+    Args:
+        exact (Iterator[PairBlock]): the exact pair blocks.
+        approximate (Iterator[PairBlock]): the approximate pair blocks.
+        n (int): the number of matrix rows.
+
+    Returns:
+        dict: `exact` and `approximate` pair counts, the `recall` and the
+        `extra` approximate pairs that the exact search doesn't have (0
+        unless the index is broken).
+    """
+    exact = _pair_keys(exact, n)
+    approximate = _pair_keys(approximate, n)
+    found = np.intersect1d(exact, approximate, assume_unique=True)
+    return {
+        "exact": len(exact),
+        "approximate": len(approximate),
+        "recall": len(found) / len(exact) if len(exact) else 1.0,
+        "extra": len(approximate) - len(found),
+    }
+
+
+def _pair_keys(blocks: Iterator[PairBlock], n: int) -> np.ndarray:
+    keys = [rows.astype(np.int64) * n + cols for rows, cols, _ in blocks]
+    return np.unique(np.concatenate(keys)) if keys else np.empty(0, np.int64)
+
+
+def _assign(matrix: np.ndarray, centroids: np.ndarray,
+            block_size: int = scoring.DEFAULT_BLOCK_SIZE) -> np.ndarray:
+    return np.concatenate([
+        np.argmax(matrix[i:i + block_size] @ centroids.T, axis=1)
+        for i in range(0, len(matrix), block_size)])
+
+
+def _unit(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
@@ -0,0 +1,153 @@
+"""Dynamic micro-batching of embedding requests.
+
+Concurrent callers of `MicroBatcher.embed` are queued for at most `max_wait`
+seconds (or until `max_batch` sentences are waiting), embedded together with
+one encoder call and answered individually. Under load this turns hundreds of
+two-sentence encoder round trips per second into a few larger ones.
+"""
+
+import asyncio
+import logging
+import os
+import numpy as np
+from typing import Awaitable, Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher():
+    """Collects concurrent embedding requests into shared encoder batches.
+    """
+
+    def __init__(self, embed: Callable[[List[str]], Awaitable[np.ndarray]],
+                 max_wait: float = 0.005, max_batch: int = 64):
+        """Create the batcher, its worker task starts with the first request.
+
+        Args:
+            embed (Callable): awaitable encoder, e.g. `Intent.batch_embed_async`.
+            max_wait (float, optional): seconds the first request of a batch
+            waits for company. Defaults to 0.005.
+            max_batch (int, optional): sentences that close a batch early.
+            Defaults to 64.
+        """
+        self._embed = embed
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._queue = None
+        self._worker = None
+        self._pending = set()
+        self.batches = 0
+        self.sentences = 0
+        self.largest_batch = 0
+        # Batch sizes in power of two buckets: 1, 2, 4, ... sentences.
+        self.histogram = {}
+
+    async def embed(self, sentences: List[str]) -> np.ndarray:
+        """Embed the sentences as part of the next batch.
+
+        Args:
+            sentences (List[str]): the sentences of this request.
+
+        Returns:
+            np.ndarray: their embeddings, one row per sentence.
+        """
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((list(sentences), future))
+        return await future
+
+    @property
+    def stats(self) -> dict:
+        """Queue depth and batch size statistics.
+        """
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "batches_in_flight": len(self._pending),
+            "batches": self.batches,
+            "sentences": self.sentences,
+            "mean_batch_size": self.sentences / self.batches if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "batch_size_histogram": dict(sorted(self.histogram.items())),
+            "max_wait_ms": self.max_wait * 1000,
+            "max_batch": self.max_batch,
+        }
+
+    async def close(self):
+        """Stop collecting, embed the requests still queued as a last batch
+        and wait for the batches being embedded.
+        """
+        if self._worker is not None:
+            worker, self._worker = self._worker, None
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                size = len(batch[0][0])
+                deadline = loop.time() + self.max_wait
+                while size < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    batch.append(request)
+                    size += len(request[0])
+                self._start(batch)
+                batch = []
+        except asyncio.CancelledError:
+            # Closed: the requests collected so far and the queued ones are
+            # still answered.
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if batch:
+                self._start(batch)
+            raise
+
+    def _start(self, batch: list):
+        # Embedding runs on its own so the next batch is collected meanwhile.
+        task = asyncio.create_task(self._run(batch))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _run(self, batch: list):
+        sentences = [sentence for request, _ in batch for sentence in request]
+        self.batches += 1
+        self.sentences += len(sentences)
+        self.largest_batch = max(self.largest_batch, len(sentences))
+        bucket = 1 << max(len(sentences) - 1, 0).bit_length()
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+        try:
+            matrix = await self._embed(sentences)
+        except Exception as ex:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        start = 0
+        for request, future in batch:
+            if not future.done():
+                future.set_result(matrix[start:start + len(request)])
+            start += len(request)
+
+
+def from_env(embed: Callable[[List[str]], Awaitable[np.ndarray]]) -> MicroBatcher:
+    """A batcher tuned with `SIMILARITY_MAX_WAIT_MS` and `SIMILARITY_MAX_BATCH`.
+    """
+    return MicroBatcher(
+        embed,
+        max_wait=float(os.getenv("SIMILARITY_MAX_WAIT_MS", 5)) / 1000,
+        max_batch=int(os.getenv("SIMILARITY_MAX_BATCH", 64)))
@@ -0,0 +1,527 @@
+"""Persistent, content-addressed embedding cache.
+
+Embeddings are keyed by a hash of the normalized sentence text, so unchanged
+bot inputs are never sent to the encoder twice. The cache lives in a
+directory shared by every process on the machine:
+
+    index.sqlite3       key -> slot, last_used (plus a small meta table)
+    vectors.<gen>.f32   append-only float32 rows, memory-mapped for reads
+
+Appends and compactions are serialized with an `flock` on `lock`, reads only
+go through SQLite and the memory map. When the index grows past `max_entries`
+the least recently used keys are dropped; their rows are reclaimed once
+dead rows outnumber live ones by rewriting the vector file (a new
+generation).
+
+Several API workers share one cache as a single writer and many readers.
+The process holding the `flock` on `writer` appends to the vector file and
+is the only one writing the index, the others open the index read-only and
+map the vector file read-only (lazily, on their first lookup, and again when
+it has grown or was compacted) so every worker reads the same pages of the
+page cache. A reader doesn't append the embeddings it computed itself, it
+drops them in `incoming/` and the writer moves them into the cache within
+`drain_interval` seconds. The keys a reader found are handed in the same way
+(at most once per `drain_interval`), the writer then marks them as recently
+used. Hand-ins stop with a warning once `incoming/` holds `max_incoming`
+bytes, e.g. while no process is the writer. When the writer exits, the next
+reader that stores embeddings takes its place.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import numpy as np
+from contextlib import contextmanager
+from typing import List, Tuple
+from modules import encoder
+
+logger = logging.getLogger(__name__)
+
+# SQLite's default limit on host parameters is 999.
+_SQL_CHUNK = 900
+
+ROLES = ("auto", "writer", "reader")
+
+# Found keys a reader collects before handing them in, whatever the interval.
+_MAX_TOUCHED = 100_000
+
+
+def normalize(sentence: str) -> str:
+    """Normalize a sentence before hashing it into a cache key.
+
+    Unicode is NFC-normalized and whitespace runs are collapsed, case is kept
+    because the encoder is case sensitive.
+
+    Args:
+        sentence (str): the raw sentence.
+
+    Returns:
+        str: the normalized sentence.
+    """
+    return " ".join(unicodedata.normalize("NFC", sentence).split())
+
+
+class EmbeddingCache():
+    """On-disk embedding cache shared across processes.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 1_000_000,
+                 namespace: str = "", role: str = "auto",
+                 drain_interval: float = 1.0, max_incoming: int = 256 << 20):
+        """Open (or create) the cache in the given directory.
+
+        Args:
+            directory (str): the cache directory, created when missing.
+            max_entries (int, optional): the size cap, least recently used
+            entries above it are evicted. Defaults to 1_000_000.
+            namespace (str, optional): mixed into every key so embeddings of
+            different encoders never collide. Defaults to "".
+            role (str, optional): "writer" becomes the cache's writer as soon
+            as there's none (waiting in a background thread, it's a reader
+            until then), "reader" never appends itself and "auto" becomes the
+            writer when there's none. Defaults to "auto".
+            drain_interval (float, optional): seconds between the writer's
+            scans of the embeddings handed in by readers. Defaults to 1.0.
+            max_incoming (int, optional): the bytes of hand-ins waiting in
+            `incoming/` above which readers drop theirs. Defaults to 256MiB.
+        """
+        if role not in ROLES:
+            raise ValueError(f"role must be one of {ROLES}")
+        self.directory = directory
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self.role = role
+        self.drain_interval = drain_interval
+        self.max_incoming = max_incoming
+        self.writer = False
+        self.hits = 0
+        self.misses = 0
+        # The SQLite connection is shared by the threads of this process.
+        self._mutex = threading.RLock()
+        # (generation, vectors) of the read-only mapping of the vector file.
+        self._mapped = None
+        self._writer_file = None
+        # Keys a reader found since it last handed them in.
+        self._touched = set()
+        self._touched_at = time.monotonic()
+        self._incoming_full = False
+        os.makedirs(directory, exist_ok=True)
+        self._incoming = os.path.join(directory, "incoming")
+        os.makedirs(self._incoming, exist_ok=True)
+        self._lock_path = os.path.join(directory, "lock")
+        self._index_path = os.path.join(directory, "index.sqlite3")
+        with self._locked():
+            db = self._connect()
+            db.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS entries (
+                    key BLOB PRIMARY KEY,
+                    slot INTEGER NOT NULL,
+                    last_used REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS entries_last_used
+                    ON entries (last_used);
+                CREATE TABLE IF NOT EXISTS meta (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL);
+                INSERT OR IGNORE INTO meta VALUES ('generation', 0);
+            """)
+            db.close()
+        self._db = self._connect(read_only=True)
+        if role != "reader" and not self._claim(blocking=False) and role == "writer":
+            # Take over once the current writer exits, without blocking here.
+            threading.Thread(target=self._claim, args=(True,), daemon=True,
+                             name="embedding-cache-claim").start()
+
+    def key(self, sentence: str) -> bytes:
+        """The cache key of an already normalized sentence.
+
+        Args:
+            sentence (str): the normalized sentence.
+
+        Returns:
+            bytes: a 20 byte SHA-1 digest.
+        """
+        return hashlib.sha1(
+            f"{self.namespace}\0{sentence}".encode("utf-8")).digest()
+
+    @property
+    def stats(self) -> dict:
+        """Hit and miss counters since this object was created, and whether
+        this process is the cache's writer.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "role": "writer" if self.writer else "reader"}
+
+    def __len__(self) -> int:
+        with self._mutex:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get_many(self, sentences: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Look up normalized sentences.
+
+        Args:
+            sentences (List[str]): the normalized sentences.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: a boolean hit mask and the matrix
+            of the hits (in the order of `sentences[mask]`). The matrix is
+            None when nothing was found.
+        """
+        keys = [self.key(sentence) for sentence in sentences]
+        # A compaction may remove the vector file between reading the index
+        # and mapping the file, in which case the lookup is simply retried.
+        for _ in range(3):
+            try:
+                with self._mutex:
+                    found, matrix = self._read(keys)
+                break
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as ex:
+                logger.warning(f"Can't map the embedding cache's vectors: {ex}")
+                found, matrix = np.zeros(len(keys), dtype=bool), None
+                break
+        else:
+            found, matrix = np.zeros(len(keys), dtype=bool), None
+        hits = int(found.sum())
+        with self._mutex:
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found, matrix
+
+    def put_many(self, sentences: List[str], matrix: np.ndarray):
+        """Append embeddings of normalized sentences to the cache.
+
+        Readers hand them to the writer instead, see `drain`.
+
+        Args:
+            sentences (List[str]): the normalized sentences.
+            matrix (np.ndarray): their embeddings, one row per sentence.
+        """
+        if not len(sentences):
+            return
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        keys = [self.key(sentence) for sentence in sentences]
+        if not self.writer and self.role == "auto":
+            # The writer may have exited, take over.
+            self._claim(blocking=False)
+        if not self.writer:
+            self._hand_in(keys, matrix)
+            return
+        with self._mutex, self._locked():
+            self._append(keys, matrix)
+
+    def drain(self) -> int:
+        """Append the embeddings readers handed in to the cache. Only the
+        writer drains, it does so every `drain_interval` seconds.
+
+        Returns:
+            int: the number of embeddings appended.
+        """
+        if not self.writer:
+            return 0
+        appended = 0
+        names = sorted(name for name in os.listdir(self._incoming)
+                       if name.endswith(".npz"))
+        for name in names:
+            path = os.path.join(self._incoming, name)
+            try:
+                with np.load(path, allow_pickle=False) as data:
+                    if "touched" in data.files:
+                        keys, matrix = _keys(data["touched"]), None
+                    else:
+                        keys, matrix = _keys(data["keys"]), data["vectors"]
+            except (OSError, ValueError, KeyError) as ex:
+                logger.warning(f"Dropping unreadable cache hand-in {name}: {ex}")
+                os.remove(path)
+                continue
+            if matrix is None:
+                with self._mutex:
+                    self._touch(keys)
+                os.remove(path)
+                continue
+            with self._mutex, self._locked():
+                # Several readers may have embedded the same sentence.
+                known = self._slots(keys)
+                new = [i for i, key in enumerate(keys) if key not in known]
+                if new:
+                    self._append([keys[i] for i in new], matrix[new])
+                os.remove(path)
+            appended += len(new)
+        if appended:
+            logger.info(f"Appended {appended} embeddings handed in by readers")
+        return appended
+
+    def _append(self, keys: List[bytes], matrix: np.ndarray):
+        """Append rows to the vector file and index them.
+
+        Must be called by the writer while holding the lock.
+        """
+        now = time.time()
+        dim = self._meta("dim")
+        if dim is None:
+            self._db.execute("INSERT INTO meta VALUES ('dim', ?)",
+                             (matrix.shape[1],))
+        elif dim != matrix.shape[1]:
+            raise ValueError(f"Cache holds {dim}-d vectors, "
+                             f"got {matrix.shape[1]}-d")
+        path = self._vectors_path(self._meta("generation"))
+        first_slot = self._whole_rows(path, matrix.shape[1])
+        with open(path, "ab") as vectors:
+            vectors.write(matrix.tobytes())
+        self._db.execute("BEGIN")
+        self._db.executemany(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+            ((key, first_slot + i, now) for i, key in enumerate(keys)))
+        self._db.execute("COMMIT")
+        self._evict(first_slot + len(keys))
+
+    def _read(self, keys: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+        slots = {}
+        self._db.execute("BEGIN")
+        try:
+            generation = self._meta("generation")
+            dim = self._meta("dim")
+            slots = self._slots(keys)
+        finally:
+            self._db.execute("COMMIT")
+        if slots:
+            vectors = self._vectors(generation, dim, max(slots.values()))
+            # Rows lost with a torn append are misses.
+            slots = {key: slot for key, slot in slots.items()
+                     if slot < len(vectors)}
+        found = np.fromiter((key in slots for key in keys), dtype=bool,
+                            count=len(keys))
+        if not slots:
+            return found, None
+        hit_keys = [key for key in keys if key in slots]
+        matrix = np.array(vectors[[slots[key] for key in hit_keys]])
+        if self.writer:
+            self._touch(hit_keys)
+        else:
+            self._touched.update(hit_keys)
+            if (len(self._touched) >= _MAX_TOUCHED or time.monotonic()
+                    - self._touched_at >= self.drain_interval):
+                self._hand_in(touched=_key_array(list(self._touched)))
+                self._touched.clear()
+                self._touched_at = time.monotonic()
+        return found, matrix
+
+    def _slots(self, keys: List[bytes]) -> dict:
+        slots = {}
+        for i in range(0, len(keys), _SQL_CHUNK):
+            chunk = keys[i:i + _SQL_CHUNK]
+            slots.update(self._db.execute(
+                "SELECT key, slot FROM entries WHERE key IN "
+                f"({','.join('?' * len(chunk))})", chunk))
+        return slots
+
+    def _vectors(self, generation: int, dim: int, last_slot: int) -> np.ndarray:
+        """The read-only mapping of the vector file, mapped again when the
+        generation changed or `last_slot` was appended after it was mapped.
+        """
+        if self._mapped is not None:
+            mapped_generation, vectors = self._mapped
+            if mapped_generation == generation and last_slot < len(vectors):
+                return vectors
+        path = self._vectors_path(generation)
+        row_bytes = dim * np.dtype(np.float32).itemsize
+        rows, torn = divmod(os.path.getsize(path), row_bytes)
+        if torn:
+            with self._locked():
+                rows = self._whole_rows(path, dim)
+        if rows:
+            vectors = np.memmap(path, dtype=np.float32, mode="r",
+                                shape=(rows, dim))
+        else:
+            vectors = np.empty((0, dim), dtype=np.float32)
+        self._mapped = generation, vectors
+        return vectors
+
+    def _whole_rows(self, path: str, dim: int) -> int:
+        """Cut a partial row left by an interrupted append off the vector
+        file, returns its number of rows.
+
+        Must be called while holding the lock, an append in progress would
+        look torn too.
+        """
+        row_bytes = dim * np.dtype(np.float32).itemsize
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+        rows, torn = divmod(size, row_bytes)
+        if torn:
+            logger.warning(f"Truncating a torn append of {torn} bytes "
+                           f"off {path}")
+            os.truncate(path, rows * row_bytes)
+        return rows
+
+    def _hand_in(self, keys: List[bytes] = None, matrix: np.ndarray = None,
+                 **arrays):
+        """Leave embeddings (or the `touched` keys a reader found) in
+        `incoming/` for the writer, unless it already holds `max_incoming`
+        bytes.
+        """
+        if keys is not None:
+            arrays.update(keys=_key_array(keys), vectors=matrix)
+        waiting = sum(entry.stat().st_size for entry in os.scandir(self._incoming)
+                      if entry.is_file())
+        if waiting >= self.max_incoming:
+            if not self._incoming_full:
+                logger.warning(f"{self._incoming} holds {waiting} bytes of hand-ins, "
+                               "dropping new ones until the cache's writer drains "
+                               "them (is there a writer?)")
+            self._incoming_full = True
+            return
+        self._incoming_full = False
+        path = os.path.join(self._incoming,
+                            f"{time.time_ns()}-{os.getpid()}-{threading.get_ident()}.npz")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(tmp_path, path)
+
+    def _claim(self, blocking: bool) -> bool:
+        """Try to become the cache's writer, the `flock` on `writer` is held
+        for the rest of the process.
+        """
+        file = open(os.path.join(self.directory, "writer"), "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX if blocking
+                        else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        with self._mutex:
+            # Only the writer writes the index.
+            self._db.close()
+            self._db = self._connect()
+            self._writer_file = file
+            self.writer = True
+        logger.info(f"Process {os.getpid()} is the writer of the embedding "
+                    f"cache in {self.directory}")
+        threading.Thread(target=self._drain_forever, daemon=True,
+                         name="embedding-cache-drain").start()
+        return True
+
+    def _drain_forever(self):
+        while True:
+            try:
+                self.drain()
+            except Exception as ex:
+                logger.exception(f"Draining the embedding cache failed: {ex}")
+            time.sleep(self.drain_interval)
+
+    def _touch(self, keys: List[bytes]):
+        now = time.time()
+        self._db.execute("BEGIN")
+        for i in range(0, len(keys), _SQL_CHUNK):
+            chunk = keys[i:i + _SQL_CHUNK]
+            self._db.execute(
+                "UPDATE entries SET last_used = ? WHERE key IN "
+                f"({','.join('?' * len(chunk))})", (now, *chunk))
+        self._db.execute("COMMIT")
+
+    def _evict(self, total_rows: int):
+        """Drop least recently used entries and compact the vector file.
+
+        Must be called while holding the lock.
+        """
+        live = len(self)
+        if live > self.max_entries:
+            self._db.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries "
+                "ORDER BY last_used LIMIT ?)", (live - self.max_entries,))
+            logger.info(f"Evicted {live - self.max_entries} cached embeddings")
+            live = self.max_entries
+        if total_rows > 2 * live:
+            self._compact()
+
+    def _compact(self):
+        generation = self._meta("generation")
+        dim = self._meta("dim")
+        old_path = self._vectors_path(generation)
+        new_path = self._vectors_path(generation + 1)
+        old = np.memmap(old_path, dtype=np.float32, mode="r").reshape(-1, dim)
+        entries = self._db.execute(
+            "SELECT key, slot FROM entries ORDER BY slot").fetchall()
+        slots = np.fromiter((slot for _, slot in entries), dtype=np.int64,
+                            count=len(entries))
+        with open(new_path, "wb") as vectors:
+            vectors.write(np.ascontiguousarray(old[slots]).tobytes())
+        del old
+        self._db.execute("BEGIN")
+        self._db.executemany(
+            "UPDATE entries SET slot = ? WHERE key = ?",
+            ((i, key) for i, (key, _) in enumerate(entries)))
+        self._db.execute("UPDATE meta SET value = ? WHERE name = 'generation'",
+                         (generation + 1,))
+        self._db.execute("COMMIT")
+        os.remove(old_path)
+        logger.info(f"Compacted embedding cache to {len(entries)} rows")
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        if read_only:
+            return sqlite3.connect(
+                f"file:{self._index_path}?mode=ro", uri=True, timeout=60,
+                isolation_level=None, check_same_thread=False)
+        return sqlite3.connect(self._index_path, timeout=60,
+                               isolation_level=None, check_same_thread=False)
+
+    def _meta(self, name: str):
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?",
+                               (name,)).fetchone()
+        return row[0] if row else None
+
+    def _vectors_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"vectors.{generation}.f32")
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _key_array(keys: List[bytes]) -> np.ndarray:
+    return np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(len(keys), -1)
+
+
+def _keys(array: np.ndarray) -> List[bytes]:
+    return [key.tobytes() for key in array]
+
+
+_default_cache = None
+
+
+def default_cache() -> EmbeddingCache:
+    """The process-wide cache configured through `EMBEDDING_CACHE_DIR`.
+
+    Entries are namespaced by the configured encoder backend, embeddings of
+    different models never mix.
+
+    Returns:
+        EmbeddingCache: the cache, or None when caching is not configured.
+    """
+    global _default_cache
+    directory = os.getenv("EMBEDDING_CACHE_DIR")
+    if not directory:
+        return None
+    if _default_cache is None or _default_cache.directory != directory:
+        _default_cache = EmbeddingCache(
+            directory,
+            max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 1_000_000)),
+            namespace=encoder.default_encoder().name,
+            role=os.getenv("EMBEDDING_CACHE_ROLE") or "auto",
+            drain_interval=float(os.getenv("EMBEDDING_CACHE_DRAIN_SECONDS") or 1.0),
+            max_incoming=int(os.getenv("EMBEDDING_CACHE_MAX_INCOMING_MB") or 256) << 20)
+    return _default_cache
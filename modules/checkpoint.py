@@ -0,0 +1,226 @@
+"""Checkpointed, resumable pair scoring.
+
+A long compare run persists its progress to a work directory: the embedding
+matrix once it's embedded, then the thresholded pairs of every finished row
+block, with a manifest recording how far the run got. When the process is
+killed and the same run is started again (same dataset, encoder, threshold
+and block size) it picks up the stored matrix and blocks and continues after
+the last finished block, instead of embedding and scoring from zero.
+
+Runs live in `CHECKPOINT_DIR/<key>/`, finished runs are kept (a retried job
+reads its result back) until they're older than `CHECKPOINT_MAX_AGE_HOURS`.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import time
+import numpy as np
+import ujson
+from typing import Any, Callable, Iterator, List
+from modules import metrics, scoring
+from modules.scoring import PairBlock
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+MATRIX = "matrix.npy"
+
+
+class Checkpoint():
+    """The work directory of one run.
+    """
+
+    def __init__(self, directory: str, key: str):
+        """Open (or start) the run `key`, see `open`.
+
+        Args:
+            directory (str): the run's work directory.
+            key (str): identifies the run's inputs and options.
+        """
+        self.directory = directory
+        self.key = key
+        self.manifest = self._load_manifest()
+
+    @classmethod
+    def open(cls, root: str, *parts, max_age: float = None) -> "Checkpoint":
+        """Open the run identified by `parts` below `root`, removing runs
+        older than `max_age` seconds.
+
+        Args:
+            root (str): the directory holding the runs.
+            parts: what identifies the run, e.g. the dataset fingerprint,
+            the encoder, the threshold and the block size.
+            max_age (float, optional): seconds after which a run is removed.
+            Defaults to `CHECKPOINT_MAX_AGE_HOURS`.
+
+        Returns:
+            Checkpoint: the run.
+        """
+        key = hashlib.blake2b("\0".join(map(str, parts)).encode("utf-8"),
+                              digest_size=16).hexdigest()
+        prune(root, default_max_age() if max_age is None else max_age, keep=key)
+        return cls(os.path.join(root, key), key)
+
+    @property
+    def complete(self) -> bool:
+        return self.manifest.get("complete", False)
+
+    @property
+    def progress(self) -> float:
+        """The fraction of the run's pairs scored so far.
+        """
+        total = self.manifest.get("total_pairs")
+        if not total:
+            return 1.0 if self.complete else 0.0
+        return self.manifest["pairs_done"] / total
+
+    def matrix(self, embed: Callable[[List[str]], np.ndarray],
+               sentences: List[str]) -> np.ndarray:
+        """The stored embedding matrix, or embed the sentences and store it.
+
+        Args:
+            embed (Callable): encodes a list of texts, e.g. `Intent.batch_embed`.
+            sentences (List[str]): the texts, one matrix row each.
+
+        Returns:
+            np.ndarray: the matrix (memory mapped when it was stored before).
+        """
+        path = os.path.join(self.directory, MATRIX)
+        if self.manifest.get("matrix") and os.path.exists(path):
+            logger.info(f"Resuming checkpoint {self.key} with its stored embeddings")
+            return np.load(path, mmap_mode="r")
+        matrix = np.asarray(embed(sentences), dtype=np.float32)
+        os.makedirs(self.directory, exist_ok=True)
+        _write(path, lambda file: np.save(file, matrix))
+        self.manifest.update(matrix=True, inputs=len(matrix))
+        self._save_manifest()
+        return matrix
+
+    def blocks(self, matrix: np.ndarray, threshold: float = 0.6,
+               codes: np.ndarray = None,
+               block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+               progress: Callable[[float], Any] = None) -> Iterator[PairBlock]:
+        """`scoring.iter_pair_blocks`, storing every block before it's
+        yielded and yielding the stored ones of an earlier attempt first.
+
+        Args:
+            matrix (np.ndarray): the stacked embeddings, see `matrix`.
+            threshold (float, optional): the minimum score. Defaults to 0.6.
+            codes (np.ndarray, optional): label codes, pairs sharing a code
+            are skipped. Defaults to None.
+            block_size (int, optional): rows per block.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            progress (Callable, optional): called with the fraction of pairs
+            scored after every block. Defaults to None.
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: rows, columns and
+            scores of one row block, in row then column order.
+        """
+        n = len(matrix)
+        starts = range(0, n, block_size)
+        done = self.manifest.get("blocks", 0)
+        if done:
+            logger.info(f"Reading {done} of {len(starts)} blocks of checkpoint "
+                        f"{self.key} ({self.progress:.1%} of the pairs)")
+        self.manifest.update(total_blocks=len(starts),
+                             total_pairs=scoring.pairs_in_rows(n, 0, n))
+        for number, start in enumerate(starts):
+            stop = min(start + block_size, n)
+            if number < done:
+                yield self._load_block(number)
+                continue
+            block = scoring.score_row_block(matrix, start, stop, threshold,
+                                            codes, block_size)
+            metrics.PAIRS_EVALUATED.inc(scoring.pairs_in_rows(n, start, stop))
+            self._save_block(number, block)
+            self.manifest.update(blocks=number + 1,
+                                 pairs_done=scoring.pairs_in_rows(n, 0, stop))
+            self.manifest["complete"] = stop == n
+            self._save_manifest()
+            logger.info(f"Checkpoint {self.key}: {self.progress:.1%} of the pairs scored")
+            if progress is not None:
+                progress(self.progress)
+            yield block
+        if not self.complete:
+            # Nothing left to score (no rows, or every block was stored).
+            self.manifest.update(complete=True, blocks=len(starts),
+                                 pairs_done=self.manifest["total_pairs"])
+            self._save_manifest()
+
+    def clear(self):
+        """Remove the run's work directory.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.manifest = {}
+
+    def _block_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"block-{number:06d}.npz")
+
+    def _load_block(self, number: int) -> PairBlock:
+        with np.load(self._block_path(number), allow_pickle=False) as data:
+            return data["rows"], data["cols"], data["scores"]
+
+    def _save_block(self, number: int, block: PairBlock):
+        rows, cols, scores = block
+        _write(self._block_path(number),
+               lambda file: np.savez(file, rows=rows, cols=cols, scores=scores))
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as file:
+                manifest = ujson.load(file)
+        except (OSError, ValueError):
+            return {"key": self.key, "created": time.time()}
+        # Blocks are written before the manifest, a block missing on disk
+        # means the directory was tampered with: start over from there.
+        for number in range(manifest.get("blocks", 0)):
+            if not os.path.exists(self._block_path(number)):
+                manifest.update(blocks=number, pairs_done=0, complete=False)
+                break
+        return manifest
+
+    def _save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest["updated"] = time.time()
+        _write(os.path.join(self.directory, MANIFEST),
+               lambda file: file.write(ujson.dumps(self.manifest).encode("utf-8")))
+
+
+def default_directory() -> str:
+    """The directory of the runs: `CHECKPOINT_DIR` in .env (`./checkpoints`
+    when unset).
+    """
+    return os.getenv("CHECKPOINT_DIR") or "checkpoints"
+
+
+def default_max_age() -> float:
+    """Seconds a run is kept: `CHECKPOINT_MAX_AGE_HOURS` in .env, 24 by default.
+    """
+    return float(os.getenv("CHECKPOINT_MAX_AGE_HOURS") or 24) * 3600
+
+
+def prune(root: str, max_age: float, keep: str = None):
+    """Remove the runs below `root` not updated for `max_age` seconds.
+    """
+    if not os.path.isdir(root):
+        return
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name == keep or not os.path.isdir(path):
+            continue
+        if now - os.path.getmtime(path) > max_age:
+            logger.info(f"Removing stale checkpoint {name}")
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _write(path: str, write: Callable):
+    """Write a file through a temporary file, so it's either whole or missing.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        write(file)
+    os.replace(tmp_path, path)
@@ -0,0 +1,107 @@
+"""Connected components of the thresholded similarity graph.
+
+Inputs are the nodes and every pair at or above the threshold is an edge.
+The pair blocks of the scoring engines are merged into an array-based
+union-find one block at a time and then dropped, so memory stays O(n)
+however many pairs match. The components with at least `min_size` members
+are the clusters, each with the member closest to the cluster's centroid
+as its representative.
+"""
+
+import numpy as np
+from typing import Iterable, List, Sequence
+from modules.scoring import PairBlock
+
+
+class UnionFind():
+    """Disjoint sets over `0..n-1`, every set is represented by its
+    smallest member.
+    """
+
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+
+    def union(self, a: np.ndarray, b: np.ndarray):
+        """Merge the sets of `a[i]` and `b[i]` for every i, all at once.
+
+        Every round links the larger root of each edge below the smaller
+        one and flattens the forest, edges whose ends already share a root
+        drop out.
+        """
+        parent = self.parent
+        a, b = parent[a], parent[b]
+        while len(a):
+            differ = a != b
+            a, b = a[differ], b[differ]
+            if not len(a):
+                break
+            low, high = np.minimum(a, b), np.maximum(a, b)
+            np.minimum.at(parent, high, low)
+            self._flatten()
+            a, b = parent[low], parent[high]
+
+    def _flatten(self):
+        parent = self.parent
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                return
+            parent[:] = grand
+
+    def roots(self) -> np.ndarray:
+        """The representative of every element's set.
+        """
+        self._flatten()
+        return self.parent.copy()
+
+
+def components(n: int, blocks: Iterable[PairBlock]) -> np.ndarray:
+    """The component of every node of the graph the pair blocks describe.
+
+    Args:
+        n (int): the number of nodes.
+        blocks (Iterable[PairBlock]): the edges, e.g. from
+        `scoring.iter_pair_blocks`. Only one block is held at a time.
+
+    Returns:
+        np.ndarray: the smallest node of every node's component.
+    """
+    sets = UnionFind(n)
+    for rows, cols, _ in blocks:
+        sets.union(rows, cols)
+    return sets.roots()
+
+
+def clusters(roots: np.ndarray, matrix: np.ndarray, ids: Sequence[str],
+             texts: Sequence[str], min_size: int = 2) -> List[dict]:
+    """Describe the components with at least `min_size` members.
+
+    Args:
+        roots (np.ndarray): the component of every row, see `components`.
+        matrix (np.ndarray): the embeddings, to pick the representatives.
+        ids (Sequence[str]): the input id of every row.
+        texts (Sequence[str]): the input text of every row.
+        min_size (int, optional): the smallest cluster returned. Defaults to 2.
+
+    Returns:
+        List[dict]: `{"size", "representative": {"id", "text"}, "members":
+        [{"id", "text"}, ...]}` per cluster, largest clusters first and
+        members by descending similarity to the centroid (the representative
+        first).
+    """
+    order = np.argsort(roots, kind="stable")
+    starts = np.flatnonzero(np.r_[True, roots[order][1:] != roots[order][:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    output = []
+    # Largest first, ties in order of their first member.
+    for index in np.argsort(-sizes, kind="stable"):
+        if sizes[index] < min_size:
+            break
+        members = order[starts[index]:starts[index] + sizes[index]]
+        vectors = np.asarray(matrix[members], dtype=np.float64)
+        centroid = vectors.mean(axis=0)
+        members = members[np.argsort(-(vectors @ centroid), kind="stable")].tolist()
+        described = [{"id": ids[member], "text": texts[member]} for member in members]
+        output.append({"size": len(members), "representative": described[0],
+                       "members": described})
+    return output
@@ -0,0 +1,214 @@
+"""Compact, array-backed representation of a bot export.
+
+The export is walked once at load time. Input ids and texts are kept as UTF-8
+blobs with an offset array (`StringTable`), labels are interned into an int32
+code array and the labeled inputs are grouped per label with precomputed index
+ranges, so the compute paths never go back to the nested JSON.
+"""
+
+import hashlib
+import numpy as np
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+# Codes of inputs without a label: `None` is unlabeled, any other falsy label
+# (e.g. "") is neither labeled nor unlabeled, like get_labeled_inputs and
+# get_unlabled_inputs always treated it.
+UNLABELED = -1
+NO_LABEL = -2
+
+
+class StringTable():
+    """Immutable strings stored back to back in one UTF-8 buffer.
+    """
+
+    __slots__ = ("data", "offsets")
+
+    def __init__(self, data: bytes, offsets: np.ndarray):
+        """Wrap an already encoded buffer, see `from_strings`.
+
+        Args:
+            data (bytes): the concatenated UTF-8 strings.
+            offsets (np.ndarray): int64 start offsets plus the end offset.
+        """
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> "StringTable":
+        data = bytearray()
+        offsets = [0]
+        for string in strings:
+            data += string.encode("utf-8")
+            offsets.append(len(data))
+        return cls(bytes(data), np.array(offsets, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.data[start:stop].decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.take(range(len(self))))
+
+    def take(self, indices: Iterable[int]) -> List[str]:
+        """The strings at the given indices.
+        """
+        data, offsets = self.data, self.offsets.tolist()
+        return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in indices]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data) + self.offsets.nbytes
+
+
+class Dataset():
+    """The inputs of a bot export, as parallel arrays.
+    """
+
+    __slots__ = ("ids", "texts", "codes", "labels", "labeled_order",
+                 "label_bounds", "unlabeled_order", "_positions", "_fingerprint")
+
+    def __init__(self, ids: StringTable, texts: StringTable, codes: np.ndarray,
+                 labels: List[str]):
+        """Wrap already built columns, see `from_json` and `from_records`.
+
+        Args:
+            ids (StringTable): the id of every input, in export order.
+            texts (StringTable): the text of every input.
+            codes (np.ndarray): the int32 label code of every input, or
+            UNLABELED / NO_LABEL.
+            labels (List[str]): the label table, in order of first appearance.
+        """
+        self.ids = ids
+        self.texts = texts
+        self.codes = codes
+        self.labels = labels
+        labeled = np.flatnonzero(codes >= 0)
+        # Grouped per label, labels in order of first appearance and inputs
+        # in export order within a label.
+        self.labeled_order = labeled[np.argsort(codes[labeled], kind="stable")]
+        self.label_bounds = np.searchsorted(
+            codes[self.labeled_order], np.arange(len(labels) + 1))
+        self.unlabeled_order = np.flatnonzero(codes == UNLABELED)
+        self._positions = None
+        self._fingerprint = None
+
+    @classmethod
+    def from_records(cls, records: Iterable[Tuple[str, str, str]]) -> "Dataset":
+        """Build the dataset from `(input_id, label, text)` records.
+
+        Only the three fields are retained, so memory scales with the
+        retained data however the records are produced.
+
+        Args:
+            records (Iterable[Tuple[str, str, str]]): the inputs.
+
+        Returns:
+            Dataset: the dataset.
+        """
+        builder = DatasetBuilder()
+        builder.extend(records)
+        return builder.build()
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Dataset":
+        """Build the dataset from a parsed export.
+
+        Args:
+            data (dict): the export, `{"inputs": {id: {"input": text,
+            "classifier": {"label": label}}}}`.
+
+        Returns:
+            Dataset: the dataset.
+        """
+        return cls.from_records(
+            (input_id, value["classifier"]["label"], value["input"])
+            for input_id, value in data["inputs"].items())
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def position(self, input_id: str) -> int:
+        """The index of an input id, the lookup table is built on first use.
+        """
+        if self._positions is None:
+            self._positions = {input_id: i for i, input_id in enumerate(self.ids)}
+        return self._positions[input_id]
+
+    def fingerprint(self) -> str:
+        """A hash of the dataset's content (ids, texts and labels), computed
+        on first use.
+        """
+        if self._fingerprint is None:
+            digest = hashlib.blake2b(digest_size=16)
+            for part in (self.ids.data, self.ids.offsets, self.texts.data,
+                         self.texts.offsets, self.codes):
+                digest.update(memoryview(part).cast("B"))
+            digest.update("\0".join(self.labels).encode("utf-8"))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def label(self, i: int) -> str:
+        """The label of the input at index i (None when unlabeled).
+        """
+        code = self.codes[i]
+        if code >= 0:
+            return self.labels[code]
+        return None if code == UNLABELED else ""
+
+    def label_range(self, code: int) -> Tuple[int, int]:
+        """The slice of `labeled_order` holding the inputs of a label.
+        """
+        return int(self.label_bounds[code]), int(self.label_bounds[code + 1])
+
+    def row_labels(self, order: Sequence[int]) -> List[str]:
+        """The label of every input of `order`, as strings.
+        """
+        labels = self.labels
+        return [labels[code] for code in self.codes[order].tolist()]
+
+
+class DatasetBuilder():
+    """Accumulates records into the compact columns of a Dataset.
+    """
+
+    __slots__ = ("_ids", "_id_offsets", "_texts", "_text_offsets", "_codes",
+                 "_lookup")
+
+    def __init__(self):
+        self._ids, self._texts = bytearray(), bytearray()
+        self._id_offsets, self._text_offsets = [0], [0]
+        self._codes = []
+        self._lookup = {}
+
+    def extend(self, records: Iterable[Tuple[str, str, str]]):
+        """Add `(input_id, label, text)` records.
+
+        Raises:
+            ValueError: when an id, label or text isn't a string (a label may
+            also be None).
+        """
+        lookup = self._lookup
+        for input_id, label, text in records:
+            if not isinstance(input_id, str):
+                raise ValueError(f"Input ids must be strings, got {input_id!r}")
+            if not isinstance(text, str):
+                raise ValueError(f"The input of {input_id!r} must be a string")
+            if label is not None and not isinstance(label, str):
+                raise ValueError(f"The label of {input_id!r} must be a string or null")
+            self._ids += input_id.encode("utf-8")
+            self._id_offsets.append(len(self._ids))
+            self._texts += text.encode("utf-8")
+            self._text_offsets.append(len(self._texts))
+            if label:
+                self._codes.append(lookup.setdefault(label, len(lookup)))
+            else:
+                self._codes.append(UNLABELED if label is None else NO_LABEL)
+
+    def build(self) -> Dataset:
+        return Dataset(
+            StringTable(bytes(self._ids), np.array(self._id_offsets, dtype=np.int64)),
+            StringTable(bytes(self._texts), np.array(self._text_offsets, dtype=np.int64)),
+            np.array(self._codes, dtype=np.int32), list(self._lookup))
@@ -0,0 +1,226 @@
+"""Incremental comparison across dataset revisions.
+
+After a compare run the inputs, their embeddings and the thresholded pairs
+are stored per bot. On the next run only the inputs that were added or edited
+(new text or new label) are embedded and scored against the whole dataset,
+pairs between unchanged inputs are carried over from the previous revision
+and pairs of removed inputs are dropped. For a bot with n inputs and k
+changes that is about k·n pair evaluations instead of n²/2.
+
+The merged pairs are in the same order as a full run would produce them.
+Revisions are kept per encoder, embeddings of another model are never reused.
+Ids, texts and labels are stored as UTF-8 blobs with offsets
+(`dataset.StringTable`), a long text doesn't pad every other row.
+"""
+
+import hashlib
+import logging
+import os
+import numpy as np
+from typing import Callable, List, Sequence
+from modules import metrics, scoring
+from modules.dataset import StringTable
+from modules.scoring import PairBlock
+
+logger = logging.getLogger(__name__)
+
+
+class Revision():
+    """A stored compare run of one bot.
+    """
+
+    def __init__(self, ids: StringTable, texts: StringTable, labels: StringTable,
+                 matrix: np.ndarray, threshold: float, pairs: PairBlock):
+        self.ids = ids
+        self.texts = texts
+        self.labels = labels
+        self.matrix = matrix
+        self.threshold = threshold
+        self.pairs = pairs
+
+
+class RevisionStore():
+    """One `.npz` file per bot, compare mode and encoder in a directory.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, bot_id: str, mode: str, encoder: str = "") -> str:
+        name = hashlib.sha1(f"{bot_id}\0{encoder}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.{mode}.npz")
+
+    def load(self, bot_id: str, mode: str, encoder: str = "") -> Revision:
+        """The previous revision, or None when the bot wasn't seen yet (with
+        this encoder).
+        """
+        path = self.path(bot_id, mode, encoder)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            return Revision(*(_load_strings(data, name)
+                              for name in ("ids", "texts", "labels")),
+                            data["matrix"], float(data["threshold"]),
+                            (data["rows"], data["cols"], data["scores"]))
+
+    def save(self, bot_id: str, mode: str, revision: Revision, encoder: str = ""):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(bot_id, mode, encoder)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        rows, cols, scores = revision.pairs
+        strings = {}
+        for name in ("ids", "texts", "labels"):
+            table = getattr(revision, name)
+            strings[f"{name}_data"] = np.frombuffer(table.data, dtype=np.uint8)
+            strings[f"{name}_offsets"] = table.offsets
+        with open(tmp_path, "wb") as f:
+            np.savez(f, matrix=revision.matrix,
+                     threshold=np.array(revision.threshold),
+                     rows=rows, cols=cols, scores=scores, **strings)
+        os.replace(tmp_path, path)
+
+
+def _load_strings(data, name: str) -> StringTable:
+    if name in data:
+        # Revisions written before the strings were stored as UTF-8.
+        return StringTable.from_strings(data[name].tolist())
+    return StringTable(data[f"{name}_data"].tobytes(), data[f"{name}_offsets"])
+
+
+def default_store() -> RevisionStore:
+    """The store in `REVISION_DIR` from .env (`./revisions` when unset).
+    """
+    return RevisionStore(os.getenv("REVISION_DIR") or "revisions")
+
+
+def compare(store: RevisionStore, bot_id: str, mode: str, ids: Sequence[str],
+            texts: Sequence[str], labels: Sequence[str],
+            embed: Callable[[List[str]], np.ndarray], threshold: float = 0.6,
+            block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+            encoder: str = "") -> PairBlock:
+    """Score a new revision of a bot's dataset, reusing the previous one.
+
+    Args:
+        store (RevisionStore): where revisions are kept.
+        bot_id (str): the bot the dataset belongs to.
+        mode (str): "labeled" or "unlabeled", stored separately.
+        ids (Sequence[str]): the input id of every row.
+        texts (Sequence[str]): the input text of every row.
+        labels (Sequence[str]): the label of every row, pairs sharing a label
+        are skipped. Use "" for every row to skip no pair.
+        embed (Callable): encodes a list of texts, e.g. `Intent.batch_embed`.
+        threshold (float, optional): the minimum score. Defaults to 0.6.
+        block_size (int, optional): rows scored per matrix multiply.
+        Defaults to scoring.DEFAULT_BLOCK_SIZE.
+        encoder (str, optional): the name of the encoder behind `embed`, only
+        a revision of the same encoder is reused. Defaults to "".
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: rows, columns and scores
+        of every pair, ordered by row then column.
+    """
+    ids, texts, labels = list(ids), list(texts), list(labels)
+    previous = store.load(bot_id, mode, encoder)
+    codes = scoring.label_codes(labels)[0] if mode == "labeled" else None
+
+    # Row of every input in the previous revision, -1 for new inputs.
+    old_rows = np.full(len(ids), -1)
+    if previous is not None:
+        position = {input_id: i for i, input_id in enumerate(previous.ids)}
+        old_rows = np.fromiter((position.get(input_id, -1) for input_id in ids),
+                               dtype=np.int64, count=len(ids))
+    known = old_rows >= 0
+    same_text = known.copy()
+    if previous is not None:
+        same_text[known] = _same(previous.texts, old_rows, texts, known)
+
+    matrix = _embed(texts, previous, old_rows, same_text, embed)
+    full = (previous is None or threshold < previous.threshold
+            or previous.matrix.shape[1:] != matrix.shape[1:])
+    if full:
+        logger.info(f"Full comparison of {len(ids)} inputs for bot {bot_id}")
+        pairs = _concat(scoring.iter_pair_blocks(matrix, threshold, codes, block_size))
+    else:
+        unchanged = same_text.copy()
+        unchanged[known] &= _same(previous.labels, old_rows, labels, known)
+        pairs = _merge(previous, old_rows, unchanged, matrix, threshold,
+                       codes, block_size)
+    revision = Revision(StringTable.from_strings(ids),
+                        StringTable.from_strings(texts),
+                        StringTable.from_strings(labels),
+                        matrix, threshold, pairs)
+    store.save(bot_id, mode, revision, encoder)
+    return pairs
+
+
+def _same(previous: StringTable, old_rows: np.ndarray, strings: List[str],
+          known: np.ndarray) -> np.ndarray:
+    """Whether every known string equals its previous revision.
+    """
+    rows = np.flatnonzero(known).tolist()
+    olds = previous.take(old_rows[rows].tolist())
+    return np.fromiter((old == strings[i] for i, old in zip(rows, olds)),
+                       dtype=bool, count=len(rows))
+
+
+def _embed(texts: List[str], previous: Revision, old_rows: np.ndarray,
+           same_text: np.ndarray, embed: Callable) -> np.ndarray:
+    """Reuse the stored embeddings of unchanged texts, encode the rest.
+    """
+    if not same_text.any():
+        return np.asarray(embed(texts), dtype=np.float32)
+    matrix = np.empty((len(texts), previous.matrix.shape[1]), dtype=np.float32)
+    matrix[same_text] = previous.matrix[old_rows[same_text]]
+    if not same_text.all():
+        matrix[~same_text] = embed(
+            [texts[i] for i in np.flatnonzero(~same_text).tolist()])
+    logger.info(f"Reused {int(same_text.sum())} of {len(texts)} embeddings")
+    return matrix
+
+
+def _merge(previous: Revision, old_rows: np.ndarray, unchanged: np.ndarray,
+           matrix: np.ndarray, threshold: float, codes: np.ndarray,
+           block_size: int) -> PairBlock:
+    """Carry over the pairs between unchanged inputs, score the changed ones.
+    """
+    # New row of every previous row that is still present and unchanged.
+    new_rows = np.full(len(previous.ids), -1)
+    new_rows[old_rows[unchanged]] = np.flatnonzero(unchanged)
+    rows, cols, scores = previous.pairs
+    rows, cols = new_rows[rows], new_rows[cols]
+    keep = (rows >= 0) & (cols >= 0) & (scores >= threshold)
+    # Inputs may have moved (e.g. to another label group), keep i < j.
+    rows, cols = rows[keep], cols[keep]
+    kept = (np.minimum(rows, cols), np.maximum(rows, cols), scores[keep])
+
+    changed = np.flatnonzero(~unchanged)
+    logger.info(f"Scoring {len(changed)} changed inputs against {len(matrix)}")
+    scored = []
+    for start in range(0, len(changed), block_size):
+        queries = changed[start:start + block_size]
+        tile = matrix[queries] @ matrix.T
+        metrics.PAIRS_EVALUATED.inc(tile.size)
+        others = np.arange(len(matrix))[None, :]
+        # Changed-changed pairs would otherwise be found from both sides.
+        mask = (tile >= threshold) & (unchanged[None, :] | (queries[:, None] < others))
+        mask &= queries[:, None] != others
+        if codes is not None:
+            mask &= codes[queries][:, None] != codes[None, :]
+        r, c = np.nonzero(mask)
+        first, second = queries[r], c
+        scored.append((np.minimum(first, second), np.maximum(first, second),
+                       tile[r, c]))
+    return _sorted(_concat([kept, *scored]))
+
+
+def _concat(blocks) -> PairBlock:
+    blocks = list(blocks)
+    if not blocks:
+        return scoring.empty_block()
+    return tuple(np.concatenate(column) for column in zip(*blocks))
+
+
+def _sorted(pairs: PairBlock) -> PairBlock:
+    rows, cols, scores = pairs
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order], scores[order]
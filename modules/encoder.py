@@ -0,0 +1,378 @@
+"""Sentence encoder backends.
+
+Every backend implements `Encoder` and returns L2-normalized float32 rows, so
+`np.inner` of two embeddings is their cosine similarity. The backend is
+selected with `ENCODER` in .env:
+
+- "remote" (default): `EmbeddingClient`, the pipelined HTTP client for the
+  remote encoder. The endpoint takes a JSON list of sentences and answers
+  with a `.npy` payload holding one embedding per sentence. The client keeps
+  a pooled keep-alive session, has up to `max_in_flight` batches on the wire
+  at once and retries failed batches with exponential backoff.
+- "onnx": `OnnxEncoder`, a local transformer model run in-process with ONNX
+  Runtime on CPU (needs `onnxruntime` and `tokenizers`).
+- "hashing": `HashingEncoder`, deterministic feature-hashed embeddings for
+  tests and load benchmarks, no model or network involved.
+"""
+
+import asyncio
+import functools
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+import numpy as np
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import List
+from modules import metrics
+
+try:
+    import onnxruntime
+    from tokenizers import Tokenizer
+except ImportError:
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = "https://ai-connect.wearetriple.com/tfusem"
+
+# Status codes worth another attempt, everything else fails the batch at once.
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class EncoderError(Exception):
+    """Raised when a batch still fails after all retries.
+    """
+
+
+def l2_normalize(matrix: np.ndarray) -> np.ndarray:
+    """Scale every row to unit length (all-zero rows are left as they are).
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.maximum(norms, np.finfo(np.float32).tiny, out=norms)
+    return matrix / norms
+
+
+class Encoder():
+    """The interface of an encoder backend.
+    """
+
+    # Identifies the embedding space, e.g. to namespace the embedding cache.
+    name = "encoder"
+
+    def embed(self, sentences: List[str], batch_size: int = None) -> np.ndarray:
+        """Encode the sentences.
+
+        Args:
+            sentences (List[str]): the sentences to encode.
+            batch_size (int, optional): sentences per model call or request.
+
+        Returns:
+            np.ndarray: L2-normalized float32 embeddings, one row per sentence.
+        """
+        raise NotImplementedError
+
+    async def embed_async(self, sentences: List[str], batch_size: int = None) -> np.ndarray:
+        """Like `embed`, but awaitable without blocking the event loop.
+        """
+        return await asyncio.to_thread(self.embed, sentences, batch_size)
+
+    def close(self):
+        pass
+
+
+class EmbeddingClient(Encoder):
+    """Client for the remote encoder endpoint.
+    """
+
+    def __init__(self, url: str = None, api_key: str = None,
+                 batch_size: int = 100, max_in_flight: int = 4,
+                 retries: int = 3, backoff: float = 0.5, timeout: float = 60):
+        """Create the client, no connection is opened until the first batch.
+
+        Args:
+            url (str, optional): the encoder endpoint. Defaults to
+            `ENCODER_URL` in .env, or the tfusem endpoint.
+            api_key (str, optional): the subscription key. Defaults to "KEY"
+            in .env.
+            batch_size (int, optional): sentences per request. Defaults to 100.
+            max_in_flight (int, optional): concurrent requests. Defaults to 4.
+            retries (int, optional): extra attempts per batch. Defaults to 3.
+            backoff (float, optional): seconds before the first retry,
+            doubled on every following one. Defaults to 0.5.
+            timeout (float, optional): seconds per request. Defaults to 60.
+        """
+        self.url = url or os.getenv("ENCODER_URL") or DEFAULT_URL
+        self.api_key = api_key or os.getenv("KEY")
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Ocp-Apim-Subscription-Key"] = self.api_key or ""
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.url
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_in_flight, thread_name_prefix="encoder")
+            return self._executor
+
+    def batches(self, sentences: List[str], batch_size: int = None) -> List[List[str]]:
+        batch_size = batch_size or self.batch_size
+        return [sentences[i:i + batch_size]
+                for i in range(0, len(sentences), batch_size)]
+
+    def embed(self, sentences: List[str], batch_size: int = None) -> np.ndarray:
+        """Encode the sentences, keeping `max_in_flight` batches on the wire.
+
+        Args:
+            sentences (List[str]): the sentences to encode.
+            batch_size (int, optional): overrides the client's batch size.
+
+        Returns:
+            np.ndarray: the stacked embeddings, in the order of `sentences`.
+        """
+        batches = self.batches(list(sentences), batch_size)
+        metrics.ENCODER_BATCHES.inc(len(batches))
+        logger.info(f"Sending {len(batches)} batches to the encoder...")
+        return l2_normalize(np.vstack(list(self.executor.map(self.post, batches))))
+
+    async def embed_async(self, sentences: List[str], batch_size: int = None) -> np.ndarray:
+        """Like `embed`, but awaitable without blocking the event loop.
+
+        Args:
+            sentences (List[str]): the sentences to encode.
+            batch_size (int, optional): overrides the client's batch size.
+
+        Returns:
+            np.ndarray: the stacked embeddings, in the order of `sentences`.
+        """
+        loop = asyncio.get_running_loop()
+        batches = self.batches(list(sentences), batch_size)
+        metrics.ENCODER_BATCHES.inc(len(batches))
+        chunks = await asyncio.gather(*(
+            loop.run_in_executor(self.executor, self.post, batch)
+            for batch in batches))
+        return l2_normalize(np.vstack(chunks))
+
+    def post(self, batch: List[str]) -> np.ndarray:
+        """Encode a single batch, retrying with exponential backoff.
+
+        Args:
+            batch (List[str]): the sentences of the batch.
+
+        Raises:
+            EncoderError: when every attempt failed.
+
+        Returns:
+            np.ndarray: the batch's embeddings.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                start = time.perf_counter()
+                res = self.session.post(self.url, json=batch,
+                                        timeout=self.timeout)
+                metrics.ENCODER_REQUEST_SECONDS.observe(time.perf_counter() - start)
+                if res.status_code not in RETRY_STATUS:
+                    res.raise_for_status()
+                    return np.load(io.BytesIO(res.content), allow_pickle=False)
+                error = f"HTTP {res.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                error = repr(ex)
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"Encoder batch failed ({error}), "
+                               f"retrying in {delay:.1f}s")
+                time.sleep(delay)
+        raise EncoderError(
+            f"Encoder batch failed after {self.retries + 1} attempts: {error}")
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.session.close()
+
+
+class HashingEncoder(Encoder):
+    """Deterministic embeddings from hashed words and character trigrams.
+
+    Each feature is hashed to a dimension and a sign, sentences sharing words
+    therefore get similar embeddings. The whole sentence is a feature too, so
+    distinct sentences never collide exactly.
+    """
+
+    def __init__(self, dimensions: int = 512):
+        """Create the encoder.
+
+        Args:
+            dimensions (int, optional): the embedding size. Defaults to 512.
+        """
+        self.dimensions = dimensions
+        self.name = f"hashing:{dimensions}"
+        self._slot = functools.lru_cache(maxsize=1 << 16)(self._hash)
+
+    def embed(self, sentences: List[str], batch_size: int = None) -> np.ndarray:
+        rows, slots = [], []
+        for i, sentence in enumerate(sentences):
+            for feature in self.features(sentence):
+                rows.append(i)
+                slots.append(self._slot(feature))
+        matrix = np.zeros((len(sentences), self.dimensions), dtype=np.float32)
+        if slots:
+            slots = np.array(slots, dtype=np.int64)
+            np.add.at(matrix, (np.array(rows), np.abs(slots) - 1),
+                      np.sign(slots).astype(np.float32))
+        return l2_normalize(matrix)
+
+    @staticmethod
+    def features(sentence: str) -> List[str]:
+        """The whole sentence, its words and the character trigrams of its words.
+        """
+        words = re.findall(r"\w+", sentence.lower())
+        features = ["s:" + sentence] + ["w:" + word for word in words]
+        for word in words:
+            padded = f" {word} "
+            features += ["c:" + padded[i:i + 3] for i in range(len(padded) - 2)]
+        return features
+
+    def _hash(self, feature: str) -> int:
+        """The feature's dimension plus one, negative for a negative sign.
+        """
+        digest = int.from_bytes(hashlib.blake2b(
+            feature.encode("utf-8"), digest_size=8).digest(), "little")
+        slot = (digest >> 1) % self.dimensions + 1
+        return slot if digest & 1 else -slot
+
+
+class OnnxEncoder(Encoder):
+    """A transformer sentence encoder exported to ONNX, run on the CPU.
+
+    The model directory holds `model.onnx` and a Hugging Face
+    `tokenizer.json`. Models with a pooled 2D output are used as they are,
+    token embeddings (the first output) are mean pooled over the attention
+    mask.
+    """
+
+    def __init__(self, model_dir: str, max_length: int = 128, threads: int = None):
+        """Load the model and tokenizer.
+
+        Args:
+            model_dir (str): the directory with `model.onnx` and `tokenizer.json`.
+            max_length (int, optional): tokens per sentence. Defaults to 128.
+            threads (int, optional): intra-op threads, ONNX Runtime picks
+            when None. Defaults to None.
+        """
+        if onnxruntime is None:
+            raise ImportError("The onnx encoder needs onnxruntime and tokenizers, "
+                              "pip install onnxruntime tokenizers")
+        self.name = f"onnx:{os.path.abspath(model_dir)}"
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"), options,
+            providers=["CPUExecutionProvider"])
+        self.inputs = {model_input.name for model_input in self.session.get_inputs()}
+        # The session is safe to share, tokenizer padding state is not.
+        self._lock = threading.Lock()
+
+    def embed(self, sentences: List[str], batch_size: int = None) -> np.ndarray:
+        batch_size = batch_size or 32
+        chunks = [self._run(sentences[i:i + batch_size])
+                  for i in range(0, len(sentences), batch_size)]
+        if not chunks:
+            return np.empty((0, 0), dtype=np.float32)
+        return l2_normalize(np.vstack(chunks))
+
+    def _run(self, batch: List[str]) -> np.ndarray:
+        with self._lock:
+            encodings = self.tokenizer.encode_batch(batch)
+        feed = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings],
+                                       dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings],
+                                       dtype=np.int64),
+        }
+        output = self.session.run(
+            None, {name: value for name, value in feed.items() if name in self.inputs})[0]
+        if output.ndim == 2:
+            return output
+        mask = feed["attention_mask"][:, :, None].astype(np.float32)
+        return (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+
+
+_clients = {}
+_encoders = {}
+
+
+def default_client(api_key: str = None) -> EmbeddingClient:
+    """The process-wide client for an API key, configured through .env.
+
+    `ENCODER_URL` and `KEY` select the endpoint, `ENCODER_MAX_IN_FLIGHT`
+    the number of concurrent batches.
+
+    Args:
+        api_key (str, optional): the subscription key. Defaults to "KEY".
+
+    Returns:
+        EmbeddingClient: the shared client.
+    """
+    if api_key not in _clients:
+        _clients[api_key] = EmbeddingClient(
+            api_key=api_key,
+            max_in_flight=int(os.getenv("ENCODER_MAX_IN_FLIGHT", 4)))
+    return _clients[api_key]
+
+
+def default_encoder(api_key: str = None) -> Encoder:
+    """The process-wide encoder backend selected with `ENCODER` in .env.
+
+    "remote" (default) uses `default_client`, "onnx" loads the model in
+    `ENCODER_MODEL_DIR` and "hashing" embeds into `ENCODER_DIMENSIONS`
+    dimensions (default 512).
+
+    Args:
+        api_key (str, optional): the remote encoder's subscription key.
+
+    Raises:
+        ValueError: when `ENCODER` names an unknown backend.
+
+    Returns:
+        Encoder: the shared encoder.
+    """
+    kind = os.getenv("ENCODER") or "remote"
+    if kind == "remote":
+        return default_client(api_key)
+    if kind not in _encoders:
+        if kind == "onnx":
+            _encoders[kind] = OnnxEncoder(
+                os.getenv("ENCODER_MODEL_DIR", "model"),
+                threads=int(os.getenv("ENCODER_THREADS", 0)) or None)
+        elif kind == "hashing":
+            _encoders[kind] = HashingEncoder(int(os.getenv("ENCODER_DIMENSIONS", 512)))
+        else:
+            raise ValueError(f"Unknown encoder {kind!r}, use remote, onnx or hashing")
+    return _encoders[kind]
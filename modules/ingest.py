@@ -0,0 +1,267 @@
+"""Streaming ingestion of bot exports.
+
+`InputsParser` is a push parser: it is fed the export chunk by chunk (from a
+file or a request body) and hands back `(input_id, label, text)` records as
+soon as each entry of `inputs` is complete. Only one entry is decoded at a
+time and every other top-level value is skipped without being decoded, so
+peak memory during ingestion scales with the retained fields, not with the
+JSON tree.
+"""
+
+import codecs
+import json
+import re
+from typing import (AsyncIterable, Awaitable, BinaryIO, Callable, Iterator, List,
+                    Tuple, Union)
+from modules import metrics
+from modules.dataset import Dataset, DatasetBuilder
+
+Record = Tuple[str, str, str]
+
+# Bytes read per chunk from files.
+CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Characters the value skipper stops at, outside and inside strings.
+_STRUCTURAL = re.compile(r'["{}\[\],]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+# Parser states
+_START, _TOP_KEY, _TOP_COLON, _SKIP, _INPUTS, _KEY, _COLON, _VALUE, _DONE = range(9)
+
+
+class InputsParser():
+    """Incremental parser for the `inputs` of a bot export.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._state = _START
+        self._first = True
+        self._key = None
+        # State of the value skipper.
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: Union[bytes, str]) -> List[Record]:
+        """Parse the next piece of the export.
+
+        Args:
+            chunk (bytes, str): the next bytes (UTF-8) or characters.
+
+        Raises:
+            ValueError: when the export is malformed.
+
+        Returns:
+            List[Record]: the inputs completed by this chunk.
+        """
+        if isinstance(chunk, bytes):
+            chunk = self._utf8.decode(chunk)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return self._parse(final=False)
+
+    def close(self) -> List[Record]:
+        """Signal the end of the export.
+
+        Raises:
+            ValueError: when the export is malformed or truncated.
+
+        Returns:
+            List[Record]: any remaining inputs.
+        """
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(b"", final=True)
+        self._pos = 0
+        records = self._parse(final=True)
+        if self._state != _DONE:
+            raise ValueError("Unexpected end of the export")
+        return records
+
+    def _parse(self, final: bool) -> List[Record]:
+        records = []
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos == len(self._buffer) and self._state != _SKIP:
+                return records
+            state = self._state
+            if state == _START:
+                self._expect("{")
+                self._state = _TOP_KEY
+            elif state in (_TOP_KEY, _KEY):
+                closing = self._peek() == "}"
+                if closing:
+                    self._pos += 1
+                    self._state = _DONE if state == _TOP_KEY else _TOP_KEY
+                    self._first = state == _TOP_KEY
+                    continue
+                start = self._pos
+                if not self._first:
+                    self._expect(",")
+                    self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+                key = self._decode(final) if self._pos < len(self._buffer) else None
+                if key is None:
+                    if final:
+                        raise ValueError("Malformed or truncated export")
+                    # Read again from the comma once more data arrived.
+                    self._pos = start
+                    return records
+                if not isinstance(key, str):
+                    raise ValueError("Object keys must be strings")
+                self._key = key
+                self._first = False
+                self._state = _TOP_COLON if state == _TOP_KEY else _COLON
+            elif state in (_TOP_COLON, _COLON):
+                self._expect(":")
+                if state == _COLON:
+                    self._state = _VALUE
+                elif self._key == "inputs":
+                    self._state = _INPUTS
+                else:
+                    self._state = _SKIP
+            elif state == _INPUTS:
+                self._expect("{")
+                self._first = True
+                self._state = _KEY
+            elif state == _VALUE:
+                value = self._decode(final)
+                if value is None:
+                    return records
+                records.append((self._key, value["classifier"]["label"],
+                                value["input"]))
+                self._state = _KEY
+            elif state == _SKIP:
+                if not self._skip(final):
+                    return records
+                self._state = _TOP_KEY
+            else:
+                raise ValueError("Unexpected data after the export")
+
+    def _peek(self) -> str:
+        return self._buffer[self._pos]
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r} at {self._peek()!r}")
+        self._pos += 1
+
+    def _decode(self, final: bool):
+        """Decode one complete value, None when it isn't complete yet.
+        """
+        try:
+            value, self._pos = self._decoder.raw_decode(self._buffer, self._pos)
+            return value
+        except json.JSONDecodeError:
+            if final:
+                raise ValueError("Malformed or truncated export")
+            return None
+
+    def _skip(self, final: bool) -> bool:
+        """Skip a top-level value without decoding it.
+
+        Returns:
+            bool: whether the end of the value was reached.
+        """
+        buffer = self._buffer
+        i = self._pos
+        while i < len(buffer):
+            if self._escaped:
+                self._escaped = False
+                i += 1
+                continue
+            pattern = _STRING_SPECIAL if self._in_string else _STRUCTURAL
+            match = pattern.search(buffer, i)
+            if match is None:
+                i = len(buffer)
+                break
+            i = match.start()
+            char = buffer[i]
+            if self._in_string:
+                if char == "\\":
+                    self._escaped = True
+                else:
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+            elif char in "]}":
+                if self._depth == 0:
+                    # The closing brace of the export ends a scalar value.
+                    self._pos = i
+                    return True
+                self._depth -= 1
+            elif self._depth == 0:
+                self._pos = i
+                return True
+            i += 1
+        self._pos = i
+        # A scalar value at the very end is only complete once the export is.
+        return final and self._depth == 0 and not self._in_string
+
+
+def iter_inputs(file: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[Record]:
+    """Read `(input_id, label, text)` records from an export file.
+
+    Args:
+        file (BinaryIO): the export, opened in binary (or text) mode.
+        chunk_size (int, optional): bytes read at a time. Defaults to 64KiB.
+
+    Yields:
+        Record: the inputs, in export order.
+    """
+    parser = InputsParser()
+    while chunk := file.read(chunk_size):
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def load_dataset(file_path: str, chunk_size: int = CHUNK_SIZE) -> Dataset:
+    """Stream an export file into a Dataset.
+    """
+    with metrics.stage("parse"), open(file_path, "rb") as file:
+        return Dataset.from_records(iter_inputs(file, chunk_size))
+
+
+async def read_dataset(chunks: AsyncIterable[bytes],
+                       run: Callable[..., Awaitable] = None) -> Dataset:
+    """Stream an export from an async byte iterator (e.g. a request body).
+
+    Args:
+        chunks (AsyncIterable[bytes]): the export, e.g. `request.stream()`.
+        run (Callable, optional): awaits a blocking call somewhere else, e.g.
+        `admission.run`, every chunk is then parsed there instead of on the
+        event loop. Defaults to None (parsed in place).
+
+    Raises:
+        ValueError: when the export is malformed.
+
+    Returns:
+        Dataset: the dataset.
+    """
+    parser = InputsParser()
+    builder = DatasetBuilder()
+    # Only the parsing counts, not the time spent waiting for the chunks.
+    timer = metrics.StageTimer("parse")
+
+    def feed(chunk: bytes):
+        with timer:
+            builder.extend(parser.feed(chunk))
+
+    def build() -> Dataset:
+        with timer:
+            builder.extend(parser.close())
+            return builder.build()
+
+    try:
+        async for chunk in chunks:
+            if run is None:
+                feed(chunk)
+            else:
+                await run(feed, chunk)
+        return build() if run is None else await run(build)
+    finally:
+        timer.record()
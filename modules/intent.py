@@ -1,16 +1,22 @@
+import argparse
+import asyncio
 import numpy as np
-import requests
-import io
-import os
 import itertools
-import ujson
-import sys
 import logging
-from timeit import default_timer as timer
 from tqdm import tqdm
-from typing import Any, Union
+from typing import Union
 from dotenv import load_dotenv
 from math import factorial
+from modules import (ann, checkpoint, clusters, delta, ingest, memo, metrics,
+                     parallel, quantized, results, scoring)
+from modules.batching import MicroBatcher
+from modules.cache import EmbeddingCache, default_cache, normalize
+from modules.dataset import Dataset
+from modules.delta import RevisionStore
+from modules.encoder import default_encoder
+from modules.memo import ResultCache
+from modules.prescreen import LabelBounds, iter_pair_blocks as iter_prescreened_blocks
+from modules.results import PairTable
 
 # load variables from the .env file and put them into the OS environment
 load_dotenv()
@@ -27,31 +33,71 @@ class Intent():
     """The intent service class
     """
 
-    def __init__(self, file: Union[str, dict] = None):
+    def __init__(self, file: Union[str, dict, Dataset] = None,
+                 cache: EmbeddingCache = None, workers: int = None,
+                 bot_id: str = None, revisions: RevisionStore = None,
+                 result_cache: ResultCache = None, precision: str = None):
         """Automatically uses the load_data method to load up a JSON file.
 
         Args:
-            file (str, dict): the JSON data's file path or the JSON data itself.
+            file (str, dict, Dataset): the JSON data's file path, the JSON data
+            itself or an already loaded Dataset.
             If the given object is a dict it's automatically used as the dataset
-            otherwise (given a str) the file is opened and read.
+            otherwise (given a str) the file is opened and read. Either way it's
+            converted to a compact `Dataset` once, the JSON isn't kept.
+            cache (EmbeddingCache, optional): the embedding cache used by
+            batch_embed. Defaults to the one configured with
+            `EMBEDDING_CACHE_DIR` (no caching when that is unset).
+            workers (int, optional): processes used for the exact pair
+            scoring, see `modules.parallel`. Defaults to `SCORING_WORKERS`
+            (1, scoring in this process).
+            bot_id (str, optional): the bot the dataset belongs to. When given
+            the exact compare paths run incrementally, only inputs added or
+            edited since the bot's previous revision are embedded and scored
+            (see `modules.delta`). Defaults to None.
+            revisions (RevisionStore, optional): where revisions are kept.
+            Defaults to `REVISION_DIR`.
+            result_cache (ResultCache, optional): memoizes the compare results
+            per dataset content, so a stricter threshold on
+            the same dataset is answered without embedding or scoring again.
+            Defaults to the one configured with `RESULT_CACHE_ENTRIES`.
+            Incremental (bot_id) runs aren't memoized.
+            precision (str, optional): "float16" or "int8" scans a quantized
+            copy of the embeddings for candidates and re-scores them in full
+            precision (see `modules.quantized`), "float32" scores every pair
+            in full precision. Defaults to `SCORING_PRECISION`.
         """
-        if file:
+        self.cache = cache if cache is not None else default_cache()
+        self.workers = workers or parallel.default_workers()
+        self.bot_id = bot_id
+        self.revisions = revisions or delta.default_store()
+        self.result_cache = (result_cache if result_cache is not None
+                             else memo.default_cache())
+        self.precision = precision or quantized.default_precision()
+        self.embed_stats = {}
+        self.dataset = None
+        # An empty Dataset is falsy, it's still a dataset.
+        if isinstance(file, Dataset):
+            self.dataset = file
+        elif file:
             if type(file) is str:
-                self.json_data = self._load_data(file)
+                self.dataset = self._load_data(file)
             elif type(file) is dict:
-                self.json_data = file
+                self.dataset = Dataset.from_json(file)
 
-    def _load_data(self, file_path: str) -> dict[str, str]:
-        """Load the JSON data from the specified file with ultrajson.
+    def _load_data(self, file_path: str) -> Dataset:
+        """Stream the JSON data from the specified file into a Dataset.
+
+        The file is parsed entry by entry (see `modules.ingest`), only the
+        id, label and text of every input are kept.
 
         Args:
             file_path (str): the JSON data's file path.
 
         Returns:
-            dict[str, str]: returns a Python dictionary 
+            Dataset: the inputs of the export.
         """
-        with open(file_path, "r") as data:
-            return ujson.load(data)
+        return ingest.load_dataset(file_path)
         
     def get_label(self, input_id: str):
         """Get the label of the ID.
@@ -61,54 +107,114 @@ class Intent():
             input_id (str): the ID.
 
         Returns:
-            _type_: _description_
+            str: the label, None for unlabeled inputs.
         """
-        return self.json_data["inputs"][input_id]["classifier"]["label"]
+        return self.dataset.label(self.dataset.position(input_id))
     
-    def get_input(self, input_id: int):
-        """_summary_
+    def get_input(self, input_id: str):
+        """Get the text of the ID.
 
         Args:
-            input_id (int): _description_
+            input_id (str): the ID.
 
         Returns:
-            _type_: _description_
+            str: the input text.
         """
-        return self.json_data["inputs"][input_id]["input"]
+        return self.dataset.texts[self.dataset.position(input_id)]
         
     def batch_embed(self, sentences: list[str], batch_size: int = 100, api_key = None):
-        """Encode a given array using the Universal Sentence Encoder (Multilingual) model
+        """Encode a given array with the configured encoder backend (by
+        default the remote Universal Sentence Encoder (Multilingual) model,
+        see `modules.encoder`).
+
+        Sentences are deduplicated first, and when a cache is configured
+        (keyed by the normalized text, see `modules.cache.normalize`) only
+        the cache misses are sent to the encoder, as given. The counts of the
+        last call are kept in `self.embed_stats`.
 
         Args:
             sentences (list[str]): the sentences list to encode.
-            batch_size (int, optional): _description_. Defaults to 100.
+            batch_size (int, optional): sentences per encoder request. Defaults to 100.
             api_key (str, optional): tfusem's api key - if nothing is provided it looks uses "KEY" in .env
 
         Returns:
-            list[np.ndarray]: _description_
-        """
-        logger.info(f"Encoding {len(sentences)} sentences...")
-        result = ()
-        # Current code cannot handle generators
-        sentences = list(sentences)
-        api_url = 'https://ai-connect.wearetriple.com/tfusem'
-        api_key = api_key or os.getenv("KEY")
-
-        for i in range(0, len(sentences), batch_size):
-            batch = sentences[i:i + batch_size]
-            # Subscription key for notebooks and testing
-            res = requests.post(
-                api_url, json=batch,
-                headers={'Ocp-Apim-Subscription-Key': os.getenv("KEY")}
-            )
-            mem_file = io.BytesIO(res.content)
-            mem_file.seek(0)
-
-            chunk = np.load(mem_file, allow_pickle=False)
-            result += (chunk,)
+            np.ndarray: the embeddings, one row per given sentence.
+        """
+        with metrics.stage("embed"):
+            plan = self._plan_embed(sentences)
+            misses = plan[-1]
+            encoded = None
+            if misses:
+                with metrics.stage("encode"):
+                    encoded = default_encoder(api_key).embed(misses, batch_size)
+            return self._finish_embed(plan, encoded)
+
+    async def batch_embed_async(self, sentences: list[str], batch_size: int = 100, api_key = None):
+        """Awaitable batch_embed. The encoder requests and the cache lookups
+        and appends (which may compact the cache) run off the event loop.
+
+        Args:
+            sentences (list[str]): the sentences list to encode.
+            batch_size (int, optional): sentences per encoder request. Defaults to 100.
+            api_key (str, optional): tfusem's api key, defaults to "KEY" in .env
+
+        Returns:
+            np.ndarray: the embeddings, one row per given sentence.
+        """
+        with metrics.stage("embed"):
+            plan = await asyncio.to_thread(self._plan_embed, sentences)
+            misses = plan[-1]
+            encoded = None
+            if misses:
+                with metrics.stage("encode"):
+                    encoded = await default_encoder(api_key).embed_async(
+                        misses, batch_size)
+            return await asyncio.to_thread(self._finish_embed, plan, encoded)
+
+    def _plan_embed(self, sentences: list[str]) -> tuple:
+        """Deduplicate the sentences and look them up in the cache.
+
+        Returns:
+            tuple: (sentences, unique, found, cached, misses), see batch_embed.
+        """
+        unique = list(dict.fromkeys(sentences))
+        logger.info(f"Encoding {len(sentences)} sentences ({len(unique)} unique)...")
+        if self.cache is None:
+            found, cached = np.zeros(len(unique), dtype=bool), None
+        else:
+            found, cached = self.cache.get_many(
+                [normalize(sentence) for sentence in unique])
+        misses = [sentence for sentence, hit in zip(unique, found) if not hit]
+        self.embed_stats = {
+            "sentences": len(sentences), "unique": len(unique),
+            "hits": len(unique) - len(misses), "misses": len(misses)}
+        logger.info(f"Embedding cache: {self.embed_stats['hits']} hits, "
+                    f"{self.embed_stats['misses']} misses")
+        metrics.SENTENCES_EMBEDDED.inc(len(sentences))
+        metrics.SENTENCES_ENCODED.inc(len(misses))
+        return sentences, unique, found, cached, misses
+
+    def _finish_embed(self, plan: tuple, encoded: np.ndarray) -> np.ndarray:
+        """Store the freshly encoded misses and assemble the full matrix.
+        """
+        sentences, unique, found, cached, misses = plan
+        if self.cache is not None and encoded is not None:
+            self.cache.put_many([normalize(sentence) for sentence in misses],
+                                encoded)
+        if cached is None:
+            matrix = encoded
+        elif encoded is None:
+            matrix = cached
+        else:
+            matrix = np.empty((len(unique), cached.shape[1]), dtype=np.float32)
+            matrix[found] = cached
+            matrix[~found] = encoded
         logger.info("Done encoding.")
-        return np.vstack(result)    
-    
+        if len(unique) == len(sentences):
+            return matrix
+        position = {sentence: i for i, sentence in enumerate(unique)}
+        return matrix[[position[sentence] for sentence in sentences]]
+
     def calc_combinations(self, n: int, r: int = 2) -> int:
         """Calculate the possible amount of r (default 2) combinations of n
 
@@ -149,25 +255,19 @@ class Intent():
         Returns:
             _type_: _description_
         """
-        # logger.info("get_labeled_inputs() running...")
-        input_data = self.json_data
+        dataset = self.dataset
         all_inputs = {}
-        for input_id in input_data["inputs"]:
-            input_json = input_data["inputs"][input_id]
-            if input_label := input_json["classifier"]["label"]:
-                all_inputs[input_label] = all_inputs.get(input_label, [])
-                all_inputs[input_label].append((input_id, input_json["input"]))
-                #all_inputs[input_label].append(input_json["input"])
+        for code, input_label in enumerate(dataset.labels):
+            start, stop = dataset.label_range(code)
+            order = dataset.labeled_order[start:stop]
+            all_inputs[input_label] = list(zip(
+                dataset.ids.take(order), dataset.texts.take(order)))
         return all_inputs
     
     def get_unlabled_inputs(self):
-        input_data = self.json_data
-        all_inputs = []
-        for input_id in input_data["inputs"]:
-            input_json = input_data["inputs"][input_id]
-            if input_json["classifier"]["label"] is None:
-                all_inputs.append((input_id, input_json["input"]))
-        return all_inputs
+        order = self.dataset.unlabeled_order
+        return list(zip(self.dataset.ids.take(order),
+                        self.dataset.texts.take(order)))
 
     def all_sentences_id(self, data: dict, only_ids: bool = False):
         """_summary_
@@ -221,40 +321,243 @@ class Intent():
                 )
         return permutations
     
-    def compute_labeled_scores_fast(self, threshold: float = 0.6) -> dict:
+    def compute_labeled_scores_fast(self, threshold: float = 0.6,
+                                    block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                                    top_k: int = None, prescreen: bool = False) -> dict:
         """Compute the similarity scores using the loaded dataset.
 
+        The embedding matrix is scored tile by tile (see `modules.scoring`),
+        pairs sharing a label are masked out with an integer label code array.
 
         Args:
             threshold (float, optional): the minimum similarity threshold. 
             Anything higher or equal to this given threshold is added to the 
             output.
             Defaults to 0.6.
+            block_size (int, optional): the tile edge length, bounds the peak
+            memory of the scoring to about block_size² scores.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            top_k (int, optional): keep the top_k most similar inputs of other
+            labels
+            of every input instead of every pair above the threshold, the
+            threshold (None for none) is then their minimum score.
+            Defaults to None.
+            prescreen (bool, optional): skip the label pairs whose centroid
+            and radius bound can't reach the threshold (see
+            `modules.prescreen`), the result stays the same. Every pair is
+            scored when that rules out too few of them. Requires a single
+            worker and float32 precision. Defaults to False.
 
         Returns:
             List[Dict[str, str]]: A list of dictionaries, each dictionary is a
             computed threshold with what it was compared with. Example:
-            `{"label": "id", "label2": "id2", "score": 0.6}`
+            `{"label": "id", "label2": "id2", "score": 0.6}`. With top_k the
+            first key is the input, followed by its neighbours by descending
+            score.
         """
-        data = self.get_labeled_inputs()
-        sentences_id = self.all_sentences_id(data, only_ids=True)
-        matrix = self.batch_embed(self.all_sentences(data))
-        matrix_ids = list(zip(sentences_id, matrix))
-        permutations = self.get_combinations(matrix_ids)
-        output = []
-        logger.info("Calculating similarity matrix (score) for each combination...")
-        for _ in permutations:
-            id1 = _[0][0]
-            id2 = _[1][0]
-            label = self.get_label(id1)
-            label2 = self.get_label(id2)
-            if label == label2:
-                continue
-            score = np.inner(_[0][1], _[1][1])
-            if score < threshold:
-                continue
-            output.append({label: id1, label2: id2, "score": score.item()})
-        return output
+        return [pair for block in self.iter_labeled_scores(
+                    threshold, block_size, top_k, prescreen)
+                for pair in block]
+
+    def iter_labeled_scores(self, threshold: float = 0.6,
+                            block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                            top_k: int = None, prescreen: bool = False):
+        """Generator version of compute_labeled_scores_fast.
+
+        Nothing is embedded or scored until the first block is requested, and
+        only one row block of results is held at a time.
+
+        Args:
+            threshold (float, optional): the minimum similarity threshold.
+            Defaults to 0.6.
+            block_size (int, optional): the tile edge length.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            top_k (int, optional): neighbours per input, see
+            compute_labeled_scores_fast. Defaults to None.
+            prescreen (bool, optional): label pre-screening, see
+            compute_labeled_scores_fast. Defaults to False.
+
+        Yields:
+            List[Dict[str, str]]: the results of one row block, in the format
+            of compute_labeled_scores_fast.
+        """
+        ids, row_labels, _, blocks = self.labeled_blocks(
+            threshold, block_size, top_k, prescreen)
+        yield from self.labeled_results(ids, row_labels, blocks)
+
+    @staticmethod
+    def labeled_results(ids: list, row_labels: list, blocks):
+        """Turn pair blocks of labeled_blocks into result dicts, block by block.
+
+        Yields:
+            List[Dict[str, str]]: the results of one block.
+        """
+        for rows, cols, scores in blocks:
+            yield [{row_labels[i]: ids[i],
+                    row_labels[j]: ids[j],
+                    "score": score} for i, j, score
+                   in zip(rows.tolist(), cols.tolist(), scores.tolist())]
+
+    def labeled_blocks(self, threshold: float = 0.6,
+                       block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                       top_k: int = None, prescreen: bool = False) -> tuple:
+        """Embed the labeled inputs and set up the pair scoring.
+
+        Args:
+            threshold (float, optional): the minimum similarity threshold.
+            Defaults to 0.6.
+            block_size (int, optional): the tile edge length.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            top_k (int, optional): neighbours per input, see
+            compute_labeled_scores_fast. Defaults to None.
+            prescreen (bool, optional): label pre-screening, see
+            compute_labeled_scores_fast. Defaults to False.
+
+        Returns:
+            tuple: `(ids, labels, codes, blocks)`, the input id and label of
+            every matrix row, the label codes and an iterator of
+            `(rows, cols, scores)` arrays indexing into them.
+        """
+        dataset = self.dataset
+        order = dataset.labeled_order
+        ids = dataset.ids.take(order)
+        row_labels = dataset.row_labels(order)
+        codes = dataset.codes[order]
+        threshold = self._check_top_k(threshold, top_k)
+        if prescreen and (top_k is not None or self.bot_id is not None):
+            raise ValueError("prescreen can't be combined with top_k or bot_id")
+        if prescreen and (self.workers > 1 or self.precision != "float32"):
+            raise ValueError("prescreen scores in this process in float32, it "
+                             "can't be combined with workers or precision")
+        if len(ids) < 2:
+            return ids, row_labels, codes, iter(())
+        sentences = dataset.texts.take(order)
+        if self.bot_id is not None:
+            return ids, row_labels, codes, metrics.timed_blocks(self._delta_blocks(
+                "labeled", ids, sentences, row_labels, threshold, block_size))
+        # Pre-screening doesn't change the result, both share the entry.
+        key, cached = self._memoized(threshold, "labeled", top_k)
+        if cached is not None:
+            return ids, row_labels, codes, metrics.timed_blocks(iter((cached,)))
+        matrix = self.batch_embed(sentences)
+        logger.info("Calculating similarity matrix (score) block by block...")
+        bounds = None
+        if prescreen:
+            bounds = LabelBounds.from_matrix(matrix, dataset.label_bounds)
+        if bounds is not None and bounds.worthwhile(threshold):
+            blocks = iter_prescreened_blocks(
+                matrix, threshold, codes, dataset.label_bounds, bounds,
+                block_size=block_size)
+        else:
+            blocks = self._pair_blocks(matrix, threshold, codes, block_size, top_k)
+        if key is not None:
+            blocks = self.result_cache.recording(key, threshold, blocks)
+        return ids, row_labels, codes, metrics.timed_blocks(blocks)
+
+    def _memoized(self, threshold: float, *options) -> tuple:
+        """Look the dataset's result up in the result cache, keyed by the
+        encoder and the scoring precision too.
+
+        Returns:
+            tuple: `(key, pairs)`, the cache key (None without a cache) and
+            the memoized pairs (None when they need to be computed).
+        """
+        if self.result_cache is None:
+            return None, None
+        key = self.result_cache.key(self.dataset.fingerprint(),
+                                    default_encoder().name, self.precision,
+                                    *options)
+        pairs = self.result_cache.get(key, threshold)
+        if pairs is not None:
+            logger.info(f"Reusing the memoized result of {len(pairs[2])} pairs")
+        return key, pairs
+
+    def _check_top_k(self, threshold: float, top_k: int) -> float:
+        """Validate the top_k options, returns the minimum score to apply.
+        """
+        if top_k is None:
+            if threshold is None:
+                raise ValueError("A threshold is required without top_k")
+            return threshold
+        if top_k < 1:
+            raise ValueError("top_k must be a positive integer")
+        if self.bot_id is not None:
+            raise ValueError("Incremental comparison doesn't support top_k")
+        # The result cache slices by minimum score, -inf keeps everything.
+        return -np.inf if threshold is None else threshold
+
+    def _delta_blocks(self, mode: str, ids: list, sentences: list, labels: list,
+                      threshold: float, block_size: int):
+        """Incremental comparison against the bot's previous revision, run
+        lazily like the other block iterators (changed inputs are embedded
+        as part of it).
+        """
+        yield delta.compare(self.revisions, self.bot_id, mode, ids, sentences,
+                            labels, self.batch_embed, threshold, block_size,
+                            default_encoder().name)
+
+    def _pair_blocks(self, matrix: np.ndarray, threshold: float,
+                     codes: np.ndarray = None,
+                     block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                     top_k: int = None):
+        """Exact pair scoring, in a process pool when `self.workers` > 1 or
+        over a quantized matrix with `self.precision`, or the top_k
+        neighbours of every row.
+        """
+        if top_k is not None:
+            return scoring.iter_top_k_blocks(matrix, top_k, threshold, codes,
+                                             block_size)
+        if self.precision != "float32":
+            return quantized.iter_pair_blocks(
+                matrix, quantized.QuantizedMatrix.from_matrix(matrix, self.precision),
+                threshold, codes, block_size)
+        if self.workers > 1:
+            return parallel.iter_pair_blocks(
+                matrix, threshold, codes, self.workers, block_size)
+        return scoring.iter_pair_blocks(matrix, threshold, codes, block_size)
+
+    def compute_labeled_table(self, threshold: float = 0.6,
+                              block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                              top_k: int = None, prescreen: bool = False) -> PairTable:
+        """compute_labeled_scores_fast, as a columnar PairTable.
+
+        Args:
+            threshold (float, optional): the minimum similarity threshold.
+            Defaults to 0.6.
+            block_size (int, optional): the tile edge length.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            top_k (int, optional): neighbours per input, see
+            compute_labeled_scores_fast. Defaults to None.
+            prescreen (bool, optional): label pre-screening, see
+            compute_labeled_scores_fast. Defaults to False.
+
+        Returns:
+            PairTable: the pairs, with the input ids and labels as tables.
+        """
+        ids, row_labels, codes, blocks = self.labeled_blocks(
+            threshold, block_size, top_k, prescreen)
+        return PairTable.from_blocks(blocks, ids, self.dataset.labels, codes)
+
+    def label_overview(self, threshold: float = None) -> dict:
+        """A label by label overview: the similarity of the label centroids
+        and the bound on the scores between two labels, without scoring any
+        pair (see `modules.prescreen`).
+
+        Args:
+            threshold (float, optional): also list the label pairs that can
+            hold a pair at or above this threshold. Defaults to None.
+
+        Returns:
+            dict: see `LabelBounds.overview`.
+        """
+        dataset = self.dataset
+        if len(dataset.labeled_order):
+            matrix = self.batch_embed(dataset.texts.take(dataset.labeled_order))
+        else:
+            # No labeled inputs, so no labels either: an empty overview.
+            matrix = np.empty((0, 0), dtype=np.float32)
+        bounds = LabelBounds.from_matrix(matrix, dataset.label_bounds)
+        return bounds.overview(dataset.labels, threshold)
 
     def compute_labeled_scores(self, threshold: float = 0.6) -> dict:
         """DEPRECATED! Use compute_labeled_scores_fast() 
@@ -300,37 +603,214 @@ class Intent():
                 output.append({label: l[0], label2: l2[0], "score": score.item()})
         return output
                 
-    def compute_unlabeled_scores(self, threshold: float = 0.6):
+    def compute_unlabeled_scores(self, threshold: float = 0.6,
+                                 approximate: bool = False, n_probe: int = 8,
+                                 block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                                 top_k: int = None):
         """Compute the simiality scores for unlabeled inputs.
 
+        By default every pair is scored (tile by tile). With `approximate`
+        an IVF index is built over the embeddings (or loaded, see
+        `modules.ann.load_or_build`) and each input is only scored against
+        its candidate neighbourhood, pairs can then be missed.
+
         Args:
             threshold (float, optional): the threshold for the scores. Defaults to 0.6.
+            approximate (bool, optional): use the IVF index. Defaults to False.
+            n_probe (int, optional): inverted lists searched per list in
+            approximate mode, more means higher recall. Defaults to 8.
+            block_size (int, optional): the tile edge length.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            top_k (int, optional): keep the top_k most similar inputs of every
+            input instead of every pair above the threshold, the threshold
+            (None for none) is then their minimum score. Exact mode only.
+            Defaults to None.
 
         Returns:
-            _type_: _description_
+            List[Tuple[str, str, float]]: `(input1, input2, score)` tuples.
+            With top_k, `input1`'s neighbours by descending score.
         """
-        data = self.get_unlabled_inputs()
-        sentences = []
-        sentence_ids = []
-        for sentence in data:
-            sentence_ids.append(sentence[0])
-            sentences.append(sentence[1])
-        #result = self.batch_embed(sentences)
-        result = np.loadtxt("helpers/test.out")
-        matrix_ids = list(zip(sentence_ids, result))
-        #combinations = list(self.get_combinations(matrix_ids))
-        output = []
-        for s1 in tqdm(range(len(matrix_ids))):
-            for s2 in range(s1 + 1, len(matrix_ids)):
-                score: np.float32 = np.inner(matrix_ids[s1][1], matrix_ids[s2][1])
-                if score < threshold:
-                    continue
-                output.append((
-                    self.get_input(matrix_ids[s1][0]), 
-                    self.get_input(matrix_ids[s2][0]),
-                    score.item()))
-        return output
+        return [pair for block in self.iter_unlabeled_scores(
+                    threshold, approximate, n_probe, block_size, top_k)
+                for pair in block]
+
+    def iter_unlabeled_scores(self, threshold: float = 0.6,
+                              approximate: bool = False, n_probe: int = 8,
+                              block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                              top_k: int = None):
+        """Generator version of compute_unlabeled_scores.
+
+        Args:
+            threshold (float, optional): the threshold for the scores. Defaults to 0.6.
+            approximate (bool, optional): use the IVF index. Defaults to False.
+            n_probe (int, optional): inverted lists searched per list in
+            approximate mode. Defaults to 8.
+            block_size (int, optional): the tile edge length.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            top_k (int, optional): neighbours per input, see
+            compute_unlabeled_scores. Defaults to None.
+
+        Yields:
+            List[Tuple[str, str, float]]: the results of one block (a row
+            block, or an inverted list in approximate mode).
+        """
+        _, sentences, blocks = self.unlabeled_blocks(
+            threshold, approximate, n_probe, block_size, top_k)
+        yield from self.unlabeled_results(sentences, blocks)
+
+    @staticmethod
+    def unlabeled_results(sentences: list, blocks):
+        """Turn pair blocks of unlabeled_blocks into result tuples, block by block.
+
+        Yields:
+            List[Tuple[str, str, float]]: the results of one block.
+        """
+        for rows, cols, scores in blocks:
+            yield [(sentences[i], sentences[j], score) for i, j, score
+                   in zip(rows.tolist(), cols.tolist(), scores.tolist())]
+
+    def unlabeled_blocks(self, threshold: float = 0.6,
+                         approximate: bool = False, n_probe: int = 8,
+                         block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                         top_k: int = None) -> tuple:
+        """Embed the unlabeled inputs and set up the pair scoring.
+
+        Args:
+            threshold (float, optional): the threshold for the scores. Defaults to 0.6.
+            approximate (bool, optional): use the IVF index. Defaults to False.
+            n_probe (int, optional): inverted lists searched per list in
+            approximate mode. Defaults to 8.
+            block_size (int, optional): the tile edge length.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            top_k (int, optional): neighbours per input, see
+            compute_unlabeled_scores. Defaults to None.
+
+        Returns:
+            tuple: `(ids, sentences, blocks)`, the input id and text of every
+            matrix row and an iterator of `(rows, cols, scores)` arrays.
+        """
+        order = self.dataset.unlabeled_order
+        ids = self.dataset.ids.take(order)
+        sentences = self.dataset.texts.take(order)
+        threshold = self._check_top_k(threshold, top_k)
+        if approximate and top_k is not None:
+            raise ValueError("top_k is only supported in exact mode")
+        if len(sentences) < 2:
+            return ids, sentences, iter(())
+        if self.bot_id is not None:
+            if approximate:
+                raise ValueError("Incremental comparison is always exact")
+            return ids, sentences, metrics.timed_blocks(self._delta_blocks(
+                "unlabeled", ids, sentences, [""] * len(ids), threshold, block_size))
+        key, cached = self._memoized(
+            threshold, "unlabeled", approximate, approximate and n_probe, top_k)
+        if cached is not None:
+            return ids, sentences, metrics.timed_blocks(iter((cached,)))
+        matrix = self.batch_embed(sentences)
+        if approximate:
+            index = ann.load_or_build(matrix)
+            blocks = index.iter_pairs(matrix, threshold, n_probe, block_size)
+        else:
+            blocks = self._pair_blocks(matrix, threshold, block_size=block_size,
+                                       top_k=top_k)
+        if key is not None:
+            blocks = self.result_cache.recording(key, threshold, blocks)
+        return ids, sentences, metrics.timed_blocks(blocks)
+
+    def cluster_unlabeled(self, threshold: float = 0.6,
+                          approximate: bool = False, n_probe: int = 8,
+                          block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                          min_size: int = 2) -> list:
+        """Group the unlabeled inputs into the connected components of the
+        graph of pairs scoring at least `threshold` (see `modules.clusters`).
+
+        The pairs are merged block by block and never kept, memory and
+        output grow with the number of inputs instead of matching pairs.
+
+        Args:
+            threshold (float, optional): the threshold for the scores. Defaults to 0.6.
+            approximate (bool, optional): use the IVF index. Defaults to False.
+            n_probe (int, optional): inverted lists searched per list in
+            approximate mode. Defaults to 8.
+            block_size (int, optional): the tile edge length.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            min_size (int, optional): the smallest cluster returned.
+            Defaults to 2.
+
+        Returns:
+            List[dict]: `{"size", "representative": {"id", "text"},
+            "members": [{"id", "text"}, ...]}` per cluster, largest first.
+        """
+        order = self.dataset.unlabeled_order
+        ids = self.dataset.ids.take(order)
+        sentences = self.dataset.texts.take(order)
+        if len(sentences) < max(min_size, 2):
+            return []
+        matrix = self.batch_embed(sentences)
+        # Straight from the engines: the result cache would keep every pair.
+        if approximate:
+            index = ann.load_or_build(matrix)
+            blocks = index.iter_pairs(matrix, threshold, n_probe, block_size)
+        else:
+            blocks = self._pair_blocks(matrix, threshold, block_size=block_size)
+        roots = clusters.components(len(matrix), metrics.timed_blocks(blocks))
+        return clusters.clusters(roots, matrix, ids, sentences, min_size)
+
+    def unlabeled_checkpointed(self, threshold: float = 0.6,
+                               block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                               directory: str = None, progress=None) -> tuple:
+        """unlabeled_blocks, persisting the embeddings and every finished row
+        block to a work directory so a killed run resumes where it stopped
+        (see `modules.checkpoint`). Always exact.
+
+        Args:
+            threshold (float, optional): the threshold for the scores. Defaults to 0.6.
+            block_size (int, optional): rows per stored block.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            directory (str, optional): where the runs are kept. Defaults to
+            `CHECKPOINT_DIR`.
+            progress (Callable, optional): called with the fraction of pairs
+            scored after every block. Defaults to None.
 
+        Returns:
+            tuple: `(ids, sentences, blocks)`, like unlabeled_blocks.
+        """
+        if self.bot_id is not None:
+            raise ValueError("Incremental comparison can't be checkpointed")
+        order = self.dataset.unlabeled_order
+        ids = self.dataset.ids.take(order)
+        sentences = self.dataset.texts.take(order)
+        if len(sentences) < 2:
+            return ids, sentences, iter(())
+        run = checkpoint.Checkpoint.open(
+            directory or checkpoint.default_directory(), self.dataset.fingerprint(),
+            "unlabeled", default_encoder().name, threshold, block_size)
+        matrix = run.matrix(self.batch_embed, sentences)
+        return ids, sentences, metrics.timed_blocks(
+            run.blocks(matrix, threshold, block_size=block_size, progress=progress))
+
+    def compute_unlabeled_table(self, threshold: float = 0.6,
+                                approximate: bool = False, n_probe: int = 8,
+                                block_size: int = scoring.DEFAULT_BLOCK_SIZE,
+                                top_k: int = None) -> PairTable:
+        """compute_unlabeled_scores, as a columnar PairTable of input ids.
+
+        Args:
+            threshold (float, optional): the threshold for the scores. Defaults to 0.6.
+            approximate (bool, optional): use the IVF index. Defaults to False.
+            n_probe (int, optional): inverted lists searched per list in
+            approximate mode. Defaults to 8.
+            block_size (int, optional): the tile edge length.
+            Defaults to scoring.DEFAULT_BLOCK_SIZE.
+            top_k (int, optional): neighbours per input, see
+            compute_unlabeled_scores. Defaults to None.
+
+        Returns:
+            PairTable: the pairs, with the input ids as a table.
+        """
+        ids, _, blocks = self.unlabeled_blocks(
+            threshold, approximate, n_probe, block_size, top_k)
+        return PairTable.from_blocks(blocks, ids)
 
 def similarity(string_1: str, string_2: str, score: float = 0.6) -> dict[str, str]:
     """Computes the similarity matrix. High score indicates greater similarity.
@@ -348,8 +828,75 @@ def similarity(string_1: str, string_2: str, score: float = 0.6) -> dict[str, st
     return {"score": computed_score, "similar": computed_score >= score}
 
 
+async def embed_async(sentences: list[str]) -> np.ndarray:
+    """Intent().batch_embed_async, with the Intent built off the event loop
+    (opening the embedding cache may wait for its lock).
+
+    Args:
+        sentences (list[str]): the sentences list to encode.
+
+    Returns:
+        np.ndarray: the embeddings, one row per given sentence.
+    """
+    intent = await asyncio.to_thread(Intent)
+    return await intent.batch_embed_async(sentences)
+
+
+async def similarity_async(string_1: str, string_2: str, score: float = 0.6,
+                           batcher: MicroBatcher = None) -> dict[str, str]:
+    """Awaitable similarity(), for use inside the API's event loop.
+
+    Args:
+        string_1 (str): the first string.
+        string_2 (str): the second string.
+        score (float, optional): Simiality score to check on. Defaults to 0.6.
+        batcher (MicroBatcher, optional): embed the strings together with
+        other concurrent requests. Defaults to None (embedded on their own).
+
+    Returns:
+        dict: the computed score and whether it's at least `score`.
+    """
+    if batcher is None:
+        matrix = await embed_async([string_1, string_2])
+    else:
+        matrix = await batcher.embed([string_1, string_2])
+    computed_score = np.inner(matrix[0], matrix[1]).item()
+    return {"score": computed_score, "similar": computed_score >= score}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Score the unlabeled inputs of an export.")
+    parser.add_argument("file", help="the export, a JSON file")
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--block-size", type=int, default=scoring.DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="store the progress in CHECKPOINT_DIR and resume "
+                        "an interrupted run")
+    parser.add_argument("--checkpoint-dir", help="overrides CHECKPOINT_DIR")
+    parser.add_argument("--output", help="write the pairs to a .npz, .arrow or "
+                        ".json file instead of printing their count")
+    args = parser.parse_args()
+
+    intent = Intent(args.file)
+    if args.checkpoint or args.checkpoint_dir:
+        ids, sentences, blocks = intent.unlabeled_checkpointed(
+            args.threshold, args.block_size, args.checkpoint_dir)
+    else:
+        ids, sentences, blocks = intent.unlabeled_blocks(
+            args.threshold, block_size=args.block_size)
+    if args.output is None:
+        print(sum(len(scores) for _, _, scores in blocks))
+    elif args.output.endswith(".json"):
+        with open(args.output, "wb") as file:
+            for chunk in results.chunks(Intent.unlabeled_results(sentences, blocks),
+                                        "json-stream"):
+                file.write(chunk)
+    else:
+        format = "arrow" if args.output.endswith(".arrow") else "npz"
+        with open(args.output, "wb") as file:
+            PairTable.from_blocks(blocks, ids).save(file, format)
+
+
 if __name__ == "__main__":
-    intent = Intent(sys.argv[1])
-    #output = intent.get_labeled_inputs()
-    output = intent.compute_unlabeled_scores()
-    print(len(output))
+    main()
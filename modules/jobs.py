@@ -0,0 +1,170 @@
+"""Compare jobs of the job queue worker (see `scripts/worker.py`).
+
+A job is a bot export plus its parameters: `compare` ("labeled" or
+"unlabeled"), `format` (any of `results.FORMATS`, "json" by default) and
+`checkpoint` (false by default, true checkpoints unlabeled runs to
+`CHECKPOINT_DIR`, see `modules.checkpoint`).
+
+`JobRunner` runs the jobs in one process pool. The export is spooled to a
+file that the pool process parses entry by entry, and the result is encoded
+block by block into a spool file while the pairs are scored, neither is ever
+held in memory as a whole. The caller uploads the result from that file.
+Jobs handed to the runner while every process is busy wait in the pool's
+queue with their export already downloaded, so the next job starts as soon
+as a process is free.
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import ujson
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import BinaryIO, Tuple
+from modules import ingest, intent, metrics, results
+from modules.dataset import Dataset
+
+logger = logging.getLogger(__name__)
+
+COMPARES = ("labeled", "unlabeled")
+
+
+def parse_settings(parameters) -> dict:
+    """Validate the parameters of a job.
+
+    Args:
+        parameters: the job's parameters, a JSON string or an already parsed
+        dict.
+
+    Raises:
+        ValueError: for an unknown `compare` or `format`.
+
+    Returns:
+        dict: the parameters.
+    """
+    settings = ujson.loads(parameters) if isinstance(parameters, (str, bytes)) \
+        else dict(parameters)
+    if settings.get("compare") not in COMPARES:
+        raise ValueError(f"compare must be one of {', '.join(COMPARES)}")
+    if settings.get("format", "json") not in results.FORMATS:
+        raise ValueError(f"format must be one of {', '.join(results.FORMATS)}")
+    return settings
+
+
+def run(settings: dict, export_file: str, result_file: str, job_id: str = "") -> dict:
+    """Run one job in this process.
+
+    Args:
+        settings (dict): the job's parameters, see `parse_settings`.
+        export_file (str): the bot export.
+        result_file (str): where the encoded result is written, block by
+        block.
+        job_id (str, optional): used in the log. Defaults to "".
+
+    Returns:
+        dict: the number of `pairs` and the job's `metrics` (stage timings
+        and counters).
+    """
+    labeled = settings["compare"] == "labeled"
+    format = settings.get("format", "json")
+    pairs = 0
+
+    def counted(blocks):
+        nonlocal pairs
+        for block in blocks:
+            pairs += len(block[2])
+            yield block
+
+    # The stage timings and counters of this job go with its result.
+    with metrics.collect() as job_metrics:
+        with metrics.stage("parse"), open(export_file, "rb") as export:
+            intents = intent.Intent(Dataset.from_records(ingest.iter_inputs(export)))
+        if labeled:
+            ids, row_labels, codes, blocks = intents.labeled_blocks()
+        elif settings.get("checkpoint", False):
+            def progress(fraction: float):
+                logger.info(f"Job {job_id}: {fraction:.1%} of the pairs scored")
+            ids, sentences, blocks = intents.unlabeled_checkpointed(progress=progress)
+        else:
+            ids, sentences, blocks = intents.unlabeled_blocks()
+        blocks = counted(blocks)
+        with open(result_file, "wb") as output:
+            if format in results.BINARY_FORMATS:
+                if labeled:
+                    table = results.PairTable.from_blocks(
+                        blocks, ids, intents.dataset.labels, codes)
+                else:
+                    table = results.PairTable.from_blocks(blocks, ids)
+                table.save(output, format)
+            else:
+                if labeled:
+                    items = intents.labeled_results(ids, row_labels, blocks)
+                else:
+                    items = intents.unlabeled_results(sentences, blocks)
+                # "json" is the same document as "json-stream".
+                for chunk in results.chunks(
+                        items, "ndjson" if format == "ndjson" else "json-stream"):
+                    output.write(chunk)
+    logger.info(f"Job {job_id}: {pairs} pairs")
+    return {"pairs": pairs, "metrics": job_metrics}
+
+
+class JobRunner():
+    """Runs jobs in a pool of processes, or in this process without one.
+    """
+
+    def __init__(self, processes: int = 1, directory: str = None):
+        """Create the runner, the pool processes start with the first job.
+
+        Args:
+            processes (int, optional): jobs computed at the same time, 0
+            computes them in the calling thread. Defaults to 1.
+            directory (str, optional): where exports and results are spooled.
+            Defaults to the system's temporary directory.
+        """
+        self.processes = processes
+        self.directory = directory
+        self._pool = None
+        if processes:
+            # Spawned, the workers don't inherit the threads of this process.
+            self._pool = ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def handle(self, settings: dict, export: BinaryIO,
+               job_id: str = "") -> Tuple[dict, BinaryIO]:
+        """Compute one job, blocks until its result is written.
+
+        Args:
+            settings (dict): the job's parameters, see `parse_settings`.
+            export (BinaryIO): the job's export.
+            job_id (str, optional): used in the log. Defaults to "".
+
+        Returns:
+            Tuple[dict, BinaryIO]: the summary of `run` and the result, a
+            file opened for reading that is deleted once it's closed.
+        """
+        export_file = self._spool_file(".json")
+        result_file = self._spool_file(".result")
+        try:
+            with open(export_file, "wb") as file:
+                shutil.copyfileobj(export, file, ingest.CHUNK_SIZE)
+            task = partial(run, settings, export_file, result_file, job_id)
+            summary = task() if self._pool is None else self._pool.submit(task).result()
+            result = open(result_file, "rb")
+        finally:
+            os.remove(export_file)
+            # The open result stays readable until it's closed.
+            os.remove(result_file)
+        return summary, result
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def _spool_file(self, suffix: str) -> str:
+        handle, path = tempfile.mkstemp(suffix=suffix, prefix="job-",
+                                        dir=self.directory)
+        os.close(handle)
+        return path
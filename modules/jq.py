@@ -1,32 +1,396 @@
-"""Everything jobqueue"""
+"""Everything jobqueue
 
-import ujson
+`JobQueueClient` talks to the job queue service at `JOBQUEUE_ENDPOINT`. It
+keeps one pooled keep-alive session for all calls, streams job payloads up
+and results down instead of holding them in memory, and waits for jobs with
+exponential backoff instead of busy polling. Every call has an awaitable
+`*_async` twin. These are thread-backed: the blocking `requests` call runs
+on the client's thread pool (at most `pool_size` at once) while the event
+loop keeps running, only the pauses between polls are native asyncio sleeps.
+
+The module level functions are kept for existing callers, they use a shared
+default client. Importing this module doesn't do any I/O.
+
+Run `python -m modules.jq export.json [compare]` to queue an export, wait for
+it and print the result link.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import sys
+import threading
+import time
 import requests
-import io
+import ujson
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Union
 from xml.dom.minidom import parseString
-from os import getenv
-from collections import namedtuple
-from json import JSONEncoder
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Job statuses after which a job doesn't change anymore (compared lowercase).
+FINAL_STATUSES = ("success", "succeeded", "completed", "done", "failed",
+                  "failure", "error", "cancelled", "canceled")
+
+# Bytes per chunk for uploads and downloads.
+CHUNK_SIZE = 1 << 16
 
-url = getenv("JOBQUEUE_ENDPOINT")
-sub_key = getenv("JOBQUEUE_SUBSCRIPTION_KEY")
 check_id = ""
-auth = getenv("JOBQUEUE_TOKEN")
+
+
+class JobQueueError(Exception):
+    """Raised for failed job queue calls and jobs that don't finish in time.
+    """
+
+
+class JobQueueClient():
+    """Client for the job queue service.
+
+    The `*_async` methods are thread-backed, they run the blocking calls on
+    the client's thread pool, see the module docstring.
+    """
+
+    def __init__(self, endpoint: str = None, subscription_key: str = None,
+                 pool_size: int = 8, timeout: float = 30):
+        """Create the client, no connection is opened until the first call.
+
+        Args:
+            endpoint (str, optional): the service's base URL. Defaults to
+            `JOBQUEUE_ENDPOINT` in .env.
+            subscription_key (str, optional): Defaults to
+            `JOBQUEUE_SUBSCRIPTION_KEY` in .env.
+            pool_size (int, optional): pooled connections, also the number of
+            calls in flight for `wait_many` and the async methods.
+            Defaults to 8.
+            timeout (float, optional): seconds per request. Defaults to 30.
+        """
+        self.endpoint = (endpoint or os.getenv("JOBQUEUE_ENDPOINT") or "").rstrip("/")
+        self.subscription_key = subscription_key or os.getenv("JOBQUEUE_SUBSCRIPTION_KEY")
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def headers(self) -> dict:
+        # Only sent to the service, not to the result download links.
+        return {"Ocp-Apim-Subscription-Key": self.subscription_key or ""}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.pool_size, thread_name_prefix="jobqueue")
+            return self._executor
+
+    def raw(self, job_id: str = None, endpoint: str = "status") -> dict:
+        """The service's answer for a job.
+
+        Args:
+            job_id (str, optional): the job. Defaults to `check_id`.
+            endpoint (str, optional): the endpoint. Defaults to "status".
+
+        Returns:
+            dict: the decoded JSON answer.
+        """
+        response = self.session.get(f"{self.endpoint}/{endpoint}/{job_id or check_id}",
+                                    headers=self.headers, timeout=self.timeout)
+        self._check(response)
+        return response.json()
+
+    def job(self, job_id: str = None) -> dict:
+        """The status record of a job (`status`, `job_id`, `result_params`, ...).
+        """
+        return self.raw(job_id)["values"][0]
+
+    def status(self, job_id: str = None) -> str:
+        return self.job(job_id)["status"]
+
+    def link(self, job_id: str = None, job: dict = None) -> str:
+        """The download link of a job's result.
+
+        Args:
+            job_id (str, optional): the job.
+            job (dict, optional): an already fetched status record (e.g. from
+            `wait`), saves a status request.
+
+        Returns:
+            str: the link.
+        """
+        job = job or self.job(job_id)
+        return job["result_params"]["download_link"]
+
+    def submit(self, data: Union[dict, list, bytes, BinaryIO, Iterable[bytes]],
+               queue: str = "dev", settings: dict = None) -> str:
+        """Queue a new job.
+
+        Args:
+            data: the job's payload. A dict or list is encoded to JSON piece by
+            piece while it's sent, bytes, binary files and byte iterators are
+            sent as they are.
+            queue (str, optional): the queue. Defaults to "dev".
+            settings (dict, optional): the job's parameters, e.g.
+            `{"compare": "labeled"}`.
+
+        Returns:
+            str: the new job's id.
+        """
+        if isinstance(data, (dict, list)):
+            data = iter_json(data)
+        response = self.session.post(f"{self.endpoint}/new/{queue}", params=settings,
+                                     headers=self.headers, data=data,
+                                     timeout=self.timeout)
+        self._check(response)
+        return response.json()["values"][0]["job_id"]
+
+    def wait(self, job_id: str, timeout: float = None, interval: float = 0.5,
+             max_interval: float = 30, factor: float = 2) -> dict:
+        """Poll a job until it's finished, backing off exponentially.
+
+        Args:
+            job_id (str): the job.
+            timeout (float, optional): seconds to wait at most. Defaults to
+            None (no limit).
+            interval (float, optional): seconds before the second poll.
+            Defaults to 0.5.
+            max_interval (float, optional): the longest pause between polls.
+            Defaults to 30.
+            factor (float, optional): the growth of the pause. Defaults to 2.
+
+        Raises:
+            JobQueueError: when the job isn't finished within `timeout`.
+
+        Returns:
+            dict: the job's final status record.
+        """
+        return self.wait_many([job_id], timeout, interval, max_interval, factor)[job_id]
+
+    def wait_many(self, job_ids: List[str], timeout: float = None,
+                  interval: float = 0.5, max_interval: float = 30,
+                  factor: float = 2) -> Dict[str, dict]:
+        """Wait for several jobs at once, see `wait`.
+
+        Every round polls the unfinished jobs concurrently, then sleeps.
+
+        Raises:
+            JobQueueError: when not all jobs finish within `timeout`.
+
+        Returns:
+            Dict[str, dict]: the final status record of every job.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = list(dict.fromkeys(job_ids))
+        finished = {}
+        while True:
+            for job_id, job in zip(pending, self.executor.map(self.job, pending)):
+                if is_final(job["status"]):
+                    finished[job_id] = job
+            pending = [job_id for job_id in pending if job_id not in finished]
+            if not pending:
+                return finished
+            delay = interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise JobQueueError(
+                        f"{len(pending)} jobs not finished after {timeout}s: {pending}")
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            interval = min(interval * factor, max_interval)
+
+    def iter_download(self, job_id: str = None, job: dict = None,
+                      chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Stream a job's result.
+
+        Args:
+            job_id (str, optional): the job.
+            job (dict, optional): an already fetched status record.
+            chunk_size (int, optional): bytes per chunk. Defaults to 64KiB.
+
+        Yields:
+            bytes: the result, chunk by chunk.
+        """
+        with self.session.get(self.link(job_id, job), stream=True,
+                              timeout=self.timeout) as response:
+            self._check(response)
+            yield from response.iter_content(chunk_size)
+
+    def download(self, job_id: str = None, file: Union[str, BinaryIO] = None,
+                 job: dict = None, chunk_size: int = CHUNK_SIZE) -> int:
+        """Stream a job's result into a file.
+
+        Args:
+            job_id (str, optional): the job.
+            file (str, BinaryIO): a path or a binary file object.
+            job (dict, optional): an already fetched status record.
+            chunk_size (int, optional): bytes per chunk. Defaults to 64KiB.
+
+        Returns:
+            int: the number of bytes written.
+        """
+        if isinstance(file, str):
+            with open(file, "wb") as output:
+                return self.download(job_id, output, job, chunk_size)
+        written = 0
+        for chunk in self.iter_download(job_id, job, chunk_size):
+            file.write(chunk)
+            written += len(chunk)
+        return written
+
+    async def submit_async(self, data, queue: str = "dev", settings: dict = None) -> str:
+        """Thread-backed `submit`: the blocking `requests` call runs on the
+        client's thread pool, it isn't a native async HTTP call.
+        """
+        return await self._run(self.submit, data, queue, settings)
+
+    async def status_async(self, job_id: str = None) -> str:
+        """Thread-backed `status`: the blocking `requests` call runs on the
+        client's thread pool, it isn't a native async HTTP call.
+        """
+        return await self._run(self.status, job_id)
+
+    async def download_async(self, job_id: str = None, file: Union[str, BinaryIO] = None,
+                             job: dict = None) -> int:
+        """Thread-backed `download`: the blocking `requests` call runs on the
+        client's thread pool, it isn't a native async HTTP call. The file is
+        written from that thread too.
+        """
+        return await self._run(self.download, job_id, file, job)
+
+    async def wait_async(self, job_id: str, timeout: float = None,
+                         interval: float = 0.5, max_interval: float = 30,
+                         factor: float = 2) -> dict:
+        """Thread-backed `wait`: each poll is a blocking `requests` call on
+        the client's thread pool, only the pauses between them are asyncio
+        sleeps.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = await self._run(self.job, job_id)
+            if is_final(job["status"]):
+                return job
+            delay = interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise JobQueueError(f"Job {job_id} not finished after {timeout}s")
+                delay = min(delay, remaining)
+            await asyncio.sleep(delay)
+            interval = min(interval * factor, max_interval)
+
+    async def wait_many_async(self, job_ids: List[str], timeout: float = None,
+                              **kwargs) -> Dict[str, dict]:
+        """Thread-backed `wait_many`: the jobs are polled concurrently as in
+        `wait_async`, each poll on the client's thread pool.
+        """
+        job_ids = list(dict.fromkeys(job_ids))
+        jobs = await asyncio.gather(*(self.wait_async(job_id, timeout, **kwargs)
+                                      for job_id in job_ids))
+        return dict(zip(job_ids, jobs))
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _check(self, response: requests.Response):
+        if not response.ok:
+            raise JobQueueError(
+                f"{response.request.method} {response.url} failed: "
+                f"HTTP {response.status_code} {response.text[:200]}")
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def is_final(status: str) -> bool:
+    return str(status).lower() in FINAL_STATUSES
+
+
+def iter_json(value, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Encode a dict or list to JSON piece by piece.
+
+    The document and the containers directly in it (e.g. an export's
+    `inputs`) are walked, only their items (e.g. single inputs) are encoded
+    at once, so no full copy of the document is built.
+
+    Args:
+        value: the dict or list.
+        chunk_size (int, optional): approximate bytes per chunk.
+
+    Yields:
+        bytes: the JSON document, chunk by chunk.
+    """
+    buffer = []
+    size = 0
+    for piece in _json_pieces(value):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def _json_pieces(value, depth: int = 0) -> Iterator[str]:
+    if depth < 2 and isinstance(value, dict):
+        yield "{"
+        separator = ""
+        for key, item in value.items():
+            yield f"{separator}{ujson.dumps(str(key))}:"
+            yield from _json_pieces(item, depth + 1)
+            separator = ","
+        yield "}"
+    elif depth < 2 and isinstance(value, list):
+        yield "["
+        separator = ""
+        for item in value:
+            yield separator
+            yield from _json_pieces(item, depth + 1)
+            separator = ","
+        yield "]"
+    else:
+        yield ujson.dumps(value)
+
+
+_client = None
+
+
+def default_client() -> JobQueueClient:
+    """The shared client configured through .env.
+    """
+    global _client
+    if _client is None:
+        _client = JobQueueClient()
+    return _client
 
 
 def raw(job_id: str = None, endpoint="status"):
-    headers = {'Ocp-Apim-Subscription-Key': sub_key}
-    raw_url = f"{url}/{endpoint}/{job_id or check_id}"
-    response = requests.get(raw_url, headers=headers, data={})
-    return response.json()
+    return default_client().raw(job_id, endpoint)
 
 
 def status(job_id: str = None):
-    return raw(job_id)["values"][0]["status"]
+    return default_client().status(job_id)
 
 
 def get_id():
@@ -34,17 +398,13 @@ def get_id():
 
 
 def download(job_id: str = None):
-    headers = {'Ocp-Apim-Subscription-Key': sub_key,
-               "Authorization": auth}
-    download_link = link(job_id)
-    r = requests.get(download_link, allow_redirects=True)
-    # with open("download.txt", "wb") as f:
-    #     f.write(r.content)
-    print(r.content)
-    return r.content
+    """The whole result of a job, prefer `JobQueueClient.download` to stream it.
+    """
+    return b"".join(default_client().iter_download(job_id))
+
 
 def valid(content: str) -> bool:
-    """Checks if the content is valid. 
+    """Checks if the content is valid.
     If it's not valid, it means that the file content has XML in it.
     Which is not good. Means something went wrong.
 
@@ -63,31 +423,30 @@ def valid(content: str) -> bool:
         return True
 
 
-def link(job_id: str = None): 
-    return raw(job_id)["values"][0]["result_params"]["download_link"]
+def link(job_id: str = None):
+    return default_client().link(job_id)
 
 
 def queue(queue="dev", data = None, settings = None):
     """Start a queue.
 
     Args:
-        queue (str, optional): _description_. Defaults to "dev".
+        queue (str, optional): the queue. Defaults to "dev".
+        data (optional): the job's payload, see `JobQueueClient.submit`.
+        settings (dict, optional): the job's parameters.
 
     Returns:
-        _type_: _description_
+        str: the new job's id.
     """
-    headers = {'Ocp-Apim-Subscription-Key': sub_key}
-    raw_url = f"{url}/new/{queue}"
-    data = io.BytesIO(ujson.dumps(data).encode())
-    response = requests.post(raw_url, params=settings, headers=headers, data=data)
-    return response.json()["values"][0]["job_id"]
-
-with open("../pocbot.json", "r") as f:
-    output = ujson.load(f)
-    new_id = queue(data=output, settings={"compare": "unlabeled"})
-    print(new_id)
-    print(raw(new_id))
-#print(link(new_id))
-#content = download(new_id)
-#print(valid(content))
+    return default_client().submit(data, queue, settings)
+
 
+if __name__ == "__main__":
+    with open(sys.argv[1] if len(sys.argv) > 1 else "../pocbot.json", "rb") as f:
+        with JobQueueClient() as client:
+            new_id = client.submit(f, os.getenv("JOBQUEUE_NAME", "dev"),
+                                   {"compare": sys.argv[2] if len(sys.argv) > 2
+                                    else "unlabeled"})
+            print(new_id)
+            job = client.wait(new_id)
+            print(job["status"], client.link(job=job))
@@ -0,0 +1,176 @@
+"""Threshold-aware memoization of compare results.
+
+Repeated compare requests on the same dataset (e.g. a threshold slider in the
+UI) reuse the pairs scored by an earlier request. An entry holds the pairs of
+one dataset and compare mode at the lowest threshold requested so far, with
+a permutation ordering them by score: a stricter threshold is a binary-search
+slice of that permutation, only a looser one is computed again (and replaces
+the entry).
+
+Entries are keyed by a content hash of the dataset (see
+`Dataset.fingerprint`), the encoder and the compare options, and are evicted
+least recently used first, after `ttl` seconds, or when the cache holds more
+than `max_bytes` of pairs.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Iterable, Iterator
+from modules import scoring
+from modules.scoring import PairBlock
+
+logger = logging.getLogger(__name__)
+
+
+class Entry():
+    """The pairs of one dataset at or above `threshold`, in emission order.
+    """
+
+    __slots__ = ("threshold", "rows", "cols", "scores", "by_score", "descending",
+                 "created")
+
+    def __init__(self, threshold: float, pairs: PairBlock):
+        self.threshold = threshold
+        self.rows, self.cols, self.scores = pairs
+        # Pair indices by descending score, stable so ties keep their order.
+        self.by_score = np.argsort(-self.scores, kind="stable")
+        # The negated scores in that order, ascending for searchsorted.
+        self.descending = -self.scores[self.by_score]
+        self.created = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        return (self.rows.nbytes + self.cols.nbytes + self.scores.nbytes
+                + self.by_score.nbytes + self.descending.nbytes)
+
+    def slice(self, threshold: float) -> PairBlock:
+        """The pairs at or above a threshold no lower than the entry's, in
+        the order they were emitted.
+        """
+        # Compared in the scores' precision, like the scoring itself does.
+        bound = -np.asarray(threshold, dtype=self.scores.dtype)
+        count = np.searchsorted(self.descending, bound, side="right")
+        keep = np.sort(self.by_score[:count])
+        return self.rows[keep], self.cols[keep], self.scores[keep]
+
+
+class ResultCache():
+    """An in-process LRU cache of compare results.
+    """
+
+    def __init__(self, max_entries: int = 16, ttl: float = 900,
+                 max_bytes: int = 256 << 20):
+        """Create the cache.
+
+        Args:
+            max_entries (int, optional): results kept. Defaults to 16.
+            ttl (float, optional): seconds a result stays valid. Defaults to 900.
+            max_bytes (int, optional): the total size of the kept pairs.
+            Defaults to 256MiB.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts) -> str:
+        """A key from the dataset fingerprint, the encoder and the options.
+        """
+        return hashlib.blake2b("\0".join(map(str, parts)).encode("utf-8"),
+                               digest_size=16).hexdigest()
+
+    def get(self, key: str, threshold: float) -> PairBlock:
+        """The memoized pairs at or above the threshold.
+
+        Returns:
+            PairBlock: the pairs, or None when they need to be computed.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.created > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None or threshold < entry.threshold:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return entry.slice(threshold)
+
+    def put(self, key: str, threshold: float, pairs: PairBlock):
+        """Keep the pairs of a finished computation at `threshold`.
+        """
+        entry = Entry(threshold, pairs)
+        if entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current.threshold < threshold:
+                # Another request already stored a looser result.
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            total = sum(entry.nbytes for entry in self._entries.values())
+            while (len(self._entries) > self.max_entries
+                   or total > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                total -= evicted.nbytes
+
+    def recording(self, key: str, threshold: float,
+                  blocks: Iterable[PairBlock]) -> Iterator[PairBlock]:
+        """Pass blocks through and memoize them once all have been produced.
+
+        Nothing is stored when the consumer stops early.
+        """
+        seen = []
+        for block in blocks:
+            seen.append(block)
+            yield block
+        if seen:
+            pairs = tuple(np.concatenate(column) for column in zip(*seen))
+        else:
+            pairs = scoring.empty_block()
+        self.put(key, threshold, pairs)
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits,
+                    "misses": self.misses,
+                    "bytes": sum(entry.nbytes for entry in self._entries.values())}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_default_cache = None
+
+
+def default_cache() -> ResultCache:
+    """The process-wide result cache configured through .env.
+
+    `RESULT_CACHE_ENTRIES` (0 disables it), `RESULT_CACHE_TTL` in seconds and
+    `RESULT_CACHE_MAX_MB`.
+
+    Returns:
+        ResultCache: the cache, or None when it's disabled.
+    """
+    global _default_cache
+    max_entries = int(os.getenv("RESULT_CACHE_ENTRIES", 16))
+    if max_entries <= 0:
+        return None
+    if _default_cache is None:
+        _default_cache = ResultCache(
+            max_entries, ttl=float(os.getenv("RESULT_CACHE_TTL", 900)),
+            max_bytes=int(os.getenv("RESULT_CACHE_MAX_MB", 256)) << 20)
+    return _default_cache
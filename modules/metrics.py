@@ -0,0 +1,249 @@
+"""Stage timings and counters of the compute paths.
+
+The compute paths report how long each stage took (`parse`, `embed`, `encode`,
+`score`, `serialize`) and count the sentences embedded, encoder batches sent,
+pairs evaluated and emitted and result bytes produced. The API exposes the
+process totals in the Prometheus text format on `/metrics`. The job worker
+wraps every job in `collect()` to attach the job's own numbers to its result.
+
+Set `METRICS_ENABLED=0` to turn the hooks off, they then return before doing
+any work.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import os
+import threading
+import time
+from typing import Iterable, Iterator, Tuple
+
+# Upper bounds (seconds) of the stage histogram buckets.
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                 10, 30, 60, 120, 300)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_enabled = None
+_registry = []
+# The numbers of the job being handled in this context, see `collect`.
+_job = contextvars.ContextVar("metrics_job", default=None)
+_null = contextlib.nullcontext()
+
+
+def enabled() -> bool:
+    """Whether metrics are recorded, read from `METRICS_ENABLED` on first use.
+    """
+    global _enabled
+    if _enabled is None:
+        _enabled = os.getenv("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+    return _enabled
+
+
+def set_enabled(flag: bool):
+    global _enabled
+    _enabled = flag
+
+
+class Counter():
+    """A monotonically increasing count.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        if not enabled():
+            return
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        job = _job.get()
+        if job is not None:
+            job["counters"][self.name] = job["counters"].get(self.name, 0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Histogram():
+    """Observations counted into cumulative buckets, plus their sum.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: the count of every bucket (+Inf last) and the sum.
+        self._counts = {}
+        self._sums = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        if not enabled():
+            return
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        with self._lock:
+            counts = {key: list(value) for key, value in self._counts.items()}
+            sums = dict(self._sums)
+        for key, bucket_counts in counts.items():
+            labels = dict(zip(self.labels, key))
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), bucket_counts):
+                total += count
+                yield f"{self.name}_bucket", dict(labels, le=str(bound)), total
+            yield f"{self.name}_sum", labels, sums[key]
+            yield f"{self.name}_count", labels, total
+
+
+STAGE_SECONDS = Histogram(
+    "intent_stage_seconds", "Seconds spent per compute stage.", ("stage",))
+ENCODER_REQUEST_SECONDS = Histogram(
+    "intent_encoder_request_seconds", "Round trip seconds per remote encoder batch.")
+SENTENCES_EMBEDDED = Counter(
+    "intent_sentences_embedded_total", "Sentences passed to batch_embed.")
+SENTENCES_ENCODED = Counter(
+    "intent_sentences_encoded_total", "Sentences sent to the encoder (cache misses).")
+ENCODER_BATCHES = Counter(
+    "intent_encoder_batches_total", "Batches sent to the remote encoder.")
+PAIRS_EVALUATED = Counter(
+    "intent_pairs_evaluated_total", "Pair scores computed.")
+PAIRS_EMITTED = Counter(
+    "intent_pairs_emitted_total", "Pairs at or above the threshold.")
+RESPONSE_BYTES = Counter(
+    "intent_response_bytes_total", "Bytes of serialized results.", ("format",))
+
+
+def record_stage(stage: str, seconds: float):
+    """Record the duration of one stage run.
+    """
+    if not enabled():
+        return
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    job = _job.get()
+    if job is not None:
+        job["stages"][stage] = job["stages"].get(stage, 0) + seconds
+
+
+@contextlib.contextmanager
+def _timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def stage(name: str):
+    """A context manager timing the stage `name`.
+    """
+    if not enabled():
+        return _null
+    return _timed(name)
+
+
+class StageTimer():
+    """Adds up the time spent in several `with` blocks of one stage run, for
+    stages interleaved with other work (e.g. parsing a body while it arrives).
+    Call `record` once the run is over.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.seconds = 0.0
+        self._start = None
+        self._recorded = False
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self._start
+
+    def record(self):
+        if not self._recorded:
+            self._recorded = True
+            record_stage(self.stage, self.seconds)
+
+
+def timed_blocks(blocks: Iterable, stage: str = "score") -> Iterator:
+    """Pass pair blocks through, timing their production and counting pairs.
+
+    Only the time spent producing the blocks counts, not the time the
+    consumer spends between them.
+    """
+    if not enabled():
+        yield from blocks
+        return
+    timer = StageTimer(stage)
+    iterator = iter(blocks)
+    try:
+        while True:
+            with timer:
+                block = next(iterator, None)
+            if block is None:
+                return
+            PAIRS_EMITTED.inc(len(block[2]))
+            yield block
+    finally:
+        timer.record()
+
+
+@contextlib.contextmanager
+def collect():
+    """Also collect the stage timings and counters recorded in this context.
+
+    Yields:
+        dict: `{"stages": {stage: seconds}, "counters": {name: value}}`,
+        filled in while the block runs.
+    """
+    job = {"stages": {}, "counters": {}}
+    token = _job.set(job)
+    try:
+        yield job
+    finally:
+        _job.reset(token)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if labels:
+                pairs = ",".join(f'{key}="{_escape(value)}"'
+                                 for key, value in labels.items())
+                name = f"{name}{{{pairs}}}"
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,192 @@
+"""Multi-core pair scoring over a shared-memory embedding matrix.
+
+The matrix is copied into `multiprocessing.shared_memory` once, every worker
+process of the pool maps it instead of receiving its own pickled copy. The
+upper-triangular pair space is split into row-block shards holding about the
+same number of pairs (early rows pair with more columns than late ones), the
+shards are scored with `scoring.score_row_block` in the pool and merged back
+in row order, so the output matches the single-process engine.
+
+The pool is started once per worker count and reused by every call, each
+task names the shared-memory segment it scores. The workers limit their BLAS
+to one thread each so the processes don't oversubscribe the cores.
+"""
+
+import ctypes
+import logging
+import multiprocessing
+import os
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterator, List, Tuple
+from modules import metrics, scoring
+from modules.scoring import PairBlock
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+logger = logging.getLogger(__name__)
+
+# Shards per worker, more shards even out the load and make results arrive
+# (and stream) sooner at the cost of a little scheduling overhead.
+SHARDS_PER_WORKER = 4
+
+# Thread pools of the usual BLAS builds, set in the workers for libraries
+# loaded after they start.
+_BLAS_THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                          "MKL_NUM_THREADS")
+
+# Thread count setters of OpenBLAS builds (numpy's wheels bundle the
+# scipy_openblas one), used when threadpoolctl isn't installed.
+_OPENBLAS_SETTERS = ("openblas_set_num_threads", "openblas_set_num_threads64_",
+                     "scipy_openblas_set_num_threads64_",
+                     "scipy_openblas_set_num_threads")
+
+# One pool per worker count, started on first use.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def default_workers() -> int:
+    """Worker processes used when none are given: `SCORING_WORKERS` in .env.
+    """
+    return int(os.getenv("SCORING_WORKERS", 1))
+
+
+def balanced_shards(n: int, n_shards: int) -> List[Tuple[int, int]]:
+    """Split rows `0:n` into ranges with about the same number of pairs.
+
+    Row `i` is paired with the `n - 1 - i` rows after it.
+
+    Args:
+        n (int): the number of rows.
+        n_shards (int): the number of ranges wanted.
+
+    Returns:
+        List[Tuple[int, int]]: non-empty `(start, stop)` row ranges.
+    """
+    pairs_before = np.concatenate(([0], np.cumsum(np.arange(n - 1, -1, -1))))
+    targets = np.linspace(0, pairs_before[-1], n_shards + 1)
+    bounds = np.unique(np.concatenate((
+        [0], np.searchsorted(pairs_before, targets[1:-1]), [n])))
+    return [(int(start), int(stop))
+            for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def iter_pair_blocks(matrix: np.ndarray, threshold: float = 0.6,
+                     codes: np.ndarray = None, workers: int = None,
+                     block_size: int = scoring.DEFAULT_BLOCK_SIZE) -> Iterator[PairBlock]:
+    """Parallel `scoring.iter_pair_blocks`.
+
+    Args:
+        matrix (np.ndarray): the stacked embeddings.
+        threshold (float, optional): the minimum score. Defaults to 0.6.
+        codes (np.ndarray, optional): label codes, pairs sharing a code are
+        skipped. Defaults to None.
+        workers (int, optional): worker processes. Defaults to
+        `SCORING_WORKERS`.
+        block_size (int, optional): the tile edge length.
+        Defaults to scoring.DEFAULT_BLOCK_SIZE.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: rows, columns and scores
+        of one shard, shards in row order.
+    """
+    workers = workers or default_workers()
+    matrix = np.ascontiguousarray(matrix)
+    shards = balanced_shards(len(matrix), workers * SHARDS_PER_WORKER)
+    logger.info(f"Scoring {len(shards)} shards on {workers} processes...")
+    # The label codes are stored after the matrix, in the same segment.
+    codes = None if codes is None else np.ascontiguousarray(codes, dtype=np.int32)
+    size = matrix.nbytes + (0 if codes is None else codes.nbytes)
+    shm = SharedMemory(create=True, size=max(size, 1))
+    futures = []
+    try:
+        np.ndarray(matrix.shape, matrix.dtype, buffer=shm.buf)[:] = matrix
+        if codes is not None:
+            shm.buf[matrix.nbytes:size] = codes.tobytes()
+        segment = (shm.name, matrix.shape, matrix.dtype.str, codes is not None)
+        pool = _pool(workers)
+        futures = [pool.submit(_score_shard, segment, start, stop, threshold,
+                               block_size) for start, stop in shards]
+        for (start, stop), future in zip(shards, futures):
+            block = future.result()
+            metrics.PAIRS_EVALUATED.inc(
+                scoring.pairs_in_rows(len(matrix), start, stop))
+            yield block
+    except BrokenProcessPool:
+        # A worker died, the next call starts a new pool.
+        with _pools_lock:
+            _pools.pop(workers, None)
+        raise
+    finally:
+        # Shards of an abandoned iteration aren't scored any more, the
+        # running ones finish before their segment goes away.
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        shm.close()
+        shm.unlink()
+
+
+def _pool(workers: int) -> ProcessPoolExecutor:
+    """The shared pool of `workers` processes, started on first use.
+    """
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_limit_blas_threads, initargs=(1,))
+        return _pools[workers]
+
+
+def _limit_blas_threads(threads: int):
+    """Limit the BLAS of a worker process to `threads` threads.
+
+    numpy (and its BLAS) is already loaded when a spawned worker runs its
+    initializer, so the limit is set through the loaded library.
+    """
+    os.environ.update({name: str(threads) for name in _BLAS_THREAD_VARIABLES})
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(threads)
+        return
+    try:
+        with open("/proc/self/maps") as maps:
+            paths = {line.split()[-1] for line in maps if "openblas" in line}
+    except OSError:
+        return
+    for path in paths:
+        try:
+            library = ctypes.CDLL(path)
+        except OSError:
+            continue
+        for name in _OPENBLAS_SETTERS:
+            setter = getattr(library, name, None)
+            if setter is not None:
+                setter(threads)
+                break
+
+
+def _score_shard(segment: tuple, start: int, stop: int, threshold: float,
+                 block_size: int) -> PairBlock:
+    name, shape, dtype, has_codes = segment
+    shm = SharedMemory(name=name)
+    try:
+        matrix = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+        codes = (np.ndarray(shape[0], np.int32, buffer=shm.buf,
+                            offset=matrix.nbytes) if has_codes else None)
+        blocks = [scoring.score_row_block(matrix, block_start,
+                                          min(block_start + block_size, stop),
+                                          threshold, codes, block_size)
+                  for block_start in range(start, stop, block_size)]
+        # Copies, nothing returned points into the segment.
+        return tuple(np.concatenate(column) for column in zip(*blocks))
+    finally:
+        # The views have to go before the segment can be closed.
+        matrix = codes = None
+        shm.close()
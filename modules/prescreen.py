@@ -0,0 +1,254 @@
+"""Label-level pre-screening of the labeled pair scoring.
+
+Every label is summarised by the direction of its centroid and its angular
+radius, the largest angle between one of its (unit length) embeddings and
+that direction. Two inputs of labels A and B are then at least
+`angle(A, B) - radius(A) - radius(B)` apart, so the cosine of that angle
+bounds every score between the two labels. Label pairs whose bound stays
+below the threshold can't hold a single pair above it and aren't scored at
+all, the others are scored exactly as `modules.scoring` does: the output is
+the same, only the work is less.
+
+Gathering the columns of the candidate labels costs more than the plain
+contiguous tiles, so pre-screening only pays off when it rules out most of
+the pairs: `LabelBounds.worthwhile` tells whether the candidates hold at most
+`MAX_SCORED_FRACTION` of the cross-label pairs, otherwise the caller scores
+every pair as usual. The pre-screened scoring runs in this process in
+float32, it doesn't combine with the parallel or quantized scoring.
+
+The centroid similarities and bounds are also a cheap label by label
+overview of a bot (see `LabelBounds.overview`).
+"""
+
+import logging
+import numpy as np
+from typing import Iterator, List
+from modules import metrics, scoring
+from modules.scoring import PairBlock
+
+logger = logging.getLogger(__name__)
+
+# Radians added to every radius, covering the rounding of float32 embeddings
+# (arccos is steep next to 1) so a bound never ends up below a real score.
+ANGLE_SLACK = 1e-3
+
+# The largest fraction of the cross-label pairs the candidate label pairs may
+# hold for pre-screening to be faster than scoring every pair.
+MAX_SCORED_FRACTION = 0.5
+
+
+class LabelBounds():
+    """Centroid directions, angular radii and the pairwise score bounds of
+    the labels of an embedding matrix.
+    """
+
+    def __init__(self, centroids: np.ndarray, radii: np.ndarray,
+                 sizes: np.ndarray):
+        """Wrap computed label statistics, see `from_matrix`.
+
+        Args:
+            centroids (np.ndarray): the unit centroid direction of every label.
+            radii (np.ndarray): the angular radius of every label, in radians.
+            sizes (np.ndarray): the number of inputs of every label.
+        """
+        self.centroids = centroids
+        self.radii = radii
+        self.sizes = sizes
+        self.similarity = np.clip(centroids @ centroids.T, -1.0, 1.0)
+        gap = (np.arccos(self.similarity) - radii[:, None] - radii[None, :]
+               - ANGLE_SLACK)
+        self.bound = np.cos(np.clip(gap, 0, np.pi))
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, label_bounds: np.ndarray) -> "LabelBounds":
+        """Compute the label statistics of a label grouped matrix.
+
+        Args:
+            matrix (np.ndarray): the unit length embeddings, grouped by label
+            like `Dataset.labeled_order`.
+            label_bounds (np.ndarray): the first row of every label plus the
+            row count, like `Dataset.label_bounds`.
+
+        Returns:
+            LabelBounds: the statistics.
+        """
+        n_labels = len(label_bounds) - 1
+        sizes = np.diff(label_bounds)
+        centroids = np.zeros((n_labels, matrix.shape[1]))
+        radii = np.full(n_labels, np.pi)
+        for code in range(n_labels):
+            start, stop = label_bounds[code], label_bounds[code + 1]
+            if start == stop:
+                continue
+            rows = matrix[start:stop].astype(np.float64)
+            centroid = rows.sum(axis=0)
+            norm = np.linalg.norm(centroid)
+            if norm < 1e-9:
+                # No direction to speak of, the label may be anywhere.
+                continue
+            centroids[code] = centroid / norm
+            cosines = rows @ centroids[code] / np.linalg.norm(rows, axis=1)
+            radii[code] = np.arccos(np.clip(cosines, -1.0, 1.0)).max()
+        return cls(centroids, radii, sizes)
+
+    def reachable(self, threshold: float) -> np.ndarray:
+        """Which label pairs can hold a pair scoring at least `threshold`.
+
+        Returns:
+            np.ndarray: a boolean label by label matrix, False on the diagonal.
+        """
+        reach = self.bound >= threshold
+        np.fill_diagonal(reach, False)
+        return reach
+
+    def worthwhile(self, threshold: float) -> bool:
+        """Whether pre-screening at `threshold` rules out enough pairs to be
+        faster than scoring them all, see `MAX_SCORED_FRACTION`.
+        """
+        fraction = self.scored_fraction(self.reachable(threshold))
+        if fraction > MAX_SCORED_FRACTION:
+            logger.info(f"Pre-screening leaves {fraction:.1%} of the cross-label "
+                        "pairs, scoring every pair instead")
+            return False
+        return True
+
+    def overview(self, labels: List[str], threshold: float = None) -> dict:
+        """The label by label statistics as plain lists.
+
+        Args:
+            labels (List[str]): the label table.
+            threshold (float, optional): also list the label pairs that need
+            scoring at this threshold. Defaults to None.
+
+        Returns:
+            dict: `labels`, their `sizes`, `radius` (degrees), the
+            `centroid_similarity` and `bound` matrices and, with a threshold,
+            the `candidates` label pairs and the fraction of `pairs_scored`.
+        """
+        overview = {"labels": list(labels), "sizes": self.sizes.tolist(),
+                    "radius": np.degrees(self.radii).round(2).tolist(),
+                    "centroid_similarity": self.similarity.round(4).tolist(),
+                    "bound": self.bound.round(4).tolist()}
+        if threshold is not None:
+            reach = np.triu(self.reachable(threshold))
+            first, second = np.nonzero(reach)
+            overview["candidates"] = [[labels[a], labels[b]] for a, b
+                                      in zip(first.tolist(), second.tolist())]
+            overview["pairs_scored"] = self.scored_fraction(reach)
+        return overview
+
+    def scored_fraction(self, reach: np.ndarray) -> float:
+        """The fraction of the cross-label pairs left to score.
+        """
+        sizes = self.sizes.astype(np.float64)
+        cross = (sizes.sum() ** 2 - (sizes ** 2).sum()) / 2
+        kept = (sizes @ np.triu(reach, 1) @ sizes)
+        return float(kept / cross) if cross else 0.0
+
+
+def iter_pair_blocks(matrix: np.ndarray, threshold: float, codes: np.ndarray,
+                     label_bounds: np.ndarray, bounds: LabelBounds = None,
+                     block_size: int = scoring.DEFAULT_BLOCK_SIZE) -> Iterator[PairBlock]:
+    """`scoring.iter_pair_blocks` of a label grouped matrix, skipping the
+    label pairs that can't reach the threshold.
+
+    Row blocks hold whole labels where they fit, each is only scored against
+    the columns of the labels reachable from one of its labels.
+
+    Args:
+        matrix (np.ndarray): the unit length embeddings, grouped by label.
+        threshold (float): the minimum score of an emitted pair.
+        codes (np.ndarray): the label code of every row.
+        label_bounds (np.ndarray): the first row of every label plus the row
+        count, like `Dataset.label_bounds`.
+        bounds (LabelBounds, optional): the label statistics. Defaults to
+        computing them.
+        block_size (int, optional): the tile edge length.
+        Defaults to scoring.DEFAULT_BLOCK_SIZE.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: rows, columns and scores
+        of one row block, in row then column order.
+    """
+    if block_size < 1:
+        raise ValueError("block_size must be a positive integer")
+    if bounds is None:
+        bounds = LabelBounds.from_matrix(matrix, label_bounds)
+    reach = bounds.reachable(threshold)
+    logger.info(f"Scoring {bounds.scored_fraction(reach):.1%} of the "
+                "cross-label pairs after pre-screening")
+    for start, stop in label_blocks(label_bounds, block_size):
+        first, last = codes[start], codes[stop - 1]
+        targets = np.flatnonzero(reach[first:last + 1].any(axis=0))
+        # Only columns after the block's first row pair with it (i < j).
+        runs = [(max(int(label_bounds[target]), start + 1),
+                 int(label_bounds[target + 1])) for target in targets]
+        runs = [(run_start, run_stop) for run_start, run_stop in runs
+                if run_stop > run_start]
+        yield score_runs(matrix, start, stop, runs, threshold, codes, reach,
+                         block_size)
+
+
+def label_blocks(label_bounds: np.ndarray, block_size: int) -> List[tuple]:
+    """Cut the rows of a label grouped matrix into `(start, stop)` blocks
+    of whole consecutive labels, labels larger than block_size are split.
+    """
+    blocks = []
+    start = stop = 0
+    for label_stop in label_bounds[1:].tolist():
+        if label_stop - start > block_size and stop > start:
+            blocks.append((start, stop))
+            start = stop
+        while label_stop - start > block_size:
+            blocks.append((start, start + block_size))
+            start += block_size
+        stop = label_stop
+    if stop > start:
+        blocks.append((start, stop))
+    return blocks
+
+
+def score_runs(matrix: np.ndarray, start: int, stop: int, runs: List[tuple],
+               threshold: float, codes: np.ndarray, reach: np.ndarray,
+               block_size: int) -> PairBlock:
+    """Score rows `start:stop` against the columns of the `(start, stop)`
+    column runs, keeping the pairs `i < j` of reachable label pairs.
+    """
+    columns = (np.concatenate([np.arange(*run) for run in runs])
+               if runs else np.empty(0, dtype=np.intp))
+    first, last = codes[start], codes[stop - 1]
+    block_reach = reach[first:last + 1]
+    targets = np.unique(codes[columns])
+    # Whether some row label of the block doesn't reach some column label
+    # (other than itself), only then do pairs need masking by label pair.
+    partial = not (block_reach[:, targets]
+                   | (np.arange(first, last + 1)[:, None] == targets[None, :])).all()
+    rows_block = matrix[start:stop]
+    rows, cols, scores = [], [], []
+    for offset in range(0, len(columns), block_size):
+        tile_columns = columns[offset:offset + block_size]
+        col_start, col_stop = tile_columns[0], tile_columns[-1] + 1
+        if col_stop - col_start == len(tile_columns):
+            tile = rows_block @ matrix[col_start:col_stop].T
+        else:
+            tile = rows_block @ matrix[tile_columns].T
+        mask = tile >= threshold
+        if partial:
+            mask &= block_reach[codes[start:stop] - first][:, codes[tile_columns]]
+        elif codes[col_start] <= last:
+            mask &= codes[start:stop, None] != codes[None, tile_columns]
+        if col_start < stop:
+            mask &= np.arange(start, stop)[:, None] < tile_columns[None, :]
+        r, c = np.nonzero(mask)
+        rows.append(r + start)
+        cols.append(tile_columns[c])
+        scores.append(tile[r, c])
+    metrics.PAIRS_EVALUATED.inc((stop - start) * len(columns))
+    if not rows:
+        return scoring.empty_block(matrix.dtype)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    scores = np.concatenate(scores)
+    # Each column tile is row-major on its own; restore global (row, col) order.
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order], scores[order]
@@ -0,0 +1,217 @@
+"""Pair scoring over a quantized copy of the embedding matrix.
+
+The matrix is stored as float16 or as int8 with one scale per row (2x or 4x
+smaller than float32) and the tiles are scored from that copy: each tile is
+upcast to float32 just before its matrix multiply, so BLAS still does the
+work while the matrix streamed through memory is smaller.
+
+Quantization moves every row by a known distance (`errors`), which bounds
+how far an approximate score can be from the exact one (`margin`). The
+quantized scan only selects candidates: the pairs scoring at least
+`threshold - margin`. Tile by tile, the rows holding a candidate are scored
+again against the full precision column tile with the same float32 matrix
+multiply as `scoring.score_row_block`, and a candidate is kept if that score
+reaches the threshold. The pairs and scores are then the ones of the float32
+scoring (see `rescore` for pairs scoring at the threshold to the last bit),
+and peak memory stays at a few tiles whatever the threshold.
+
+The scan is a float32 multiply of the upcast tiles itself, so with numpy the
+quantized path is not faster than the float32 one: it trades the size of the
+scanned copy for a second, partial multiply. `benchmarks/quantized.py`
+measures both.
+"""
+
+import logging
+import os
+import numpy as np
+from typing import Iterator
+from modules import metrics, scoring
+from modules.scoring import PairBlock
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ("float32", "float16", "int8")
+
+
+def default_precision() -> str:
+    """The scoring precision used when none is given: `SCORING_PRECISION`
+    in .env, "float32" (exact scoring) by default.
+    """
+    precision = os.getenv("SCORING_PRECISION") or "float32"
+    if precision not in PRECISIONS:
+        raise ValueError(f"SCORING_PRECISION must be one of {PRECISIONS}")
+    return precision
+
+
+class QuantizedMatrix():
+    """A float16 or per-row scaled int8 copy of an embedding matrix.
+    """
+
+    def __init__(self, values: np.ndarray, scales: np.ndarray,
+                 errors: np.ndarray, norms: np.ndarray):
+        """Wrap quantized rows, see `from_matrix`.
+
+        Args:
+            values (np.ndarray): the quantized rows.
+            scales (np.ndarray): the scale of every int8 row, None for float16.
+            errors (np.ndarray): the distance between every quantized row and
+            the original row.
+            norms (np.ndarray): the norm of every original row.
+        """
+        self.values = values
+        self.scales = scales
+        self.errors = errors
+        self.norms = norms
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, precision: str = "int8") -> "QuantizedMatrix":
+        """Quantize a matrix.
+
+        Args:
+            matrix (np.ndarray): the embeddings.
+            precision (str, optional): "float16" or "int8". Defaults to "int8".
+
+        Returns:
+            QuantizedMatrix: the quantized copy.
+        """
+        if precision == "float16":
+            values = matrix.astype(np.float16)
+            scales = None
+            restored = values.astype(np.float32)
+        elif precision == "int8":
+            peaks = np.abs(matrix).max(axis=1)
+            scales = (np.where(peaks > 0, peaks, 1) / 127).astype(np.float32)
+            values = np.rint(matrix / scales[:, None]).astype(np.int8)
+            restored = values * scales[:, None]
+        else:
+            raise ValueError(f"Can't quantize to {precision}")
+        errors = np.linalg.norm(restored - matrix, axis=1)
+        return cls(values, scales, errors, np.linalg.norm(matrix, axis=1))
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @property
+    def nbytes(self) -> int:
+        scales = 0 if self.scales is None else self.scales.nbytes
+        return self.values.nbytes + scales
+
+    @property
+    def margin(self) -> float:
+        """The largest difference between an approximate and an exact score.
+
+        With `a = x + e`: `|a.b - x.y| <= |e|.|b| + |x|.|f|` (Cauchy-Schwarz),
+        taken over the largest errors and norms.
+        """
+        if not len(self.errors):
+            return 0.0
+        error = float(self.errors.max())
+        norm = float(self.norms.max())
+        # float32 rounding of the tile multiply on top.
+        return error * (norm + error) + norm * error + 1e-6
+
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        """Rows `start:stop`, upcast to float32.
+        """
+        rows = self.values[start:stop].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[start:stop, None]
+        return rows
+
+
+def iter_pair_blocks(matrix: np.ndarray, quantized: QuantizedMatrix,
+                     threshold: float = 0.6, codes: np.ndarray = None,
+                     block_size: int = scoring.DEFAULT_BLOCK_SIZE) -> Iterator[PairBlock]:
+    """`scoring.iter_pair_blocks`, scanning the quantized matrix and
+    re-scoring the candidates in full precision.
+
+    Args:
+        matrix (np.ndarray): the full precision embeddings, only the rows of
+        candidate pairs are multiplied.
+        quantized (QuantizedMatrix): the quantized copy of the matrix.
+        threshold (float, optional): the minimum score. Defaults to 0.6.
+        codes (np.ndarray, optional): label codes, pairs sharing a code are
+        skipped. Defaults to None.
+        block_size (int, optional): the tile edge length.
+        Defaults to scoring.DEFAULT_BLOCK_SIZE.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: rows, columns and full
+        precision scores of one row block, in row then column order.
+    """
+    if block_size < 1:
+        raise ValueError("block_size must be a positive integer")
+    n = len(quantized)
+    margin = quantized.margin
+    logger.info(f"Scoring in {quantized.values.dtype} with a re-scoring "
+                f"margin of {margin:.4f}")
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = score_row_block(matrix, quantized, start, stop, threshold,
+                                margin, codes, block_size)
+        metrics.PAIRS_EVALUATED.inc(scoring.pairs_in_rows(n, start, stop))
+        yield block
+
+
+def score_row_block(matrix: np.ndarray, quantized: QuantizedMatrix,
+                    start: int, stop: int, threshold: float, margin: float,
+                    codes: np.ndarray = None,
+                    block_size: int = scoring.DEFAULT_BLOCK_SIZE) -> PairBlock:
+    """`scoring.score_row_block`, tile by tile: the quantized tile selects
+    the candidates (approximate score at least `threshold - margin`) and the
+    tile's rows holding one are scored again against the full precision
+    column tile.
+    """
+    n = len(quantized)
+    approximate_rows = quantized.rows(start, stop)
+    exact_rows = matrix[start:stop]
+    rows, cols, scores = [], [], []
+    for col_start in range(start, n, block_size):
+        col_stop = min(col_start + block_size, n)
+        tile = approximate_rows @ quantized.rows(col_start, col_stop).T
+        mask = tile >= threshold - margin
+        if codes is not None:
+            mask &= codes[start:stop, None] != codes[None, col_start:col_stop]
+        if col_start < stop:
+            mask &= (np.arange(start, stop)[:, None]
+                     < np.arange(col_start, col_stop)[None, :])
+        candidates = np.flatnonzero(mask.any(axis=1))
+        if not len(candidates):
+            continue
+        rescore(exact_rows, candidates, matrix[col_start:col_stop],
+                mask, threshold, start, col_start, rows, cols, scores)
+    if not rows:
+        return scoring.empty_block(matrix.dtype)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    scores = np.concatenate(scores)
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order], scores[order]
+
+
+def rescore(exact_rows: np.ndarray, candidates: np.ndarray,
+            columns: np.ndarray, mask: np.ndarray, threshold: float,
+            start: int, col_start: int, rows: list, cols: list, scores: list):
+    """Score the candidate rows of a tile against its full precision
+    columns and append the pairs reaching the threshold.
+
+    The rows are multiplied against the whole column tile like
+    `scoring.score_row_block` does. When every row holds a candidate it's
+    the very same multiply, otherwise BLAS sums the products of the
+    gathered rows in the same order on full width tiles, but may not on
+    narrow ones (a pair scoring at the threshold to the last float32 bit
+    can then come out differently).
+    """
+    if len(candidates) == len(exact_rows):
+        exact = exact_rows @ columns.T
+    else:
+        picked = candidates
+        if len(candidates) == 1:
+            # A lone row would be a matrix-vector product, which sums in
+            # another order than the tile's matrix multiply.
+            picked = np.append(candidates, 1 if candidates[0] == 0 else 0)
+        exact = (exact_rows[picked] @ columns.T)[:len(candidates)]
+    r, c = np.nonzero(mask[candidates] & (exact >= threshold))
+    rows.append(candidates[r] + start)
+    cols.append(c + col_start)
+    scores.append(exact[r, c])
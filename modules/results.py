@@ -0,0 +1,269 @@
+"""Serialization of compare results.
+
+The compute generators of `Intent` yield results one block at a time, these
+helpers turn those blocks into byte chunks so a response can be streamed while
+the scoring is still running. `PairTable` is the opt-in columnar alternative
+to per-pair JSON objects, written as `.npz` or Arrow IPC.
+"""
+
+import io
+import numpy as np
+import ujson
+from typing import BinaryIO, Iterable, Iterator, List, Sequence
+from modules import metrics
+from modules.scoring import PairBlock
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Formats accepted by the compare endpoints and the job worker.
+FORMATS = ("json", "ndjson", "json-stream", "npz", "arrow")
+
+# Formats written from a PairTable instead of per-pair JSON objects.
+BINARY_FORMATS = ("npz", "arrow")
+
+MEDIA_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "json-stream": "application/json",
+    "npz": "application/octet-stream",
+    "arrow": "application/vnd.apache.arrow.file",
+}
+
+
+def ndjson_chunks(blocks: Iterable[List]) -> Iterator[bytes]:
+    """Newline-delimited JSON, one result per line and one chunk per block.
+
+    Args:
+        blocks (Iterable[List]): the result blocks.
+
+    Yields:
+        bytes: the encoded lines of one block.
+    """
+    timer = metrics.StageTimer("serialize")
+    try:
+        for block in blocks:
+            if block:
+                with timer:
+                    chunk = "".join(ujson.dumps(item) + "\n" for item in block).encode()
+                metrics.RESPONSE_BYTES.inc(len(chunk), format="ndjson")
+                yield chunk
+    finally:
+        timer.record()
+
+
+def json_array_chunks(blocks: Iterable[List]) -> Iterator[bytes]:
+    """A single JSON array, written out one block at a time.
+
+    Args:
+        blocks (Iterable[List]): the result blocks.
+
+    Yields:
+        bytes: the opening bracket, the encoded items of every block and the
+        closing bracket.
+    """
+    timer = metrics.StageTimer("serialize")
+    try:
+        yield b"["
+        separator = ""
+        for block in blocks:
+            if block:
+                with timer:
+                    chunk = (separator + ",".join(
+                        ujson.dumps(item) for item in block)).encode()
+                metrics.RESPONSE_BYTES.inc(len(chunk), format="json-stream")
+                yield chunk
+                separator = ","
+        yield b"]"
+        metrics.RESPONSE_BYTES.inc(2, format="json-stream")
+    finally:
+        timer.record()
+
+
+def json_bytes(result) -> bytes:
+    """Encode a complete result as one JSON document.
+
+    Args:
+        result: the result, e.g. of `Intent.compute_labeled_scores_fast`.
+
+    Returns:
+        bytes: the encoded JSON.
+    """
+    with metrics.stage("serialize"):
+        data = ujson.dumps(result).encode()
+    metrics.RESPONSE_BYTES.inc(len(data), format="json")
+    return data
+
+
+def chunks(blocks: Iterable[List], format: str = "ndjson") -> Iterator[bytes]:
+    """Encode result blocks in one of the streaming formats.
+
+    Args:
+        blocks (Iterable[List]): the result blocks.
+        format (str, optional): "ndjson" or "json-stream". Defaults to "ndjson".
+
+    Raises:
+        ValueError: for an unknown format.
+
+    Returns:
+        Iterator[bytes]: the encoded chunks.
+    """
+    if format == "ndjson":
+        return ndjson_chunks(blocks)
+    if format == "json-stream":
+        return json_array_chunks(blocks)
+    raise ValueError(f"Unknown streaming format {format!r}")
+
+
+class ChunkStream(io.RawIOBase):
+    """A read-only file object over an iterator of byte chunks.
+
+    Chunks are only produced as the reader asks for data, so a result can be
+    handed to an uploader expecting a file without being encoded up front.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+class PairTable():
+    """Columnar similarity pairs.
+
+    Instead of one dict per pair, the pairs are three parallel typed arrays
+    indexing into a single input-id table. For labeled results every input
+    also has a code into a single label table, so label strings are stored
+    once rather than once per pair.
+    """
+
+    def __init__(self, rows: np.ndarray, cols: np.ndarray, scores: np.ndarray,
+                 ids: Sequence[str], labels: Sequence[str] = (),
+                 codes: np.ndarray = None):
+        """Wrap already computed columns, see `from_blocks`.
+
+        Args:
+            rows (np.ndarray): the first input of every pair (into `ids`).
+            cols (np.ndarray): the second input of every pair (into `ids`).
+            scores (np.ndarray): the score of every pair.
+            ids (Sequence[str]): the input id table.
+            labels (Sequence[str], optional): the label table. Defaults to ().
+            codes (np.ndarray, optional): the label code of every input id,
+            -1 for unlabeled inputs. Defaults to all -1.
+        """
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.cols = np.asarray(cols, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=np.float32)
+        self.ids = np.asarray(ids, dtype=str)
+        self.labels = np.asarray(labels, dtype=str)
+        if codes is None:
+            codes = np.full(len(self.ids), -1)
+        self.codes = np.asarray(codes, dtype=np.int32)
+
+    @classmethod
+    def from_blocks(cls, blocks: Iterable[PairBlock], ids: Sequence[str],
+                    labels: Sequence[str] = (),
+                    codes: np.ndarray = None) -> "PairTable":
+        """Concatenate scoring blocks (see `modules.scoring`) into a table.
+        """
+        rows, cols, scores = [], [], []
+        for block_rows, block_cols, block_scores in blocks:
+            rows.append(block_rows.astype(np.int32))
+            cols.append(block_cols.astype(np.int32))
+            scores.append(block_scores.astype(np.float32))
+        if not rows:
+            rows = cols = [np.empty(0, np.int32)]
+            scores = [np.empty(0, np.float32)]
+        return cls(np.concatenate(rows), np.concatenate(cols),
+                   np.concatenate(scores), ids, labels, codes)
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def save(self, file: BinaryIO, format: str = "npz"):
+        """Write the table as an uncompressed `.npz` or an Arrow IPC file.
+
+        Args:
+            file (BinaryIO): the binary file object to write to.
+            format (str, optional): "npz" or "arrow". Defaults to "npz".
+
+        Raises:
+            ValueError: for an unknown format.
+        """
+        with metrics.stage("serialize"):
+            self._save(file, format)
+
+    def _save(self, file: BinaryIO, format: str):
+        if format == "npz":
+            np.savez(file, rows=self.rows, cols=self.cols, scores=self.scores,
+                     ids=self.ids, labels=self.labels, codes=self.codes)
+        elif format == "arrow":
+            _require_pyarrow()
+            pairs = pa.table({"row": self.rows, "col": self.cols,
+                              "score": self.scores})
+            pairs = pairs.replace_schema_metadata({
+                "ids": ujson.dumps(self.ids.tolist()),
+                "labels": ujson.dumps(self.labels.tolist()),
+                "codes": ujson.dumps(self.codes.tolist()),
+            })
+            with pa.ipc.new_file(file, pairs.schema) as writer:
+                writer.write_table(pairs)
+        else:
+            raise ValueError(f"Unknown binary format {format!r}")
+
+    def to_bytes(self, format: str = "npz") -> bytes:
+        buffer = io.BytesIO()
+        self.save(buffer, format)
+        data = buffer.getvalue()
+        metrics.RESPONSE_BYTES.inc(len(data), format=format)
+        return data
+
+    @classmethod
+    def load(cls, file, format: str = "npz") -> "PairTable":
+        """Read a table written by `save`.
+
+        Arrow files are memory-mapped when given a path, so the pair columns
+        aren't copied.
+
+        Args:
+            file: a path or a binary file object.
+            format (str, optional): "npz" or "arrow". Defaults to "npz".
+
+        Returns:
+            PairTable: the table.
+        """
+        if format == "npz":
+            with np.load(file, allow_pickle=False) as data:
+                return cls(data["rows"], data["cols"], data["scores"],
+                           data["ids"], data["labels"], data["codes"])
+        if format == "arrow":
+            _require_pyarrow()
+            source = pa.memory_map(file) if isinstance(file, str) else file
+            pairs = pa.ipc.open_file(source).read_all()
+            metadata = pairs.schema.metadata
+            return cls(pairs["row"].to_numpy(), pairs["col"].to_numpy(),
+                       pairs["score"].to_numpy(),
+                       ujson.loads(metadata[b"ids"]),
+                       ujson.loads(metadata[b"labels"]),
+                       ujson.loads(metadata[b"codes"]))
+        raise ValueError(f"Unknown binary format {format!r}")
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The arrow format needs pyarrow, pip install pyarrow")
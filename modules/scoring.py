@@ -0,0 +1,218 @@
+"""Block-matrix pair scoring.
+
+Instead of walking every `itertools.combinations` pair in Python, the
+embedding matrix is cut into square tiles and each tile is scored with a
+single matrix multiply. Cells that fall below the threshold (or that pair two
+inputs sharing a label) are masked out and only the surviving pairs are
+emitted with `np.nonzero`.
+
+`iter_top_k_blocks` scores the same tiles but keeps only the k best columns
+of every row (with `np.argpartition`), so its memory and output are O(n·k)
+instead of growing with the number of pairs above a threshold.
+"""
+
+import numpy as np
+from typing import Iterator, Sequence, Tuple
+from modules import metrics
+
+# Rows/columns per tile. A tile holds block_size² scores, so the default keeps
+# the scratch space for one tile at ~4MB (float32) regardless of dataset size.
+DEFAULT_BLOCK_SIZE = 1024
+
+PairBlock = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def label_codes(labels: Sequence[str]) -> Tuple[np.ndarray, list]:
+    """Intern a sequence of labels into an int32 code array.
+
+    Args:
+        labels (Sequence[str]): the label of every row of the matrix.
+
+    Returns:
+        Tuple[np.ndarray, list]: the code of every row and the label table,
+        `table[codes[i]] == labels[i]`.
+    """
+    lookup = {}
+    codes = np.fromiter(
+        (lookup.setdefault(label, len(lookup)) for label in labels),
+        dtype=np.int32, count=len(labels))
+    return codes, list(lookup)
+
+
+def iter_pair_blocks(matrix: np.ndarray, threshold: float = 0.6,
+                     codes: np.ndarray = None,
+                     block_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[PairBlock]:
+    """Score every pair `i < j` of the matrix rows, one row block at a time.
+
+    Pairs are yielded in the same order as `itertools.combinations` would
+    produce them: by row, then by column.
+
+    Args:
+        matrix (np.ndarray): the stacked embeddings, one row per sentence.
+        threshold (float, optional): the minimum score of an emitted pair.
+        Defaults to 0.6.
+        codes (np.ndarray, optional): an integer label code per row, pairs
+        with the same code are skipped. Defaults to None (no label masking).
+        block_size (int, optional): the tile edge length. Peak scratch memory
+        is about block_size² scores. Defaults to DEFAULT_BLOCK_SIZE.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: the row indices, column
+        indices and scores of the surviving pairs of one row block.
+    """
+    if block_size < 1:
+        raise ValueError("block_size must be a positive integer")
+    n = len(matrix)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = score_row_block(matrix, start, stop, threshold, codes, block_size)
+        metrics.PAIRS_EVALUATED.inc(pairs_in_rows(n, start, stop))
+        yield block
+
+
+def pairs_in_rows(n: int, start: int, stop: int) -> int:
+    """The number of pairs `i < j` of an n row matrix with `start <= i < stop`.
+    """
+    rows = stop - start
+    return rows * (n - 1) - (start + stop - 1) * rows // 2
+
+
+def score_row_block(matrix: np.ndarray, start: int, stop: int,
+                    threshold: float = 0.6, codes: np.ndarray = None,
+                    block_size: int = DEFAULT_BLOCK_SIZE) -> PairBlock:
+    """Score rows `start:stop` against every later row of the matrix.
+
+    Args:
+        matrix (np.ndarray): the stacked embeddings.
+        start (int): the first row of the block.
+        stop (int): one past the last row of the block.
+        threshold (float, optional): the minimum score. Defaults to 0.6.
+        codes (np.ndarray, optional): label codes, see `iter_pair_blocks`.
+        block_size (int, optional): the column tile width.
+        Defaults to DEFAULT_BLOCK_SIZE.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: rows, columns and scores,
+        ordered by row then column.
+    """
+    n = len(matrix)
+    rows_block = matrix[start:stop]
+    rows, cols, scores = [], [], []
+    for col_start in range(start, n, block_size):
+        col_stop = min(col_start + block_size, n)
+        tile = rows_block @ matrix[col_start:col_stop].T
+        mask = tile >= threshold
+        if codes is not None:
+            mask &= codes[start:stop, None] != codes[None, col_start:col_stop]
+        # Only the upper triangle (i < j) is scored; the tile overlapping the
+        # diagonal also contains i >= j cells.
+        if col_start < stop:
+            mask &= (np.arange(start, stop)[:, None]
+                     < np.arange(col_start, col_stop)[None, :])
+        r, c = np.nonzero(mask)
+        rows.append(r + start)
+        cols.append(c + col_start)
+        scores.append(tile[r, c])
+    if not rows:
+        return empty_block(matrix.dtype)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    scores = np.concatenate(scores)
+    # Each column tile is row-major on its own; restore global (row, col) order.
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order], scores[order]
+
+
+def empty_block(dtype=np.float32) -> PairBlock:
+    """A block without pairs.
+    """
+    return (np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp),
+            np.empty(0, dtype=dtype))
+
+
+def iter_top_k_blocks(matrix: np.ndarray, k: int, min_score: float = None,
+                      codes: np.ndarray = None,
+                      block_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[PairBlock]:
+    """Find the k most similar other rows of every row, one row block at a time.
+
+    Unlike `iter_pair_blocks` the pairs are directed: row `i` lists its own
+    neighbours, so a pair can show up from both of its ends.
+
+    Args:
+        matrix (np.ndarray): the stacked embeddings, one row per sentence.
+        k (int): the neighbours kept per row.
+        min_score (float, optional): the minimum score of a neighbour.
+        Defaults to None (no minimum).
+        codes (np.ndarray, optional): an integer label code per row, rows
+        sharing a code aren't neighbours. Defaults to None.
+        block_size (int, optional): the tile edge length.
+        Defaults to DEFAULT_BLOCK_SIZE.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: the rows, their neighbours
+        and scores, ordered by row then by descending score.
+    """
+    if k < 1:
+        raise ValueError("k must be a positive integer")
+    if block_size < 1:
+        raise ValueError("block_size must be a positive integer")
+    n = len(matrix)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = top_k_row_block(matrix, start, stop, k, min_score, codes,
+                                block_size)
+        metrics.PAIRS_EVALUATED.inc((stop - start) * (n - 1))
+        yield block
+
+
+def top_k_row_block(matrix: np.ndarray, start: int, stop: int, k: int,
+                    min_score: float = None, codes: np.ndarray = None,
+                    block_size: int = DEFAULT_BLOCK_SIZE) -> PairBlock:
+    """The k best neighbours of rows `start:stop` among all other rows.
+
+    The column tiles are merged into a running `(rows, k)` best list, so
+    the scratch space stays at about `rows * (k + block_size)` scores.
+
+    Args:
+        matrix (np.ndarray): the stacked embeddings.
+        start (int): the first row of the block.
+        stop (int): one past the last row of the block.
+        k (int): the neighbours kept per row.
+        min_score (float, optional): the minimum score. Defaults to None.
+        codes (np.ndarray, optional): label codes, see `iter_top_k_blocks`.
+        block_size (int, optional): the column tile width.
+        Defaults to DEFAULT_BLOCK_SIZE.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: rows, neighbours and
+        scores, ordered by row then by descending score.
+    """
+    n = len(matrix)
+    rows_block = matrix[start:stop]
+    row_index = np.arange(start, stop)
+    best_scores = np.empty((stop - start, 0), dtype=matrix.dtype)
+    best_cols = np.empty((stop - start, 0), dtype=np.intp)
+    for col_start in range(0, n, block_size):
+        col_stop = min(col_start + block_size, n)
+        tile = rows_block @ matrix[col_start:col_stop].T
+        col_index = np.arange(col_start, col_stop)
+        # Masked cells sink to the bottom and are dropped below.
+        skip = row_index[:, None] == col_index[None, :]
+        if codes is not None:
+            skip |= codes[start:stop, None] == codes[None, col_start:col_stop]
+        tile[skip] = -np.inf
+        best_scores = np.concatenate((best_scores, tile), axis=1)
+        best_cols = np.concatenate(
+            (best_cols, np.broadcast_to(col_index, tile.shape)), axis=1)
+        if best_scores.shape[1] > k:
+            keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+            best_cols = np.take_along_axis(best_cols, keep, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+    best_cols = np.take_along_axis(best_cols, order, axis=1)
+    mask = np.isfinite(best_scores)
+    if min_score is not None:
+        mask &= best_scores >= min_score
+    r, c = np.nonzero(mask)
+    return r + start, best_cols[r, c], best_scores[r, c]
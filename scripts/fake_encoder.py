@@ -0,0 +1,84 @@
+"""
+A local stand-in for the remote encoder, for testing and benchmarking.
+
+It answers `POST /` with a `.npy` payload of deterministic unit vectors
+(`modules.encoder.HashingEncoder`), one per sentence of the JSON list in the
+request body. Point the service at it with `ENCODER_URL=http://localhost:8001/`,
+or skip the HTTP hop altogether with `ENCODER=hashing`.
+
+`statuses` makes the first requests fail with the given HTTP status codes
+(to exercise the client's retries), the size of every encoded batch is kept
+in `server.batches`.
+
+Run `python -m scripts.fake_encoder [port] [dimensions] [latency_ms]`
+"""
+import io
+import sys
+import threading
+import time
+import numpy as np
+import ujson
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable
+from modules.encoder import HashingEncoder
+
+
+def embed(sentences, dimensions: int = 512) -> np.ndarray:
+    """Deterministic unit vectors, see `HashingEncoder`.
+    """
+    return HashingEncoder(dimensions).embed(sentences)
+
+
+def make_handler(dimensions: int = 512, latency: float = 0,
+                 statuses: Iterable[int] = ()):
+    encoder = HashingEncoder(dimensions)
+    failures = list(statuses)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            with lock:
+                status = failures.pop(0) if failures else None
+            if status is not None:
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            sentences = ujson.loads(body)
+            with lock:
+                self.server.batches.append(len(sentences))
+            buffer = io.BytesIO()
+            np.save(buffer, encoder.embed(sentences))
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(buffer.tell()))
+            self.end_headers()
+            self.wfile.write(buffer.getvalue())
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port: int = 8001, dimensions: int = 512, latency: float = 0,
+          statuses: Iterable[int] = ()) -> ThreadingHTTPServer:
+    """Create the server, call `serve_forever()` (or run it in a thread) to start it.
+
+    Port 0 picks a free port, see `server.server_port`.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port),
+                                 make_handler(dimensions, latency, statuses))
+    server.batches = []
+    return server
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8001
+    dimensions = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0
+    serve(port, dimensions, latency).serve_forever()
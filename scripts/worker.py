@@ -1,11 +1,29 @@
+"""
+Job queue worker computing compare jobs.
+
+Every job's blob is a bot export. Its parameters pick the comparison
+(`compare`: "labeled" or "unlabeled"), the result format (`format`: any of
+`results.FORMATS`, "json" by default) and whether an unlabeled run is
+checkpointed to `CHECKPOINT_DIR` (`checkpoint`, false by default), see
+`modules.jobs`. A checkpointed job handed out again after the worker was
+restarted resumes from its last scored block.
+
+Run `python -m scripts.worker [processes]`, `JOB_WORKERS` processes by default
+(one per CPU). The jobs are computed in one pool of that many processes, fed
+by `processes + JOB_PREFETCH` job queue loops running as threads: while every
+process is busy, the extra loops have already fetched the next jobs and their
+blobs. A job's result is encoded block by block into a spool file while it's
+scored and uploaded from there.
+"""
+import os
+import sys
 import time
 import io
-import ujson
+import threading
 import logging.config
-from multiprocessing import Process, Queue
 from dotenv import load_dotenv
 load_dotenv()
-from modules import intent
+from modules import jobs
 from jobqueue_worker import Job, Result, ResultStatus, basic_worker
 from jobqueue_worker.config import loggers
 
@@ -19,36 +37,22 @@ LOG = logging.getLogger(__name__.split(".")[0])
 job_success = False
 
 
+# Computes the jobs, in this process unless run_worker starts a pool.
+runner = jobs.JobRunner(0)
+
+
 def handler(job: Job, stream: io.BytesIO):
     try:
-        #intents = intent.Intent(json.loads(stream))
-        #result_data = intents.compute_labeled_scores()
-        settings = ujson.loads(job.parameters)
-        
-        if "compare" not in settings:
-            return Result(status=ResultStatus.FAILED)
-        if settings["compare"] not in ["labeled", "unlabeled"]:
-            return Result(status=ResultStatus.FAILED)
-        labeled = settings["compare"] == "labeled"
-
-        stream_read = stream.read().decode("utf-8")
-        result_data = ujson.dumps(stream_read)
-        data = ujson.loads(result_data)
-    
-        intents = intent.Intent(result_data)
-        output = intents.compute_labeled_scores_fast()
-        print(len(output))
-        result_stream = io.StringIO(output)
-        result_stream.write()
-        result_stream.seek(0)
-
-        #intents = intent.Intent()
+        settings = jobs.parse_settings(job.parameters)
+        summary, result_stream = runner.handle(settings, stream, job.id)
+
         result = Result(
             status=ResultStatus.SUCCESS,
             params={
                 "worker": "Job Worker",
                 "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
                 "input_data": settings,
+                "metrics": summary["metrics"],
             },
             blob_name=job.id,
             blob_data=result_stream)
@@ -56,20 +60,42 @@ def handler(job: Job, stream: io.BytesIO):
         LOG.info("Handled job")
         return result
 
+    except ValueError as ex:
+        LOG.error(f"Invalid job: {ex}")
     except Exception as ex:
         LOG.exception("Function failed")
     
     LOG.info("Handled job as failed")
     return Result(status=ResultStatus.FAILED)
 
-def run_worker():
-    """Run basic_worker in a different process.
+def run_worker(processes: int = 1, prefetch: int = 1):
+    """Compute jobs in a pool of processes fed by several job queue loops.
+
+    Args:
+        processes (int, optional): jobs computed at the same time. Defaults to 1.
+        prefetch (int, optional): jobs fetched ahead while every process is
+        busy. Defaults to 1.
     """
-    queue = Queue()
-    p = Process(target=basic_worker, args=(handler, True))
-    #basic_worker(handler, retrieve_blob=True)
-    p.start()
-    p.join()
+    global runner
+    if processes < 2 and not prefetch:
+        basic_worker(handler, retrieve_blob=True)
+        return
+    runner = jobs.JobRunner(processes)
+    loops = [threading.Thread(target=basic_worker, args=(handler, True),
+                              name=f"job-loop-{i}", daemon=True)
+             for i in range(processes + prefetch)]
+    for loop in loops:
+        loop.start()
+    LOG.info(f"Computing jobs in {processes} processes, "
+             f"{prefetch} fetched ahead")
+    try:
+        for loop in loops:
+            loop.join()
+    finally:
+        runner.close()
 
 
-basic_worker(handler, retrieve_blob=True)
+if __name__ == "__main__":
+    run_worker(int(sys.argv[1]) if len(sys.argv) > 1
+               else int(os.getenv("JOB_WORKERS") or os.cpu_count()),
+               int(os.getenv("JOB_PREFETCH") or 1))
@@ -0,0 +1,62 @@
+"""Shared fixtures. The tests run against the local hashing encoder with
+every on-disk cache turned off, nothing leaves the machine.
+"""
+import os
+
+os.environ.update(ENCODER="hashing", ENCODER_DIMENSIONS="64",
+                  EMBEDDING_CACHE_DIR="", ANN_INDEX_DIR="", REVISION_DIR="",
+                  RESULT_CACHE_ENTRIES="0", SCORING_WORKERS="1",
+                  SCORING_PRECISION="float32")
+
+import itertools
+import numpy as np
+import pytest
+from benchmarks import exports
+from modules import intent
+from modules.dataset import Dataset
+
+
+def combinations_reference(matrix: np.ndarray, threshold: float,
+                           codes: np.ndarray = None) -> list:
+    """The pairs the original `itertools.combinations` loop emitted:
+    `(i, j, score)` in combination order.
+    """
+    pairs = []
+    for i, j in itertools.combinations(range(len(matrix)), 2):
+        if codes is not None and codes[i] == codes[j]:
+            continue
+        score = float(np.inner(matrix[i], matrix[j]))
+        if score >= threshold:
+            pairs.append((i, j, score))
+    return pairs
+
+
+def block_pairs(blocks) -> list:
+    """Flatten pair blocks into `(i, j, score)` tuples.
+    """
+    return [(i, j, score) for rows, cols, scores in blocks
+            for i, j, score in zip(rows.tolist(), cols.tolist(), scores.tolist())]
+
+
+def assert_same_pairs(actual: list, expected: list, tolerance: float = 1e-5):
+    """Same pairs in the same order, scores within float32 tolerance.
+    """
+    assert [pair[:2] for pair in actual] == [pair[:2] for pair in expected]
+    np.testing.assert_allclose([pair[2] for pair in actual],
+                               [pair[2] for pair in expected], atol=tolerance)
+
+
+@pytest.fixture
+def export() -> dict:
+    # No duplicates: the pairs near the threshold then have distinct scores.
+    return exports.generate_export(400, labels=12, duplicates=0, seed=3)
+
+
+@pytest.fixture
+def dataset(export) -> Dataset:
+    return Dataset.from_json(export)
+
+
+@pytest.fixture
+def intents(dataset) -> intent.Intent:
+    return intent.Intent(dataset)
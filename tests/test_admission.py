@@ -0,0 +1,71 @@
+import gc
+import pytest
+from modules import admission
+
+
+def test_limiter_rejects_instead_of_waiting():
+    limiter = admission.Limiter("route", 2)
+    limiter.acquire()
+    limiter.acquire()
+    with pytest.raises(admission.Saturated):
+        limiter.acquire()
+    limiter.release()
+    limiter.acquire()
+    assert limiter.stats == {"active": 2, "limit": 2, "admitted": 3, "rejected": 1}
+    with pytest.raises(ValueError):
+        admission.Limiter("route", 0)
+
+
+def held(limiter, items=(1, 2, 3)) -> admission.Held:
+    limiter.acquire()
+    return limiter.hold(items)
+
+
+def test_held_releases_when_exhausted():
+    limiter = admission.Limiter("route", 1)
+    assert list(held(limiter)) == [1, 2, 3]
+    assert limiter.active == 0
+
+
+def test_held_releases_on_errors_and_close():
+    limiter = admission.Limiter("route", 1)
+
+    def failing():
+        yield 1
+        raise RuntimeError("scoring failed")
+
+    items = held(limiter, failing())
+    assert next(items) == 1
+    with pytest.raises(RuntimeError):
+        next(items)
+    assert limiter.active == 0
+
+    closed = []
+
+    def blocks():
+        try:
+            yield from (1, 2, 3)
+        finally:
+            closed.append(True)
+
+    items = held(limiter, blocks())
+    next(items)
+    items.close()
+    items.close()
+    assert closed == [True] and limiter.active == 0
+
+
+def test_held_releases_when_never_started():
+    limiter = admission.Limiter("route", 1)
+    items = held(limiter)
+    del items
+    gc.collect()
+    assert limiter.active == 0
+
+
+def test_run_uses_the_compute_pool():
+    import asyncio
+    import threading
+
+    name = asyncio.run(admission.run(lambda: threading.current_thread().name))
+    assert name.startswith("compute")
@@ -0,0 +1,44 @@
+import pytest
+from benchmarks import exports
+from modules import ann, intent, scoring
+from modules.dataset import Dataset
+from tests.conftest import block_pairs
+
+
+@pytest.fixture(scope="module")
+def matrix():
+    dataset = Dataset.from_json(exports.generate_export(
+        3000, labels=60, duplicates=0, unlabeled=1.0, seed=5))
+    return intent.Intent(dataset).batch_embed(
+        dataset.texts.take(dataset.unlabeled_order))
+
+
+def test_approximate_pairs_are_exact_pairs(matrix):
+    index = ann.IVFIndex.build(matrix)
+    exact = {pair[:2]: pair[2] for pair in
+             block_pairs(scoring.iter_pair_blocks(matrix, 0.6))}
+    approximate = block_pairs(index.iter_pairs(matrix, 0.6))
+    assert len({pair[:2] for pair in approximate}) == len(approximate)
+    for i, j, score in approximate:
+        assert i < j
+        assert score == pytest.approx(exact[i, j], abs=1e-5)
+
+
+def test_recall_at_the_default_n_probe(matrix):
+    index = ann.IVFIndex.build(matrix)
+    report = ann.measure_recall(matrix, index, 0.6)
+    assert report["extra"] == 0
+    assert report["recall"] >= 0.95
+    # More probes never lose pairs, probing every list is exact.
+    assert ann.measure_recall(matrix, index, 0.6, n_probe=2)["recall"] <= report["recall"]
+    assert ann.measure_recall(matrix, index, 0.6, n_probe=len(index.centroids))["recall"] == 1.0
+
+
+def test_intent_approximate_is_a_subset():
+    dataset = Dataset.from_records(
+        (f"id{i}", None, f"text {i % 40} {i % 13} word{i % 7}") for i in range(300))
+    intents = intent.Intent(dataset)
+    exact = {pair[:2] for pair in intents.compute_unlabeled_scores(0.5)}
+    approximate = {pair[:2] for pair in
+                   intents.compute_unlabeled_scores(0.5, approximate=True)}
+    assert approximate and approximate <= exact
@@ -0,0 +1,126 @@
+import io
+import threading
+import ujson
+import pytest
+from fastapi.testclient import TestClient
+import main
+from modules import admission, ingest, intent
+
+
+@pytest.fixture
+def client() -> TestClient:
+    return TestClient(main.app)
+
+
+def parse(response, format: str) -> list:
+    if format == "ndjson":
+        return [ujson.loads(line) for line in response.text.splitlines()]
+    return response.json()
+
+
+@pytest.mark.parametrize("route, threshold", [("labeled", 0.4), ("unlabeled", 0.3)])
+@pytest.mark.parametrize("format", ["ndjson", "json-stream"])
+def test_streamed_formats_equal_the_json_response(client, export, route,
+                                                  threshold, format):
+    url = f"/inputs/compare/{route}?threshold={threshold}"
+    expected = client.post(url, json=export).json()
+    response = client.post(f"{url}&format={format}", json=export)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith(
+        main.results.MEDIA_TYPES[format])
+    assert expected
+    assert parse(response, format) == expected
+
+
+def test_unknown_format_is_rejected(client, export):
+    response = client.post("/inputs/compare/labeled?format=csv", json=export)
+    assert response.status_code == 400
+
+
+def test_npz_format_holds_the_json_pairs(client, export):
+    expected = client.post("/inputs/compare/unlabeled?threshold=0.3",
+                           json=export).json()
+    response = client.post("/inputs/compare/unlabeled?threshold=0.3&format=npz",
+                           json=export)
+    assert response.status_code == 200
+    table = main.results.PairTable.load(io.BytesIO(response.content))
+    assert len(table) == len(expected)
+    assert table.scores.tolist() == pytest.approx([pair[2] for pair in expected])
+
+
+@pytest.fixture
+def blocked(monkeypatch):
+    """Labeled compares that wait until `release` is set.
+    """
+    started, release = threading.Event(), threading.Event()
+    compute = intent.Intent.compute_labeled_scores_fast
+
+    def wait(self, *args, **kwargs):
+        started.set()
+        assert release.wait(10)
+        return compute(self, *args, **kwargs)
+
+    monkeypatch.setattr(intent.Intent, "compute_labeled_scores_fast", wait)
+    yield started, release
+    release.set()
+
+
+def post_in_thread(client, url, export) -> tuple:
+    responses = []
+    thread = threading.Thread(
+        target=lambda: responses.append(client.post(url, json=export)))
+    thread.start()
+    return thread, responses
+
+
+def test_similarity_answers_during_a_compare(export, blocked):
+    started, release = blocked
+    with TestClient(main.app) as client:
+        thread, responses = post_in_thread(
+            client, "/inputs/compare/labeled?threshold=0.4", export)
+        assert started.wait(10)
+        response = client.post("/similarity?sentence_1=hi&sentence_2=hello")
+        assert response.status_code == 200 and "score" in response.json()
+        assert thread.is_alive()
+        release.set()
+        thread.join(10)
+    assert responses[0].status_code == 200 and responses[0].json()
+
+
+def test_saturated_route_answers_429(export, blocked, monkeypatch):
+    started, release = blocked
+    limiter = admission.Limiter("/inputs/compare/labeled", 1)
+    monkeypatch.setitem(main.limiters, "labeled", limiter)
+    with TestClient(main.app) as client:
+        thread, responses = post_in_thread(
+            client, "/inputs/compare/labeled?threshold=0.4", export)
+        assert started.wait(10)
+        response = client.post("/inputs/compare/labeled?threshold=0.4", json=export)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == main.RETRY_AFTER
+        release.set()
+        thread.join(10)
+    assert responses[0].status_code == 200
+    assert limiter.stats == {"active": 0, "limit": 1, "admitted": 1, "rejected": 1}
+
+
+def test_the_export_is_parsed_in_the_compute_pool(client, export, monkeypatch):
+    threads = []
+    feed = ingest.InputsParser.feed
+
+    def record(self, chunk):
+        threads.append(threading.current_thread().name)
+        return feed(self, chunk)
+
+    monkeypatch.setattr(ingest.InputsParser, "feed", record)
+    assert client.post("/inputs/compare/labels", json=export).status_code == 200
+    assert threads and all(name.startswith("compute") for name in threads)
+
+
+@pytest.mark.parametrize("format", ["ndjson", "json-stream"])
+def test_streams_release_their_slot(client, export, format):
+    limiter = main.limiters["unlabeled"]
+    response = client.post(f"/inputs/compare/unlabeled?threshold=0.3&format={format}",
+                           json=export)
+    assert response.status_code == 200
+    assert limiter.active == 0
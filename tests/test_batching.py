@@ -0,0 +1,115 @@
+import asyncio
+import time
+import numpy as np
+import pytest
+from modules.batching import MicroBatcher
+
+
+class Encoder():
+    """Embeds a sentence as its length and records every call.
+    """
+
+    def __init__(self, error: Exception = None):
+        self.calls = []
+        self.error = error
+
+    async def __call__(self, sentences):
+        self.calls.append(list(sentences))
+        await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+        return np.array([[len(sentence)] for sentence in sentences], dtype=np.float32)
+
+
+REQUESTS = [["a", "bb"], ["ccc"], ["dddd", "eeeee", "ffffff"]]
+
+
+def lengths(matrix: np.ndarray) -> list:
+    return matrix[:, 0].astype(int).tolist()
+
+
+def test_concurrent_requests_share_one_batch():
+    encoder = Encoder()
+    batcher = MicroBatcher(encoder, max_wait=0.05, max_batch=64)
+
+    async def run():
+        return await asyncio.gather(*(batcher.embed(r) for r in REQUESTS))
+
+    answers = asyncio.run(run())
+    assert [lengths(matrix) for matrix in answers] == [[1, 2], [3], [4, 5, 6]]
+    assert encoder.calls == [[s for request in REQUESTS for s in request]]
+    stats = batcher.stats
+    assert stats["batches"] == 1 and stats["sentences"] == 6
+    assert stats["largest_batch"] == 6 and stats["batch_size_histogram"] == {8: 1}
+
+
+def test_a_full_batch_doesnt_wait():
+    encoder = Encoder()
+    batcher = MicroBatcher(encoder, max_wait=10, max_batch=3)
+
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(batcher.embed(REQUESTS[0]), batcher.embed(REQUESTS[1]))
+        return time.perf_counter() - start
+
+    assert asyncio.run(run()) < 5
+    assert encoder.calls == [["a", "bb", "ccc"]]
+
+
+def test_a_lone_request_is_flushed_after_max_wait():
+    encoder = Encoder()
+    batcher = MicroBatcher(encoder, max_wait=0.01, max_batch=64)
+
+    async def run():
+        first = await batcher.embed(["x"])
+        second = await batcher.embed(["yy"])
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert lengths(first) == [1] and lengths(second) == [2]
+    assert encoder.calls == [["x"], ["yy"]]
+
+
+def test_encoder_errors_reach_every_request_of_the_batch():
+    batcher = MicroBatcher(Encoder(RuntimeError("down")), max_wait=0.05)
+
+    async def run():
+        return await asyncio.gather(*(batcher.embed(r) for r in REQUESTS),
+                                    return_exceptions=True)
+
+    answers = asyncio.run(run())
+    assert all(isinstance(answer, RuntimeError) for answer in answers)
+
+
+def test_close_answers_the_queued_requests():
+    encoder = Encoder()
+    batcher = MicroBatcher(encoder, max_wait=10, max_batch=64)
+
+    async def run():
+        requests = [asyncio.create_task(batcher.embed(r)) for r in REQUESTS]
+        await asyncio.sleep(0.01)
+        await batcher.close()
+        return await asyncio.wait_for(asyncio.gather(*requests), 1)
+
+    answers = asyncio.run(run())
+    assert [lengths(matrix) for matrix in answers] == [[1, 2], [3], [4, 5, 6]]
+    assert len(encoder.calls) == 1
+    assert batcher.stats["batches_in_flight"] == 0
+
+
+def test_close_without_requests():
+    asyncio.run(MicroBatcher(Encoder()).close())
+
+
+@pytest.mark.parametrize("max_batch, calls", [
+    (1, REQUESTS), (2, [REQUESTS[0], REQUESTS[1] + REQUESTS[2]])])
+def test_requests_are_never_split(max_batch, calls):
+    encoder = Encoder()
+    batcher = MicroBatcher(encoder, max_wait=0.05, max_batch=max_batch)
+
+    async def run():
+        return await asyncio.gather(*(batcher.embed(r) for r in REQUESTS))
+
+    answers = asyncio.run(run())
+    assert [lengths(matrix) for matrix in answers] == [[1, 2], [3], [4, 5, 6]]
+    assert encoder.calls == calls
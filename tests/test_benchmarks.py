@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import ujson
+import pytest
+from benchmarks import exports, suite
+
+
+def test_exports_are_reproducible():
+    export = exports.generate_export(500, labels=10, duplicates=0.1, seed=1)
+    assert exports.generate_export(500, labels=10, duplicates=0.1, seed=1) == export
+    assert exports.generate_export(500, labels=10, duplicates=0.1, seed=2) != export
+    inputs = export["inputs"]
+    assert len(inputs) == 500
+    labels = [value["classifier"]["label"] for value in inputs.values()]
+    assert 0 < labels.count(None) < 500
+    assert len(set(labels) - {None}) <= 10
+    texts = [value["input"] for value in inputs.values()]
+    assert len(set(texts)) < len(texts)
+
+
+@pytest.fixture
+def export_file(tmp_path) -> str:
+    return exports.write_export(str(tmp_path / "export.json"), 300, labels=8,
+                                duplicates=0, seed=4)
+
+
+def test_cases_report_stages_and_pairs(export_file):
+    runs = {path: suite.run_case(path, export_file, 0.4, 64)
+            for path in suite.PATHS}
+    for run in runs.values():
+        assert run["inputs"] == 300 and run["pairs"] > 0
+        assert {"load", "embed", "score"} <= set(run["stages"])
+    assert runs["labeled_prescreen"]["pairs"] == runs["labeled"]["pairs"]
+    assert runs["labeled_deprecated"]["pairs"] == runs["labeled"]["pairs"]
+    recall = runs["unlabeled_approx"]["recall"]
+    assert recall["exact"] == runs["unlabeled"]["pairs"]
+    assert recall["approximate"] == runs["unlabeled_approx"]["pairs"]
+    assert 0 < recall["recall"] <= 1
+
+
+def test_suite_writes_and_compares_results(tmp_path):
+    output = str(tmp_path / "results.json")
+    command = [sys.executable, "-m", "benchmarks.suite", "--sizes", "200",
+               "--paths", "labeled", "unlabeled", "--dim", "32",
+               "--output", output]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run(command, cwd=root, check=True, capture_output=True)
+    with open(output) as file:
+        report = ujson.load(file)
+    assert [(run["path"], run["n"]) for run in report["runs"]] == [
+        ("labeled", 200), ("unlabeled", 200)]
+    assert all("error" not in run for run in report["runs"])
+    compared = subprocess.run(command + ["--compare", output], cwd=root,
+                              check=True, capture_output=True, text=True)
+    assert "compared with" in compared.stdout
+    assert "peak rss" in compared.stdout
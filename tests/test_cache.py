@@ -0,0 +1,198 @@
+import multiprocessing
+import os
+import sqlite3
+import time
+import numpy as np
+import pytest
+from modules import intent
+from modules.cache import EmbeddingCache
+from modules.encoder import HashingEncoder
+
+
+def rows(n: int, dim: int = 8, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+
+
+@pytest.fixture
+def cache(tmp_path) -> EmbeddingCache:
+    return EmbeddingCache(str(tmp_path), max_entries=4)
+
+
+def test_hits_and_misses(cache):
+    matrix = rows(3)
+    cache.put_many(["a", "b", "c"], matrix)
+    found, cached = cache.get_many(["c", "x", "a"])
+    assert found.tolist() == [True, False, True]
+    np.testing.assert_array_equal(cached, matrix[[2, 0]])
+    assert cache.stats["hits"] == 2 and cache.stats["misses"] == 1
+    found, cached = cache.get_many(["x", "y"])
+    assert not found.any() and cached is None
+
+
+def test_keys_are_namespaced(tmp_path):
+    EmbeddingCache(str(tmp_path), namespace="one").put_many(["a"], rows(1))
+    found, _ = EmbeddingCache(str(tmp_path), namespace="two").get_many(["a"])
+    assert not found.any()
+
+
+def test_rejects_other_dimensions(cache):
+    cache.put_many(["a"], rows(1, dim=8))
+    with pytest.raises(ValueError):
+        cache.put_many(["b"], rows(1, dim=4))
+
+
+def test_evicts_the_least_recently_used(cache):
+    matrix = rows(6)
+    for i, key in enumerate("abcd"):
+        cache.put_many([key], matrix[i:i + 1])
+        time.sleep(0.01)
+    cache.get_many(["a"])
+    time.sleep(0.01)
+    cache.put_many(["e", "f"], matrix[4:])
+    found, cached = cache.get_many(list("abcdef"))
+    assert found.tolist() == [True, False, False, True, True, True]
+    np.testing.assert_array_equal(cached, matrix[[0, 3, 4, 5]])
+    assert len(cache) == 4
+
+
+def test_compaction_keeps_the_live_rows(cache, tmp_path):
+    matrix = rows(9)
+    for i in range(9):
+        cache.put_many([str(i)], matrix[i:i + 1])
+    assert not os.path.exists(tmp_path / "vectors.0.f32")
+    generation = cache._meta("generation")
+    assert generation > 0
+    size = os.path.getsize(tmp_path / f"vectors.{generation}.f32")
+    assert size <= 2 * 4 * matrix[0].nbytes
+    found, cached = cache.get_many([str(i) for i in range(9)])
+    assert found.tolist() == [False] * 5 + [True] * 4
+    np.testing.assert_array_equal(cached, matrix[5:])
+
+
+def test_recovers_from_a_torn_append(tmp_path):
+    matrix = rows(3)
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put_many(["a"], matrix[:1])
+    # A writer that died in the middle of its next append.
+    with open(tmp_path / "vectors.0.f32", "ab") as vectors:
+        vectors.write(matrix[1].tobytes()[:12])
+    other = EmbeddingCache(str(tmp_path), role="reader")
+    found, cached = other.get_many(["a", "b"])
+    assert found.tolist() == [True, False]
+    np.testing.assert_array_equal(cached, matrix[:1])
+    assert os.path.getsize(tmp_path / "vectors.0.f32") == matrix[0].nbytes
+    cache.put_many(["b", "c"], matrix[1:])
+    found, cached = other.get_many(["a", "b", "c"])
+    assert found.all()
+    np.testing.assert_array_equal(cached, matrix)
+
+
+def test_rows_missing_from_the_vectors_are_misses(cache, tmp_path):
+    cache.put_many(["a", "b"], rows(2))
+    os.truncate(tmp_path / "vectors.0.f32", 0)
+    reader = EmbeddingCache(str(tmp_path), role="reader")
+    found, cached = reader.get_many(["a", "b"])
+    assert not found.any() and cached is None
+
+
+def test_the_encoder_gets_the_sentences_as_given(tmp_path):
+    sentences = ["Hello  world ", "Hello world"]
+    expected = HashingEncoder(64).embed(sentences)
+    np.testing.assert_array_equal(
+        intent.Intent(cache=None).batch_embed(sentences), expected)
+    cache = EmbeddingCache(str(tmp_path), namespace="hashing:64")
+    intents = intent.Intent(cache=cache)
+    np.testing.assert_array_equal(intents.batch_embed(sentences[:1]),
+                                  expected[:1])
+    # Normalized, both sentences share the cache key.
+    np.testing.assert_array_equal(intents.batch_embed(sentences[1:]),
+                                  expected[:1])
+    assert intents.embed_stats["hits"] == 1
+
+
+def last_used(directory: str) -> dict:
+    with sqlite3.connect(os.path.join(directory, "index.sqlite3")) as db:
+        return dict(db.execute("SELECT key, last_used FROM entries"))
+
+
+def read_in_a_reader(directory: str, results):
+    """A reader process: looks sentences up, tries to write the index and
+    hands in an embedding of its own.
+    """
+    cache = EmbeddingCache(directory, role="reader", drain_interval=0)
+    found, _ = cache.get_many(["a", "b", "x"])
+    try:
+        cache._db.execute("DELETE FROM entries")
+        wrote = True
+    except sqlite3.OperationalError:
+        wrote = False
+    cache.put_many(["d"], rows(1, seed=1))
+    results.put((found.tolist(), wrote))
+
+
+def hold_the_writer(directory: str, ready, release):
+    cache = EmbeddingCache(directory, role="writer", drain_interval=3600)
+    ready.set()
+    release.wait(60)
+    cache.drain()
+
+
+def test_readers_leave_the_index_to_the_writer(tmp_path):
+    directory = str(tmp_path)
+    writer = EmbeddingCache(directory, role="writer", drain_interval=3600)
+    assert writer.writer
+    writer.put_many(["a", "b", "c"], rows(3))
+    before = last_used(directory)
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    reader = context.Process(target=read_in_a_reader, args=(directory, results))
+    reader.start()
+    found, wrote = results.get(timeout=60)
+    reader.join(60)
+    assert found == [True, True, False] and not wrote
+    assert last_used(directory) == before
+    # The found keys and the new embedding were handed in, the writer
+    # applies them.
+    assert writer.drain() == 1
+    after = last_used(directory)
+    key = writer.key
+    assert after[key("a")] > before[key("a")] and after[key("b")] > before[key("b")]
+    assert after[key("c")] == before[key("c")]
+    found, cached = writer.get_many(["d"])
+    np.testing.assert_array_equal(cached, rows(1, seed=1))
+    assert os.listdir(tmp_path / "incoming") == []
+
+
+def test_a_second_writer_takes_over_in_the_background(tmp_path):
+    directory = str(tmp_path)
+    context = multiprocessing.get_context("spawn")
+    ready, release = context.Event(), context.Event()
+    holder = context.Process(target=hold_the_writer, args=(directory, ready, release))
+    holder.start()
+    try:
+        assert ready.wait(60)
+        start = time.monotonic()
+        cache = EmbeddingCache(directory, role="writer", drain_interval=0.05)
+        assert time.monotonic() - start < 5
+        assert not cache.writer
+        cache.put_many(["a"], rows(1))
+        assert len(os.listdir(tmp_path / "incoming")) == 1
+    finally:
+        release.set()
+        holder.join(60)
+    deadline = time.monotonic() + 30
+    while not (cache.writer and cache.get_many(["a"])[0].all()):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    cache.put_many(["b"], rows(1, seed=2))
+    assert cache.get_many(["b"])[0].all()
+
+
+def test_hand_ins_are_capped(tmp_path, caplog):
+    cache = EmbeddingCache(str(tmp_path), role="reader", max_incoming=1)
+    for i in range(3):
+        cache.put_many([str(i)], rows(1, seed=i))
+    assert len(os.listdir(tmp_path / "incoming")) == 1
+    warnings = [record for record in caplog.records
+                if "dropping new ones" in record.getMessage()]
+    assert len(warnings) == 1
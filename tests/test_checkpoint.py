@@ -0,0 +1,168 @@
+import os
+import subprocess
+import sys
+import time
+import ujson
+import numpy as np
+import pytest
+from benchmarks import exports
+from modules import checkpoint, intent, scoring
+from modules.checkpoint import Checkpoint
+from modules.dataset import Dataset
+from modules.results import PairTable
+from tests.conftest import block_pairs
+
+PARTS = ("fingerprint", "unlabeled", "hashing", 0.3, 32)
+
+
+@pytest.fixture
+def matrix() -> np.ndarray:
+    generator = np.random.default_rng(4)
+    matrix = generator.standard_normal((200, 16)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def scored(monkeypatch) -> list:
+    """The start row of every block scored (not read back) from now on.
+    """
+    starts = []
+    score_row_block = scoring.score_row_block
+
+    def counted(matrix, start, *args):
+        starts.append(start)
+        return score_row_block(matrix, start, *args)
+
+    monkeypatch.setattr(checkpoint.scoring, "score_row_block", counted)
+    return starts
+
+
+def not_embedded(sentences):
+    raise AssertionError("a stored matrix isn't embedded again")
+
+
+def test_blocks_equal_plain_scoring(matrix, tmp_path):
+    run = Checkpoint.open(str(tmp_path), *PARTS)
+    stored = run.matrix(lambda sentences: matrix, ["text"] * len(matrix))
+    expected = block_pairs(scoring.iter_pair_blocks(matrix, 0.3, block_size=32))
+    assert block_pairs(run.blocks(stored, 0.3, block_size=32)) == expected
+    assert run.complete and run.progress == 1.0
+
+
+def test_interrupted_run_resumes(matrix, tmp_path, scored):
+    run = Checkpoint.open(str(tmp_path), *PARTS)
+    stored = run.matrix(lambda sentences: matrix, ["text"] * len(matrix))
+    blocks = run.blocks(stored, 0.3, block_size=32)
+    first = [next(blocks) for _ in range(3)]
+    blocks.close()
+    assert run.manifest["blocks"] == 3 and not run.complete
+    total = scoring.pairs_in_rows(200, 0, 200)
+    assert run.progress == scoring.pairs_in_rows(200, 0, 96) / total
+
+    scored.clear()
+    fractions = []
+    resumed = Checkpoint.open(str(tmp_path), *PARTS)
+    assert resumed.manifest["blocks"] == 3
+    stored = resumed.matrix(not_embedded, ["text"] * len(matrix))
+    assert isinstance(stored, np.memmap)
+    rest = list(resumed.blocks(stored, 0.3, block_size=32,
+                               progress=fractions.append))
+    assert scored == [96, 128, 160, 192]
+    assert fractions[-1] == 1.0 and fractions == sorted(fractions)
+    assert block_pairs(rest[:3]) == block_pairs(first)
+    assert block_pairs(rest) == block_pairs(
+        scoring.iter_pair_blocks(matrix, 0.3, block_size=32))
+    assert resumed.complete
+
+
+def test_finished_runs_are_read_back(matrix, tmp_path, scored):
+    run = Checkpoint.open(str(tmp_path), *PARTS)
+    expected = block_pairs(run.blocks(run.matrix(lambda s: matrix, []), 0.3,
+                                      block_size=32))
+    scored.clear()
+    again = Checkpoint.open(str(tmp_path), *PARTS)
+    assert again.complete
+    assert block_pairs(again.blocks(again.matrix(not_embedded, []), 0.3,
+                                    block_size=32)) == expected
+    assert scored == []
+
+
+def test_other_options_are_other_runs(matrix, tmp_path):
+    run = Checkpoint.open(str(tmp_path), *PARTS)
+    list(run.blocks(run.matrix(lambda s: matrix, []), 0.3, block_size=32))
+    other = Checkpoint.open(str(tmp_path), *PARTS[:-2], 0.4, 32)
+    assert other.key != run.key and other.manifest.get("blocks") is None
+
+
+def test_a_missing_block_is_scored_again(matrix, tmp_path, scored):
+    run = Checkpoint.open(str(tmp_path), *PARTS)
+    list(run.blocks(run.matrix(lambda s: matrix, []), 0.3, block_size=32))
+    os.remove(os.path.join(run.directory, "block-000002.npz"))
+    scored.clear()
+    again = Checkpoint.open(str(tmp_path), *PARTS)
+    assert again.manifest["blocks"] == 2 and not again.complete
+    pairs = block_pairs(again.blocks(again.matrix(not_embedded, []), 0.3,
+                                     block_size=32))
+    assert scored == [64, 96, 128, 160, 192]
+    assert pairs == block_pairs(scoring.iter_pair_blocks(matrix, 0.3,
+                                                         block_size=32))
+
+
+def test_stale_runs_are_pruned(matrix, tmp_path):
+    run = Checkpoint.open(str(tmp_path), *PARTS)
+    list(run.blocks(run.matrix(lambda s: matrix, []), 0.3, block_size=32))
+    stale = tmp_path / "stale"
+    stale.mkdir()
+    fresh = tmp_path / "fresh"
+    fresh.mkdir()
+    old = time.time() - 7200
+    for path in (stale, run.directory):
+        os.utime(path, (old, old))
+    again = Checkpoint.open(str(tmp_path), *PARTS, max_age=3600)
+    # The run being opened is kept however old it is.
+    assert sorted(os.listdir(tmp_path)) == sorted(["fresh", again.key])
+    assert again.complete
+
+
+def test_default_max_age(monkeypatch):
+    monkeypatch.setenv("CHECKPOINT_MAX_AGE_HOURS", "2")
+    assert checkpoint.default_max_age() == 7200
+    monkeypatch.delenv("CHECKPOINT_MAX_AGE_HOURS")
+    assert checkpoint.default_max_age() == 24 * 3600
+
+
+def test_intent_resumes_without_embedding(intents, tmp_path, monkeypatch):
+    expected = intents.compute_unlabeled_scores(0.3, block_size=16)
+    ids, sentences, blocks = intents.unlabeled_checkpointed(
+        0.3, block_size=16, directory=str(tmp_path))
+    next(blocks)
+    blocks.close()
+    monkeypatch.setattr(intents, "batch_embed", not_embedded)
+    ids, sentences, blocks = intents.unlabeled_checkpointed(
+        0.3, block_size=16, directory=str(tmp_path))
+    results = intent.Intent.unlabeled_results(sentences, blocks)
+    assert [list(pair) for block in results for pair in block] == [
+        list(pair) for pair in expected]
+
+
+def test_checkpoint_cli(tmp_path):
+    export = exports.generate_export(300, labels=8, duplicates=0, seed=6)
+    export_file = str(tmp_path / "export.json")
+    with open(export_file, "w") as file:
+        ujson.dump(export, file)
+    directory = str(tmp_path / "checkpoints")
+    output = str(tmp_path / "pairs.npz")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = [sys.executable, "-m", "modules.intent", export_file,
+               "--threshold", "0.3", "--block-size", "16", "--checkpoint",
+               "--checkpoint-dir", directory]
+    for _ in range(2):
+        subprocess.run(command + ["--output", output], cwd=root, check=True,
+                       capture_output=True)
+    expected = intent.Intent(Dataset.from_json(export)).compute_unlabeled_table(
+        0.3, block_size=16)
+    table = PairTable.load(output)
+    assert len(table) == len(expected) > 0
+    [run] = os.listdir(directory)
+    with open(os.path.join(directory, run, checkpoint.MANIFEST)) as file:
+        assert ujson.load(file)["complete"]
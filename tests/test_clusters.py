@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from modules import clusters, scoring
+from tests.conftest import combinations_reference
+
+
+def reference_components(n, pairs):
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    for i, j, _ in pairs:
+        a, b = find(i), find(j)
+        parent[max(a, b)] = min(a, b)
+    return [find(i) for i in range(n)]
+
+
+def test_union_find_merges_chains():
+    sets = clusters.UnionFind(6)
+    sets.union(np.array([4, 3, 1]), np.array([5, 4, 0]))
+    assert sets.roots().tolist() == [0, 0, 2, 3, 3, 3]
+
+
+@pytest.mark.parametrize("threshold", [0.3, 0.5, 0.8])
+def test_components_match_reference(intents, threshold):
+    dataset = intents.dataset
+    matrix = intents.batch_embed(dataset.texts.take(dataset.unlabeled_order))
+    expected = reference_components(
+        len(matrix), combinations_reference(matrix, threshold))
+    roots = clusters.components(
+        len(matrix), scoring.iter_pair_blocks(matrix, threshold, block_size=16))
+    assert roots.tolist() == expected
+
+
+def test_cluster_unlabeled(intents):
+    dataset = intents.dataset
+    order = dataset.unlabeled_order
+    ids = dataset.ids.take(order)
+    matrix = intents.batch_embed(dataset.texts.take(order))
+    roots = reference_components(len(matrix), combinations_reference(matrix, 0.4))
+    groups = {}
+    for input_id, root in zip(ids, roots):
+        groups.setdefault(root, set()).add(input_id)
+    expected = sorted(sorted(group) for group in groups.values() if len(group) >= 2)
+
+    result = intents.cluster_unlabeled(0.4, block_size=16)
+    assert sorted(sorted(member["id"] for member in cluster["members"])
+                  for cluster in result) == expected
+    sizes = [cluster["size"] for cluster in result]
+    assert sizes == sorted(sizes, reverse=True)
+    for cluster in result:
+        assert cluster["representative"] == cluster["members"][0]
+    assert intents.cluster_unlabeled(0.4, min_size=len(ids) + 1) == []
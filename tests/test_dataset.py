@@ -0,0 +1,62 @@
+import numpy as np
+from modules import intent
+from modules.dataset import NO_LABEL, UNLABELED, Dataset, StringTable
+
+EXPORT = {"inputs": {
+    "a": {"input": "héllo", "classifier": {"label": "greet"}},
+    "b": {"input": "bye", "classifier": {"label": "leave"}},
+    "c": {"input": "", "classifier": {"label": None}},
+    "d": {"input": "hi 👋", "classifier": {"label": "greet"}},
+    "e": {"input": "what", "classifier": {"label": ""}},
+}}
+
+
+def test_string_table_round_trips():
+    strings = ["", "a", "héllo", "👋 wave", ""]
+    table = StringTable.from_strings(strings)
+    assert len(table) == 5
+    assert list(table) == strings
+    assert [table[i] for i in range(5)] == strings
+    assert table.take([4, 2, 2]) == ["", "héllo", "héllo"]
+    assert table.nbytes == len("".join(strings).encode()) + 6 * 8
+
+
+def test_columns_of_an_export():
+    dataset = Dataset.from_json(EXPORT)
+    assert len(dataset) == 5
+    assert list(dataset.ids) == list("abcde")
+    assert dataset.labels == ["greet", "leave"]
+    assert dataset.codes.tolist() == [0, 1, UNLABELED, 0, NO_LABEL]
+    # Grouped per label, export order within a label.
+    assert dataset.labeled_order.tolist() == [0, 3, 1]
+    assert dataset.label_range(0) == (0, 2) and dataset.label_range(1) == (2, 3)
+    assert dataset.unlabeled_order.tolist() == [2]
+    assert [dataset.label(i) for i in range(5)] == ["greet", "leave", None,
+                                                   "greet", ""]
+    assert dataset.row_labels(dataset.labeled_order) == ["greet", "greet", "leave"]
+    assert dataset.position("d") == 3
+
+
+def test_fingerprint_follows_the_content():
+    fingerprint = Dataset.from_json(EXPORT).fingerprint()
+    assert Dataset.from_json(EXPORT).fingerprint() == fingerprint
+    for field, value in (("input", "hello"), ("classifier", {"label": "leave"})):
+        changed = {"inputs": dict(EXPORT["inputs"])}
+        changed["inputs"]["a"] = dict(changed["inputs"]["a"], **{field: value})
+        assert Dataset.from_json(changed).fingerprint() != fingerprint
+
+
+def test_intent_lookups_use_the_dataset():
+    intents = intent.Intent(Dataset.from_json(EXPORT))
+    assert intents.get_label("b") == "leave" and intents.get_label("c") is None
+    assert intents.get_input("d") == "hi 👋"
+    assert intents.get_labeled_inputs() == {
+        "greet": [("a", "héllo"), ("d", "hi 👋")], "leave": [("b", "bye")]}
+    assert intents.get_unlabled_inputs() == [("c", "")]
+
+
+def test_empty_dataset():
+    dataset = Dataset.from_json({"inputs": {}})
+    assert len(dataset) == 0 and dataset.labels == []
+    assert dataset.labeled_order.dtype.kind == "i"
+    assert np.array_equal(dataset.label_bounds, [0])
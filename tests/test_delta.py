@@ -0,0 +1,121 @@
+import copy
+import numpy as np
+import pytest
+from modules import delta, intent
+from modules.dataset import Dataset
+from modules.encoder import HashingEncoder
+
+
+def edited(export: dict) -> dict:
+    """A later revision: relabeled, edited, removed and added inputs.
+    """
+    export = copy.deepcopy(export)
+    inputs = export["inputs"]
+    ids = list(inputs)
+    labels = sorted({value["classifier"]["label"] for value in inputs.values()
+                     if value["classifier"]["label"]})
+    for step, input_id in enumerate(ids[::9]):
+        # Moves inputs to another label group, and in and out of unlabeled.
+        inputs[input_id]["classifier"]["label"] = (
+            None if step % 4 == 0 else labels[step % len(labels)])
+    for input_id in ids[5::23]:
+        inputs[input_id]["input"] += " edited"
+    for input_id in ids[7::31]:
+        del inputs[input_id]
+    for i in range(12):
+        inputs[f"new_{i}"] = {"input": inputs[ids[i * 3]]["input"] + " again",
+                              "classifier": {"label": [None, labels[0]][i % 2]}}
+    return export
+
+
+def assert_same_results(actual: list, expected: list):
+    def keys(pair):
+        return ([item for item in pair.items() if item[0] != "score"]
+                if isinstance(pair, dict) else list(pair[:2]))
+
+    def score(pair):
+        return pair["score"] if isinstance(pair, dict) else pair[2]
+
+    assert [keys(pair) for pair in actual] == [keys(pair) for pair in expected]
+    np.testing.assert_allclose([score(pair) for pair in actual],
+                               [score(pair) for pair in expected], atol=1e-5)
+
+
+@pytest.mark.parametrize("mode", ["labeled", "unlabeled"])
+def test_incremental_run_matches_full_run_after_relabel(export, tmp_path, mode):
+    store = delta.RevisionStore(str(tmp_path))
+    later = edited(export)
+
+    def run(data, bot_id):
+        intents = intent.Intent(Dataset.from_json(data), bot_id=bot_id,
+                                revisions=store)
+        if mode == "labeled":
+            return intents.compute_labeled_scores_fast(0.4)
+        return intents.compute_unlabeled_scores(0.3)
+
+    assert_same_results(run(export, "bot"), run(export, None))
+    incremental = run(later, "bot")
+    assert_same_results(incremental, run(later, None))
+    # And once more without changes, everything carried over.
+    assert_same_results(run(later, "bot"), incremental)
+
+
+def test_revisions_are_kept_per_encoder(tmp_path):
+    store = delta.RevisionStore(str(tmp_path))
+    texts = [f"text {i} about {i % 5}" for i in range(40)]
+    ids = [f"id{i}" for i in range(40)]
+    embedded = []
+
+    def embed(sentences):
+        embedded.append(len(sentences))
+        return HashingEncoder(32).embed(sentences)
+
+    def run(encoder):
+        return delta.compare(store, "bot", "unlabeled", ids, texts, [""] * 40,
+                             embed, 0.3, encoder=encoder)
+
+    first = run("model-a")
+    run("model-a")
+    assert embedded == [40]
+    # Same dimensions, another model: nothing of model-a is reused.
+    second = run("model-b")
+    assert embedded == [40, 40]
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_strings_are_stored_without_padding(tmp_path):
+    store = delta.RevisionStore(str(tmp_path))
+    texts = ["é" * 5000] + [f"short {i}" for i in range(99)]
+    ids = [f"id{i}" for i in range(100)]
+    delta.compare(store, "bot", "unlabeled", ids, texts, [""] * 100,
+                  HashingEncoder(8).embed, 0.3)
+    with np.load(store.path("bot", "unlabeled"), allow_pickle=False) as data:
+        assert data["texts_data"].nbytes == sum(len(text.encode()) for text in texts)
+    revision = store.load("bot", "unlabeled")
+    assert list(revision.ids) == ids and list(revision.texts) == texts
+
+
+def test_loads_revisions_with_fixed_width_strings(tmp_path):
+    store = delta.RevisionStore(str(tmp_path))
+    texts = [f"text {i} about {i % 5}" for i in range(20)]
+    ids = [f"id{i}" for i in range(20)]
+    embedded = []
+
+    def embed(sentences):
+        embedded.append(len(sentences))
+        return HashingEncoder(32).embed(sentences)
+
+    pairs = delta.compare(store, "bot", "unlabeled", ids, texts, [""] * 20,
+                          embed, 0.3)
+    revision = store.load("bot", "unlabeled")
+    with open(store.path("bot", "unlabeled"), "wb") as f:
+        np.savez(f, ids=np.asarray(ids), texts=np.asarray(texts),
+                 labels=np.asarray([""] * 20), matrix=revision.matrix,
+                 threshold=np.array(0.3), rows=pairs[0], cols=pairs[1],
+                 scores=pairs[2])
+    again = delta.compare(store, "bot", "unlabeled", ids, texts, [""] * 20,
+                          embed, 0.3)
+    assert embedded == [20]
+    for a, b in zip(pairs, again):
+        np.testing.assert_array_equal(a, b)
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import numpy as np
+import pytest
+import requests
+from modules import encoder as encoder_module, intent
+from modules.encoder import EmbeddingClient, EncoderError, HashingEncoder
+from scripts import fake_encoder
+
+SENTENCES = [f"sentence number {i} about topic {i % 7}" for i in range(50)]
+
+
+@pytest.fixture
+def server():
+    def start(statuses=()):
+        server = fake_encoder.serve(0, 32, statuses=statuses)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    servers = []
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def client(server, **options) -> EmbeddingClient:
+    options = dict(dict(batch_size=7, max_in_flight=4, backoff=0.01), **options)
+    return EmbeddingClient(f"http://127.0.0.1:{server.server_port}/", **options)
+
+
+def test_batches_come_back_in_order(server):
+    fake = server()
+    encoder = client(fake)
+    matrix = encoder.embed(SENTENCES)
+    np.testing.assert_allclose(matrix, HashingEncoder(32).embed(SENTENCES), atol=1e-6)
+    assert sorted(fake.batches) == [1] + [7] * 7
+    encoder.close()
+
+
+def test_async_batches_come_back_in_order(server):
+    encoder = client(server(), batch_size=3)
+    matrix = asyncio.run(encoder.embed_async(SENTENCES))
+    np.testing.assert_allclose(matrix, HashingEncoder(32).embed(SENTENCES), atol=1e-6)
+    encoder.close()
+
+
+@pytest.mark.parametrize("statuses", [[429], [503, 500], [502, 504, 429]])
+def test_retries_throttling_and_server_errors(server, statuses):
+    fake = server(statuses)
+    encoder = client(fake, batch_size=100)
+    matrix = encoder.embed(SENTENCES)
+    np.testing.assert_allclose(matrix, HashingEncoder(32).embed(SENTENCES), atol=1e-6)
+    assert fake.batches == [len(SENTENCES)]
+    encoder.close()
+
+
+def test_gives_up_after_the_retries(server):
+    fake = server([500] * 3)
+    encoder = client(fake, batch_size=100, retries=2)
+    with pytest.raises(EncoderError):
+        encoder.embed(SENTENCES)
+    assert fake.batches == []
+    encoder.close()
+
+
+def test_client_errors_are_not_retried(server):
+    fake = server([400])
+    encoder = client(fake, batch_size=100)
+    with pytest.raises(requests.HTTPError):
+        encoder.embed(SENTENCES)
+    encoder.close()
+
+
+class RecordingCache():
+    """Records the threads the embedding cache is used from.
+    """
+
+    def __init__(self):
+        self.threads = []
+
+    def get_many(self, sentences):
+        self.threads.append(threading.get_ident())
+        return np.zeros(len(sentences), dtype=bool), None
+
+    def put_many(self, sentences, matrix):
+        self.threads.append(threading.get_ident())
+
+
+def test_batch_embed_async_keeps_the_cache_off_the_event_loop():
+    cache = RecordingCache()
+    intents = intent.Intent(cache=cache)
+
+    async def embed():
+        return threading.get_ident(), await intents.batch_embed_async(
+            SENTENCES + SENTENCES[:5])
+
+    loop_thread, matrix = asyncio.run(embed())
+    assert len(cache.threads) == 2 and loop_thread not in cache.threads
+    np.testing.assert_allclose(matrix[-5:], matrix[:5])
+    assert intents.embed_stats["unique"] == len(SENTENCES)
+
+
+def test_hashing_embeddings_are_deterministic_unit_rows():
+    encoder = HashingEncoder(64)
+    matrix = encoder.embed(SENTENCES)
+    assert matrix.shape == (len(SENTENCES), 64) and matrix.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(matrix, axis=1), 1, atol=1e-6)
+    np.testing.assert_array_equal(HashingEncoder(64).embed(SENTENCES), matrix)
+    assert encoder.embed([]).shape == (0, 64)
+    close, far = encoder.embed(["book a flight to paris",
+                                "book a flight to london", "what's the weather"])[1:]
+    anchor = encoder.embed(["book a flight to paris"])[0]
+    assert np.inner(anchor, close) > np.inner(anchor, far)
+
+
+def test_encoder_names_separate_embedding_spaces():
+    assert HashingEncoder(64).name != HashingEncoder(32).name
+    assert EmbeddingClient("http://a/").name != EmbeddingClient("http://b/").name
+
+
+def test_default_encoder_follows_the_environment(monkeypatch):
+    monkeypatch.setattr(encoder_module, "_encoders", {})
+    monkeypatch.setenv("ENCODER", "hashing")
+    monkeypatch.setenv("ENCODER_DIMENSIONS", "16")
+    backend = encoder_module.default_encoder()
+    assert isinstance(backend, HashingEncoder) and backend.dimensions == 16
+    assert encoder_module.default_encoder() is backend
+    monkeypatch.setenv("ENCODER", "remote")
+    assert isinstance(encoder_module.default_encoder("key"), EmbeddingClient)
+    monkeypatch.setenv("ENCODER", "word2vec")
+    with pytest.raises(ValueError):
+        encoder_module.default_encoder()
+
+
+@pytest.mark.skipif(encoder_module.onnxruntime is not None,
+                    reason="onnxruntime is installed")
+def test_onnx_encoder_needs_onnxruntime(tmp_path):
+    with pytest.raises(ImportError):
+        encoder_module.OnnxEncoder(str(tmp_path))
+
+
+class Encoding():
+    def __init__(self, ids):
+        self.ids = ids
+        self.attention_mask = [1 if i else 0 for i in ids]
+        self.type_ids = [0] * len(ids)
+
+
+class Tokens():
+    """Tokenizes into word lengths, padded with 0.
+    """
+
+    def encode_batch(self, batch):
+        rows = [[len(word) for word in sentence.split()] for sentence in batch]
+        width = max(map(len, rows))
+        return [Encoding(row + [0] * (width - len(row))) for row in rows]
+
+
+class Session():
+    """Token embeddings [id, 1], the mean pool over the real tokens is then
+    [mean word length, 1].
+    """
+
+    def run(self, outputs, feed):
+        assert set(feed) == {"input_ids", "attention_mask"}
+        ids = feed["input_ids"].astype(np.float32)
+        return [np.stack([ids, np.ones_like(ids)], axis=-1)]
+
+
+def test_onnx_encoder_mean_pools_the_real_tokens():
+    onnx = encoder_module.OnnxEncoder.__new__(encoder_module.OnnxEncoder)
+    onnx.tokenizer, onnx.session = Tokens(), Session()
+    onnx.inputs = {"input_ids", "attention_mask"}
+    onnx._lock = threading.Lock()
+    matrix = onnx.embed(["aa bbbb", "ccc", "d e f g"], batch_size=2)
+    expected = encoder_module.l2_normalize([[3, 1], [3, 1], [1, 1]])
+    np.testing.assert_allclose(matrix, expected, atol=1e-6)
@@ -0,0 +1,110 @@
+import asyncio
+import io
+import json
+import pytest
+from fastapi.testclient import TestClient
+from modules import ingest
+from modules.dataset import Dataset
+
+EXPORT = {
+    "bot": {"name": "tricky } ] \" \\ {", "tags": [1, 2.5, None, True, {"a": []}],
+            "quoted \"key\"": "\\\"", "nested": [[[]]], "empty": {}},
+    "inputs": {
+        "plain": {"input": "hello there", "classifier": {"label": "greeting"}},
+        "unicode": {"input": "héllo wörld ✓ 🤖 日本語", "classifier": {"label": "ünï"}},
+        "escapes": {"input": "a \"quote\", a \\ backslash\n\ttab \u0001 é",
+                    "classifier": {"label": None}},
+        "braces": {"input": "} { ] [ , :", "classifier": {"label": ""},
+                   "extra": {"ignored": ["}", "{"]}},
+        "ké\"y": {"input": "", "classifier": {"label": "greeting", "score": 0.5}},
+    },
+    "version": 3,
+    "trailing": None,
+}
+
+
+def expected_records(export: dict) -> list:
+    return [(input_id, value["classifier"]["label"], value["input"])
+            for input_id, value in export["inputs"].items()]
+
+
+def parse(data, chunk_size: int) -> list:
+    return list(ingest.iter_inputs(io.BytesIO(data), chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 16, 64, 1 << 16])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_every_chunk_boundary(chunk_size, indent):
+    data = json.dumps(EXPORT, ensure_ascii=False, indent=indent).encode("utf-8")
+    assert parse(data, chunk_size) == expected_records(EXPORT)
+
+
+def test_ascii_escaped_export():
+    data = json.dumps(EXPORT, ensure_ascii=True).encode("ascii")
+    assert parse(data, 3) == expected_records(EXPORT)
+
+
+@pytest.mark.parametrize("export", [
+    {"inputs": {}},
+    {"inputs": {}, "bot": 1},
+    {"bot": "x", "inputs": {"a": {"input": "x", "classifier": {"label": "l"}}}},
+    {"a": 1, "b": -2.5e3, "c": True, "d": None, "inputs": {}},
+    {"inputs": {}, "last": 12345},
+])
+def test_top_level_values_around_inputs(export):
+    for chunk_size in (1, 4, 1 << 16):
+        assert parse(json.dumps(export).encode(), chunk_size) == expected_records(export)
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"[]",
+    b'{"inputs": {"a": {"input": "x", "classifier": {"label": null}}}',
+    b'{"inputs": {"a": {"input": "x", "classifier": {"label": null}}}} trailing',
+    b'{"inputs" {}}',
+    b'{"inputs": {"a" {"input": "x"}}}',
+    b'{"inputs": {"a": {"input": "x", "classifier": {"label": null}} "b": {}}}',
+    b'{"inputs": {"a": {"input": "unterminated}}}',
+    b'{"bot": {"unclosed": [1, 2}',
+    b'{"inputs": []}',
+])
+def test_malformed_exports_raise_value_error(data):
+    for chunk_size in (1, 1 << 16):
+        with pytest.raises(ValueError):
+            parse(data, chunk_size)
+
+
+@pytest.mark.parametrize("entry", [
+    {"input": 5, "classifier": {"label": "a"}},
+    {"input": "x", "classifier": {"label": ["a"]}},
+    {"input": None, "classifier": {"label": None}},
+])
+def test_wrong_types_raise_value_error(entry):
+    data = json.dumps({"inputs": {"a": entry}}).encode()
+    with pytest.raises(ValueError):
+        Dataset.from_records(parse(data, 4))
+
+
+def test_read_dataset_from_async_chunks():
+    data = json.dumps(EXPORT).encode()
+
+    async def chunks():
+        for i in range(0, len(data), 5):
+            yield data[i:i + 5]
+
+    dataset = asyncio.run(ingest.read_dataset(chunks()))
+    assert [(dataset.ids[i], dataset.label(i), dataset.texts[i])
+            for i in range(len(dataset))] == expected_records(EXPORT)
+
+
+@pytest.mark.parametrize("body", [
+    b'{"inputs": {"a": {"input": 5, "classifier": {"label": "x"}}}}',
+    b'{"inputs": {"a": {"input": "x"}}}',
+    b'{"inputs": {"a": "x"}}',
+    b'{"inputs": {',
+])
+def test_api_rejects_bad_exports_with_400(body):
+    import main
+    client = TestClient(main.app)
+    response = client.post("/inputs/compare/labeled", content=body)
+    assert response.status_code == 400
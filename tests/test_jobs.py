@@ -0,0 +1,133 @@
+import io
+import os
+import threading
+import ujson
+import pytest
+from benchmarks import exports
+from modules import intent, jobs, results
+from modules.dataset import Dataset
+
+
+@pytest.fixture
+def export() -> dict:
+    # Duplicated texts score 1.0, there are pairs at the default threshold.
+    return exports.generate_export(300, labels=8, duplicates=0.1, seed=5)
+
+
+@pytest.fixture
+def dataset(export) -> Dataset:
+    return Dataset.from_json(export)
+
+
+@pytest.fixture
+def export_file(export, tmp_path) -> str:
+    path = str(tmp_path / "export.json")
+    with open(path, "w") as file:
+        ujson.dump(export, file)
+    return path
+
+
+def test_parse_settings():
+    assert jobs.parse_settings('{"compare": "labeled"}') == {"compare": "labeled"}
+    assert jobs.parse_settings({"compare": "unlabeled", "format": "npz"})["format"] == "npz"
+    for settings in ({}, {"compare": "both"}, {"compare": "labeled", "format": "csv"}):
+        with pytest.raises(ValueError):
+            jobs.parse_settings(ujson.dumps(settings))
+
+
+def expected(intents, compare: str):
+    if compare == "labeled":
+        return intents.compute_labeled_scores_fast()
+    return [list(pair) for pair in intents.compute_unlabeled_scores()]
+
+
+@pytest.mark.parametrize("compare", jobs.COMPARES)
+@pytest.mark.parametrize("format", ["json", "json-stream", "ndjson"])
+def test_run_writes_the_json_result(dataset, export_file, tmp_path, compare, format):
+    result_file = str(tmp_path / "result")
+    summary = jobs.run({"compare": compare, "format": format}, export_file, result_file)
+    with open(result_file, "rb") as file:
+        data = file.read()
+    if format == "ndjson":
+        output = [ujson.loads(line) for line in data.splitlines()]
+    else:
+        output = ujson.loads(data)
+    assert output == expected(intent.Intent(dataset), compare)
+    assert summary["pairs"] == len(output) > 0
+    assert summary["metrics"]["stages"]["parse"] > 0
+
+
+def test_run_writes_tables(dataset, export_file, tmp_path):
+    result_file = str(tmp_path / "result")
+    summary = jobs.run({"compare": "labeled", "format": "npz"}, export_file, result_file)
+    table = results.PairTable.load(result_file)
+    assert len(table) == summary["pairs"] == len(intent.Intent(dataset)
+                                                 .compute_labeled_scores_fast())
+    assert table.labels.tolist() == dataset.labels
+
+
+def test_result_is_written_while_scoring(export_file, tmp_path, monkeypatch):
+    result_file = str(tmp_path / "result")
+    sizes = []
+    unlabeled_blocks = intent.Intent.unlabeled_blocks
+
+    def watched(self, *args, **kwargs):
+        ids, sentences, blocks = unlabeled_blocks(self, *args, block_size=8)
+
+        def blocks_watched():
+            for block in blocks:
+                sizes.append(os.path.getsize(result_file))
+                yield block
+
+        return ids, sentences, blocks_watched()
+
+    monkeypatch.setattr(intent.Intent, "unlabeled_blocks", watched)
+    jobs.run({"compare": "unlabeled", "format": "ndjson"}, export_file, result_file)
+    # Each size is taken before the block's pairs are written.
+    assert len(sizes) > 2 and sizes == sorted(sizes) and sizes[-1] > 0
+
+
+def test_checkpoints_are_opt_in(export_file, tmp_path, monkeypatch):
+    directory = tmp_path / "checkpoints"
+    monkeypatch.setenv("CHECKPOINT_DIR", str(directory))
+    result_file = str(tmp_path / "result")
+    jobs.run({"compare": "unlabeled"}, export_file, result_file)
+    assert not directory.exists()
+    jobs.run({"compare": "unlabeled", "checkpoint": True}, export_file, result_file)
+    assert os.listdir(directory)
+
+
+@pytest.mark.parametrize("processes", [0, 2])
+def test_runner_spools_and_cleans_up(dataset, export, tmp_path, processes):
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    runner = jobs.JobRunner(processes, directory=str(spool))
+    outputs = {}
+
+    def handle(compare):
+        summary, result = runner.handle({"compare": compare},
+                                        io.BytesIO(ujson.dumps(export).encode()))
+        with result:
+            outputs[compare] = (summary, ujson.loads(result.read()))
+
+    try:
+        threads = [threading.Thread(target=handle, args=(compare,))
+                   for compare in jobs.COMPARES]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(120)
+    finally:
+        runner.close()
+    for compare in jobs.COMPARES:
+        summary, output = outputs[compare]
+        assert output == expected(intent.Intent(dataset), compare)
+        assert summary["pairs"] == len(output)
+    assert os.listdir(spool) == []
+
+
+def test_failed_jobs_leave_no_spool_files(tmp_path):
+    runner = jobs.JobRunner(0, directory=str(tmp_path))
+    with pytest.raises(ValueError):
+        runner.handle({"compare": "labeled"}, io.BytesIO(b'{"inputs": [1, 2]}'))
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,166 @@
+import asyncio
+import io
+import json
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from modules import jq
+
+KEY = "secret"
+
+
+class StubJobQueue(ThreadingHTTPServer):
+    """A job queue service in memory. Jobs finish after `polls` status
+    requests, their result is the uploaded payload.
+    """
+
+    def __init__(self, polls: int = 3):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.polls = polls
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        queue = url.path.split("/")[-1]
+        if not url.path.startswith("/new/"):
+            return self.answer(404, {"error": "not found"})
+        if self.headers.get("Ocp-Apim-Subscription-Key") != KEY:
+            return self.answer(401, {"error": "unauthorized"})
+        with self.server.lock:
+            job_id = f"job-{len(self.server.jobs)}"
+            self.server.jobs[job_id] = {
+                "job_id": job_id, "queue": queue, "status": "queued", "polls": 0,
+                "settings": dict(parse_qsl(url.query)), "payload": self.body(),
+                "chunked": self.headers.get("Transfer-Encoding") == "chunked",
+                "result_params": {"download_link": f"{self.server.url}/results/{job_id}"}}
+        self.answer(200, {"values": [{"job_id": job_id}]})
+
+    def do_GET(self):
+        kind, _, job_id = self.path.strip("/").partition("/")
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            return self.answer(404, {"error": "no such job"})
+        if kind == "results":
+            # Download links are pre-signed, the key must not be sent there.
+            if "Ocp-Apim-Subscription-Key" in self.headers:
+                return self.answer(400, {"error": "key leaked"})
+            return self.answer(200, job["payload"])
+        with self.server.lock:
+            job["polls"] += 1
+            if job["polls"] >= self.server.polls:
+                job["status"] = "Success"
+            record = {key: job[key] for key in ("job_id", "status", "result_params")}
+        self.answer(200, {"values": [record]})
+
+    def body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b""
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            chunk = self.rfile.read(size + 2)[:size]
+            if not size:
+                return body
+            body += chunk
+
+    def answer(self, status: int, value):
+        body = value if isinstance(value, bytes) else json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def service():
+    server = StubJobQueue()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(service):
+    with jq.JobQueueClient(service.url, KEY, pool_size=4, timeout=5) as client:
+        yield client
+
+
+EXPORT = {"bot": {"name": "x"},
+          "inputs": {f"i{k}": {"input": f"text {k} é \"q\"",
+                               "classifier": {"label": None}} for k in range(500)}}
+
+
+def test_submit_streams_the_payload(client, service):
+    job_id = client.submit(EXPORT, "dev", {"compare": "labeled"})
+    job = service.jobs[job_id]
+    assert job["chunked"]
+    assert json.loads(job["payload"]) == EXPORT
+    assert job["queue"] == "dev" and job["settings"] == {"compare": "labeled"}
+
+
+def test_iter_json_matches_json_dumps():
+    chunks = list(jq.iter_json(EXPORT, chunk_size=256))
+    assert len(chunks) > 1
+    assert json.loads(b"".join(chunks)) == EXPORT
+    assert json.loads(b"".join(jq.iter_json([1, {"a": [2]}, "b"]))) == [1, {"a": [2]}, "b"]
+
+
+def test_wait_and_download(client, service):
+    job_id = client.submit(b'{"inputs": {}}')
+    job = client.wait(job_id, timeout=5, interval=0.01)
+    assert job["status"] == "Success" and service.jobs[job_id]["polls"] == 3
+    output = io.BytesIO()
+    assert client.download(job=job, file=output) == len(b'{"inputs": {}}')
+    assert output.getvalue() == b'{"inputs": {}}'
+    assert client.link(job_id).endswith(f"/results/{job_id}")
+
+
+def test_wait_many(client):
+    job_ids = [client.submit({"inputs": {}}) for _ in range(5)]
+    jobs = client.wait_many(job_ids + job_ids[:1], timeout=5, interval=0.01)
+    assert sorted(jobs) == sorted(job_ids)
+    assert all(jq.is_final(job["status"]) for job in jobs.values())
+
+
+def test_wait_times_out(client, service):
+    service.polls = 1000
+    job_id = client.submit({"inputs": {}})
+    with pytest.raises(jq.JobQueueError):
+        client.wait(job_id, timeout=0.1, interval=0.01)
+
+
+def test_errors_raise_job_queue_error(service):
+    with jq.JobQueueClient(service.url, "wrong", timeout=5) as client:
+        with pytest.raises(jq.JobQueueError):
+            client.submit({"inputs": {}})
+        with pytest.raises(jq.JobQueueError):
+            client.status("no-such-job")
+
+
+def test_async_twins(client, service):
+    async def run():
+        job_ids = await asyncio.gather(*(client.submit_async({"n": n})
+                                         for n in range(3)))
+        jobs = await client.wait_many_async(job_ids, timeout=5, interval=0.01)
+        output = io.BytesIO()
+        await client.download_async(file=output, job=jobs[job_ids[2]])
+        return job_ids, jobs, output.getvalue(), await client.status_async(job_ids[0])
+
+    job_ids, jobs, payload, status = asyncio.run(run())
+    assert set(jobs) == set(job_ids)
+    assert json.loads(payload) == {"n": 2}
+    assert status == "Success"
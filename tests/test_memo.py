@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+from modules import intent, memo
+from modules.dataset import Dataset
+from modules.memo import ResultCache
+
+
+def pairs_of(scores: list) -> tuple:
+    """Pairs `(k, k + 1)` with the given scores, in emission order.
+    """
+    rows = np.arange(len(scores), dtype=np.int64)
+    return rows, rows + 1, np.asarray(scores, dtype=np.float32)
+
+
+def as_list(pairs: tuple) -> list:
+    return [column.tolist() for column in pairs]
+
+
+SCORES = [0.5, 0.9, 0.4, 0.7, 0.9, 0.6]
+
+
+def test_key_depends_on_every_part():
+    key = ResultCache.key("fingerprint", "hashing", "float32", "labeled")
+    assert key == ResultCache.key("fingerprint", "hashing", "float32", "labeled")
+    assert key != ResultCache.key("fingerprint", "hashing", "int8", "labeled")
+    assert key != ResultCache.key("fingerprint", "hashing", "float32", "unlabeled")
+
+
+def test_stricter_thresholds_are_slices_in_emission_order():
+    cache = ResultCache()
+    cache.put("a", 0.4, pairs_of(SCORES))
+    assert as_list(cache.get("a", 0.4)) == as_list(pairs_of(SCORES))
+    rows, cols, scores = cache.get("a", 0.65)
+    assert rows.tolist() == [1, 3, 4]
+    assert scores.tolist() == pytest.approx([0.9, 0.7, 0.9])
+    # Scores equal to the threshold are kept, as in the scoring.
+    assert cache.get("a", 0.9)[0].tolist() == [1, 4]
+    assert len(cache.get("a", 0.95)[2]) == 0
+    assert cache.stats["hits"] == 4 and cache.stats["misses"] == 0
+
+
+def test_looser_thresholds_are_misses():
+    cache = ResultCache()
+    assert cache.get("a", 0.5) is None
+    cache.put("a", 0.5, pairs_of([0.5, 0.8]))
+    assert cache.get("a", 0.4) is None
+    # A stricter result doesn't replace a looser one.
+    cache.put("a", 0.7, pairs_of([0.8]))
+    assert cache.get("a", 0.5)[0].tolist() == [0, 1]
+    cache.put("a", 0.3, pairs_of([0.3, 0.5, 0.8]))
+    assert cache.get("a", 0.3)[0].tolist() == [0, 1, 2]
+    assert cache.stats["misses"] == 2
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResultCache(max_entries=2)
+    cache.put("a", 0.5, pairs_of([0.5]))
+    cache.put("b", 0.5, pairs_of([0.5]))
+    assert cache.get("a", 0.5) is not None
+    cache.put("c", 0.5, pairs_of([0.5]))
+    assert cache.get("b", 0.5) is None
+    assert cache.get("a", 0.5) is not None and cache.get("c", 0.5) is not None
+    assert cache.stats["entries"] == 2
+
+
+def test_entries_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(memo.time, "monotonic", lambda: now[0])
+    cache = ResultCache(ttl=10)
+    cache.put("a", 0.5, pairs_of([0.5]))
+    now[0] += 5
+    assert cache.get("a", 0.5) is not None
+    now[0] += 10
+    assert cache.get("a", 0.5) is None
+    assert cache.stats["entries"] == 0
+
+
+def test_size_is_bounded():
+    pairs = pairs_of(SCORES)
+    size = memo.Entry(0.4, pairs).nbytes
+    cache = ResultCache(max_bytes=2 * size)
+    for key in "abc":
+        cache.put(key, 0.4, pairs)
+    assert cache.stats["entries"] == 2 and cache.stats["bytes"] == 2 * size
+    assert cache.get("a", 0.4) is None
+    # A result larger than the whole cache isn't kept.
+    small = ResultCache(max_bytes=size - 1)
+    small.put("a", 0.4, pairs)
+    assert small.stats["entries"] == 0
+
+
+def test_recording_stores_finished_runs_only():
+    cache = ResultCache()
+    blocks = [pairs_of([0.5, 0.6]), pairs_of([]), pairs_of([0.9])]
+    assert len(list(cache.recording("a", 0.5, iter(blocks)))) == 3
+    assert cache.get("a", 0.5)[2].tolist() == pytest.approx([0.5, 0.6, 0.9])
+    stopped = cache.recording("b", 0.5, iter(blocks))
+    next(stopped)
+    stopped.close()
+    assert cache.get("b", 0.5) is None
+    list(cache.recording("c", 0.5, iter(())))
+    assert len(cache.get("c", 0.5)[2]) == 0
+
+
+def test_default_cache_is_configured_through_env(monkeypatch):
+    monkeypatch.setattr(memo, "_default_cache", None)
+    monkeypatch.setenv("RESULT_CACHE_ENTRIES", "0")
+    assert memo.default_cache() is None
+    monkeypatch.setenv("RESULT_CACHE_ENTRIES", "3")
+    monkeypatch.setenv("RESULT_CACHE_TTL", "60")
+    monkeypatch.setenv("RESULT_CACHE_MAX_MB", "1")
+    cache = memo.default_cache()
+    assert (cache.max_entries, cache.ttl, cache.max_bytes) == (3, 60, 1 << 20)
+    assert memo.default_cache() is cache
+
+
+def test_intent_reuses_results_for_stricter_thresholds(dataset, monkeypatch):
+    cache = ResultCache()
+    intents = intent.Intent(dataset, result_cache=cache)
+    expected = {threshold: intent.Intent(dataset).compute_labeled_scores_fast(threshold)
+                for threshold in (0.4, 0.5)}
+    assert intents.compute_labeled_scores_fast(0.4) == expected[0.4]
+
+    def no_embedding(*args, **kwargs):
+        raise AssertionError("memoized results aren't embedded again")
+
+    monkeypatch.setattr(intents, "batch_embed", no_embedding)
+    assert intents.compute_labeled_scores_fast(0.5) == expected[0.5]
+    assert cache.stats["hits"] == 1
+    # The unlabeled compare has an entry of its own.
+    with pytest.raises(AssertionError):
+        intents.compute_unlabeled_scores(0.5)
+
+
+def test_intent_results_are_keyed_by_content(export):
+    cache = ResultCache()
+    intent.Intent(Dataset.from_json(export),
+                  result_cache=cache).compute_labeled_scores_fast(0.4)
+    edited = dict(export, inputs=dict(export["inputs"]))
+    key = next(iter(edited["inputs"]))
+    edited["inputs"][key] = dict(edited["inputs"][key], input="something else")
+    intent.Intent(Dataset.from_json(edited),
+                  result_cache=cache).compute_labeled_scores_fast(0.4)
+    assert cache.stats["hits"] == 0 and cache.stats["entries"] == 2
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from modules import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch) -> list:
+    """A registry of its own, metrics created in the test aren't rendered
+    by the app afterwards.
+    """
+    registry = []
+    monkeypatch.setattr(metrics, "_registry", registry)
+    return registry
+
+
+def test_render_counters_and_histograms(registry):
+    counter = metrics.Counter("jobs_total", "Jobs.", ("kind",))
+    counter.inc(kind="a")
+    counter.inc(2, kind='say "hi"\n')
+    histogram = metrics.Histogram("wait_seconds", "Waits.", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    assert metrics.render() == (
+        "# HELP jobs_total Jobs.\n"
+        "# TYPE jobs_total counter\n"
+        'jobs_total{kind="a"} 1\n'
+        'jobs_total{kind="say \\"hi\\"\\n"} 2\n'
+        "# HELP wait_seconds Waits.\n"
+        "# TYPE wait_seconds histogram\n"
+        'wait_seconds_bucket{le="0.1"} 2\n'
+        'wait_seconds_bucket{le="1"} 3\n'
+        'wait_seconds_bucket{le="+Inf"} 4\n'
+        "wait_seconds_sum 3.65\n"
+        "wait_seconds_count 4\n")
+
+
+def test_collect_attaches_the_job_numbers(registry):
+    counter = metrics.Counter("rows_total", "Rows.")
+    counter.inc(5)
+    with metrics.collect() as job:
+        counter.inc(3)
+        with metrics.stage("score"):
+            pass
+        timer = metrics.StageTimer("parse")
+        for _ in range(3):
+            with timer:
+                pass
+        timer.record()
+        timer.record()
+    counter.inc(7)
+    assert job["counters"] == {"rows_total": 3}
+    assert set(job["stages"]) == {"score", "parse"}
+
+
+def test_timed_blocks_count_the_emitted_pairs(registry):
+    emitted = metrics.PAIRS_EMITTED
+    registry.append(emitted)
+    blocks = [(np.arange(n), np.arange(n), np.ones(n)) for n in (3, 0, 4)]
+    with metrics.collect() as job:
+        assert list(metrics.timed_blocks(iter(blocks))) == blocks
+    assert job["counters"] == {emitted.name: 7}
+    assert job["stages"]["score"] >= 0
+
+
+def test_disabled_metrics_record_nothing(registry, monkeypatch):
+    counter = metrics.Counter("off_total", "Off.")
+    monkeypatch.setattr(metrics, "_enabled", False)
+    with metrics.collect() as job:
+        counter.inc()
+        with metrics.stage("score"):
+            pass
+    assert job == {"stages": {}, "counters": {}}
+    assert "\noff_total " not in metrics.render()
+
+
+def test_metrics_endpoint(export):
+    import main
+
+    client = TestClient(main.app)
+    assert client.post("/inputs/compare/labeled?threshold=0.4",
+                       json=export).status_code == 200
+    response = client.get("/metrics")
+    assert response.headers["content-type"] == metrics.CONTENT_TYPE
+    assert 'intent_stage_seconds_count{stage="score"}' in response.text
+    assert 'intent_stage_seconds_count{stage="parse"}' in response.text
+    assert "intent_pairs_emitted_total" in response.text
@@ -0,0 +1,51 @@
+import os
+import threading
+import numpy as np
+import pytest
+from modules import parallel, scoring
+from tests.conftest import assert_same_pairs, block_pairs
+
+
+@pytest.fixture(scope="module")
+def matrix():
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((1500, 32)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("labeled", [False, True])
+def test_parallel_matches_single_process(matrix, labeled):
+    codes = (np.random.default_rng(1).integers(0, 12, len(matrix)).astype(np.int32)
+             if labeled else None)
+    expected = block_pairs(scoring.iter_pair_blocks(matrix, 0.4, codes, 128))
+    actual = block_pairs(parallel.iter_pair_blocks(matrix, 0.4, codes, 2, 128))
+    # Shards start off the tile grid, scores may differ in the last bit.
+    assert_same_pairs(actual, expected, tolerance=1e-6)
+
+
+def test_concurrent_calls_share_the_pool_and_leave_the_environment(matrix):
+    before = {name: os.environ.get(name)
+              for name in parallel._BLAS_THREAD_VARIABLES}
+    results = []
+
+    def run():
+        results.append(len(block_pairs(
+            parallel.iter_pair_blocks(matrix, 0.4, workers=2, block_size=64))))
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(results)) == 1 and len(results) == 4
+    assert list(parallel._pools) == [2]
+    assert {name: os.environ.get(name)
+            for name in parallel._BLAS_THREAD_VARIABLES} == before
+
+
+def test_abandoned_iteration_cleans_up(matrix):
+    blocks = parallel.iter_pair_blocks(matrix, 0.4, workers=2, block_size=64)
+    next(blocks)
+    blocks.close()
+    # The pool keeps serving.
+    assert block_pairs(parallel.iter_pair_blocks(matrix[:50], 0.4, workers=2))
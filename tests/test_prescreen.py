@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+from modules import intent, prescreen, scoring
+from modules.prescreen import LabelBounds, iter_pair_blocks
+from tests.conftest import assert_same_pairs, block_pairs
+
+
+@pytest.mark.parametrize("threshold", [0.2, 0.4, 0.6, 0.9])
+@pytest.mark.parametrize("block_size", [8, 1024])
+def test_prescreened_pairs_equal_exact_pairs(intents, threshold, block_size):
+    dataset = intents.dataset
+    order = dataset.labeled_order
+    matrix = intents.batch_embed(dataset.texts.take(order))
+    codes = dataset.codes[order]
+    expected = block_pairs(scoring.iter_pair_blocks(matrix, threshold, codes,
+                                                    block_size))
+    actual = block_pairs(iter_pair_blocks(matrix, threshold, codes,
+                                          dataset.label_bounds,
+                                          block_size=block_size))
+    # Column runs change the shape of the tile multiplies, scores may
+    # differ in the last float32 bit.
+    assert_same_pairs(actual, expected, tolerance=1e-6)
+
+
+def test_bounds_hold_every_score(intents):
+    dataset = intents.dataset
+    order = dataset.labeled_order
+    matrix = intents.batch_embed(dataset.texts.take(order))
+    codes = dataset.codes[order]
+    bounds = LabelBounds.from_matrix(matrix, dataset.label_bounds)
+    scores = matrix @ matrix.T
+    for a in range(len(dataset.labels)):
+        for b in range(len(dataset.labels)):
+            if a != b:
+                block = scores[np.ix_(codes == a, codes == b)]
+                assert block.max() <= bounds.bound[a, b] + 1e-6
+
+
+def test_intent_prescreen_matches_exact(intents):
+    actual = intents.compute_labeled_scores_fast(0.5, prescreen=True)
+    expected = intents.compute_labeled_scores_fast(0.5)
+    assert ([[item for item in pair.items() if item[0] != "score"] for pair in actual]
+            == [[item for item in pair.items() if item[0] != "score"]
+                for pair in expected])
+    np.testing.assert_allclose([pair["score"] for pair in actual],
+                               [pair["score"] for pair in expected], atol=1e-6)
+
+
+def clustered(intents, spread: float = 0.05) -> np.ndarray:
+    """Embed every label around a direction of its own, far from the others,
+    so the pre-screening rules out most label pairs.
+    """
+    dataset = intents.dataset
+    order = dataset.labeled_order
+    generator = np.random.default_rng(7)
+    centers = generator.standard_normal((len(dataset.labels), 64))
+    matrix = (centers[dataset.codes[order]]
+              + spread * generator.standard_normal((len(order), 64)))
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix.astype(np.float32)
+    rows = {text: i for i, text in enumerate(dataset.texts.take(order))}
+    intents.batch_embed = lambda sentences, *args: matrix[[rows[s] for s in sentences]]
+    return matrix
+
+
+def test_clustered_labels_are_mostly_ruled_out(intents):
+    dataset = intents.dataset
+    matrix = clustered(intents)
+    codes = dataset.codes[dataset.labeled_order]
+    bounds = LabelBounds.from_matrix(matrix, dataset.label_bounds)
+    assert bounds.scored_fraction(bounds.reachable(0.5)) < prescreen.MAX_SCORED_FRACTION
+    assert bounds.worthwhile(0.5)
+    expected = block_pairs(scoring.iter_pair_blocks(matrix, 0.3, codes, 64))
+    actual = block_pairs(iter_pair_blocks(matrix, 0.3, codes, dataset.label_bounds,
+                                          bounds, block_size=64))
+    assert expected
+    assert_same_pairs(actual, expected, tolerance=1e-6)
+
+
+def test_intent_prescreens_only_when_worthwhile(intents, monkeypatch):
+    calls = []
+    screened = intent.iter_prescreened_blocks
+
+    def spy(*args, **kwargs):
+        calls.append(args)
+        return screened(*args, **kwargs)
+
+    monkeypatch.setattr(intent, "iter_prescreened_blocks", spy)
+    # Every label of the hashed export can reach every other one.
+    expected = intents.compute_labeled_scores_fast(0.5)
+    assert intents.compute_labeled_scores_fast(0.5, prescreen=True) == expected
+    assert calls == []
+    clustered(intents)
+    actual = intents.compute_labeled_scores_fast(0.5, prescreen=True)
+    assert len(calls) == 1
+    assert len(actual) == len(intents.compute_labeled_scores_fast(0.5))
+
+
+@pytest.mark.parametrize("options", [{"workers": 2}, {"precision": "int8"}])
+def test_prescreen_rejects_parallel_and_quantized_scoring(dataset, options):
+    intents = intent.Intent(dataset, **options)
+    with pytest.raises(ValueError):
+        intents.compute_labeled_scores_fast(0.5, prescreen=True)
+
+
+def test_prescreen_rejected_by_the_api(export, monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+
+    monkeypatch.setenv("SCORING_PRECISION", "int8")
+    response = TestClient(main.app).post(
+        "/inputs/compare/labeled?threshold=0.5&prescreen=true", json=export)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("inputs", [
+    {},
+    {"a": {"input": "only unlabeled", "classifier": {"label": None}}},
+    {"a": {"input": "one labeled", "classifier": {"label": "x"}},
+     "b": {"input": "one unlabeled", "classifier": {"label": None}}},
+])
+def test_label_overview_of_tiny_datasets(inputs):
+    from fastapi.testclient import TestClient
+    import main
+
+    response = TestClient(main.app).post("/inputs/compare/labels?threshold=0.5",
+                                         json={"inputs": inputs})
+    assert response.status_code == 200
+    overview = response.json()
+    labels = sorted({value["classifier"]["label"] for value in inputs.values()
+                     if value["classifier"]["label"]})
+    assert overview["labels"] == labels
+    assert overview["sizes"] == [1] * len(labels)
+    assert overview["candidates"] == [] and overview["pairs_scored"] == 0.0
+    assert len(overview["bound"]) == len(labels)
+
+
+def test_label_overview_lists_reachable_label_pairs(intents):
+    overview = intents.label_overview(0.5)
+    dataset = intents.dataset
+    assert overview["labels"] == dataset.labels
+    assert sum(overview["sizes"]) == len(dataset.labeled_order)
+    pairs = intents.compute_labeled_scores_fast(0.5)
+    found = {tuple(sorted(key for key in pair if key != "score")) for pair in pairs}
+    candidates = {tuple(sorted(pair)) for pair in overview["candidates"]}
+    assert found <= candidates
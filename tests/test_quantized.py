@@ -0,0 +1,93 @@
+import tracemalloc
+import numpy as np
+import pytest
+from modules import intent, quantized, scoring
+from modules.memo import ResultCache
+from tests.conftest import assert_same_pairs, block_pairs
+
+
+@pytest.mark.parametrize("precision", ["float16", "int8"])
+@pytest.mark.parametrize("labeled", [True, False])
+def test_quantized_pairs_equal_exact_pairs(intents, precision, labeled):
+    dataset = intents.dataset
+    order = dataset.labeled_order if labeled else dataset.unlabeled_order
+    matrix = intents.batch_embed(dataset.texts.take(order))
+    codes = dataset.codes[order] if labeled else None
+    threshold = 0.4 if labeled else 0.3
+    table = quantized.QuantizedMatrix.from_matrix(matrix, precision)
+    expected = block_pairs(scoring.iter_pair_blocks(matrix, threshold, codes,
+                                                    block_size=64))
+    actual = block_pairs(quantized.iter_pair_blocks(matrix, table, threshold,
+                                                    codes, block_size=64))
+    # Gathered candidate rows may be summed in another order by BLAS.
+    assert_same_pairs(actual, expected, tolerance=1e-6)
+
+
+@pytest.mark.parametrize("block_size", [64, 100])
+def test_tiles_of_candidates_score_like_float32(block_size):
+    generator = np.random.default_rng(1)
+    matrix = generator.standard_normal((300, 32)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    table = quantized.QuantizedMatrix.from_matrix(matrix, "int8")
+    # Every row is a candidate: the very same tile multiplies.
+    expected = list(scoring.iter_pair_blocks(matrix, -1.0, block_size=block_size))
+    actual = list(quantized.iter_pair_blocks(matrix, table, -1.0,
+                                             block_size=block_size))
+    assert len(actual) == len(expected)
+    for block, reference in zip(actual, expected):
+        for column, reference_column in zip(block, reference):
+            np.testing.assert_array_equal(column, reference_column)
+
+
+def test_a_lone_candidate_row():
+    generator = np.random.default_rng(2)
+    matrix = np.linalg.qr(generator.standard_normal((64, 64)))[0].astype(np.float32)
+    matrix[40] = matrix[3] + 0.05 * matrix[4]
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    table = quantized.QuantizedMatrix.from_matrix(matrix, "int8")
+    actual = block_pairs(quantized.iter_pair_blocks(matrix, table, 0.9,
+                                                    block_size=16))
+    assert [pair[:2] for pair in actual] == [(3, 40)]
+    assert_same_pairs(actual, block_pairs(scoring.iter_pair_blocks(
+        matrix, 0.9, block_size=16)), tolerance=1e-6)
+
+
+def test_peak_memory_stays_at_the_tiles():
+    generator = np.random.default_rng(3)
+    matrix = generator.standard_normal((1024, 32)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    table = quantized.QuantizedMatrix.from_matrix(matrix, "int8")
+    tracemalloc.start()
+    try:
+        for block in quantized.iter_pair_blocks(matrix, table, -1.0,
+                                                block_size=128):
+            del block
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # A row block's pairs (128 x 1024 x 20 bytes) and a few tiles, not a
+    # copy of the candidate rows.
+    assert peak < 16 << 20
+
+
+def scores_of(pairs: list) -> list:
+    return [pair["score"] for pair in pairs]
+
+
+def test_memoized_results_are_kept_per_precision(dataset):
+    cache = ResultCache()
+    exact = intent.Intent(dataset, precision="float32")
+    expected = exact.compute_labeled_scores_fast(0.4)
+    cache_int8 = intent.Intent(dataset, result_cache=cache, precision="int8")
+    approximate = cache_int8.compute_labeled_scores_fast(0.4)
+    cache_float32 = intent.Intent(dataset, result_cache=cache,
+                                  precision="float32")
+    actual = cache_float32.compute_labeled_scores_fast(0.5)
+    assert cache.stats["hits"] == 0
+    assert cache.stats["entries"] == 2
+    assert len(approximate) == len(expected)
+    np.testing.assert_allclose(scores_of(approximate), scores_of(expected),
+                               atol=1e-6)
+    assert actual == [pair for pair in expected if pair["score"] >= 0.5]
+    assert cache_float32.compute_labeled_scores_fast(0.5) == actual
+    assert cache.stats["hits"] == 1
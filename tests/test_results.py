@@ -0,0 +1,76 @@
+import io
+import ujson
+import pytest
+from modules import results
+
+
+BLOCKS = [[{"a": "1", "b": "2", "score": 0.5}], [],
+          [{"a": "3", "b": "4", "score": 0.75}, {"a": "5", "c": "6", "score": 1.0}]]
+
+
+def test_ndjson_writes_one_line_per_result_and_one_chunk_per_block():
+    chunks = list(results.ndjson_chunks(BLOCKS))
+    assert len(chunks) == 2
+    lines = b"".join(chunks).decode().splitlines()
+    assert [ujson.loads(line) for line in lines] == BLOCKS[0] + BLOCKS[2]
+
+
+@pytest.mark.parametrize("blocks", [[], [[]], BLOCKS])
+def test_json_stream_is_one_json_array(blocks):
+    data = b"".join(results.json_array_chunks(blocks))
+    assert ujson.loads(data) == [item for block in blocks for item in block]
+
+
+def test_unknown_streaming_format():
+    with pytest.raises(ValueError):
+        results.chunks(BLOCKS, "csv")
+
+
+def test_stream_blocks_equal_the_collected_result(intents):
+    blocks = list(intents.iter_labeled_scores(0.4, block_size=32))
+    assert len(blocks) > 1
+    assert [item for block in blocks for item in block] == \
+        intents.compute_labeled_scores_fast(0.4, block_size=32)
+    blocks = list(intents.iter_unlabeled_scores(0.3, block_size=16))
+    assert len(blocks) > 1
+    assert [item for block in blocks for item in block] == \
+        intents.compute_unlabeled_scores(0.3, block_size=16)
+
+
+def table_pairs(table: results.PairTable) -> list:
+    return [(table.ids[i], table.ids[j], table.labels[table.codes[i]],
+             table.labels[table.codes[j]], score) for i, j, score
+            in zip(table.rows.tolist(), table.cols.tolist(), table.scores.tolist())]
+
+
+@pytest.mark.parametrize("format", ["npz", "arrow"])
+def test_table_round_trips(intents, format, tmp_path):
+    if format == "arrow":
+        pytest.importorskip("pyarrow")
+    table = intents.compute_labeled_table(0.4)
+    assert len(table)
+    loaded = results.PairTable.load(io.BytesIO(table.to_bytes(format)), format)
+    assert table_pairs(loaded) == table_pairs(table)
+    path = str(tmp_path / f"pairs.{format}")
+    with open(path, "wb") as file:
+        table.save(file, format)
+    assert table_pairs(results.PairTable.load(path, format)) == table_pairs(table)
+
+
+def test_table_holds_the_labeled_result(intents):
+    table = intents.compute_labeled_table(0.4)
+    expected = intents.compute_labeled_scores_fast(0.4)
+    assert len(table) == len(expected)
+    for (id_1, id_2, label_1, label_2, score), pair in zip(table_pairs(table),
+                                                           expected):
+        assert pair[label_1] == id_1 and pair[label_2] == id_2
+        assert score == pytest.approx(pair["score"])
+
+
+def test_empty_table_and_unknown_format():
+    table = results.PairTable.from_blocks([], ["a"])
+    assert len(table) == 0
+    loaded = results.PairTable.load(io.BytesIO(table.to_bytes("npz")))
+    assert len(loaded) == 0 and loaded.ids.tolist() == ["a"]
+    with pytest.raises(ValueError):
+        table.to_bytes("csv")
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from modules import scoring
+from tests.conftest import assert_same_pairs, block_pairs, combinations_reference
+
+
+def labeled_matrix(intents):
+    dataset = intents.dataset
+    order = dataset.labeled_order
+    return intents.batch_embed(dataset.texts.take(order)), dataset.codes[order]
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 64, 1024])
+def test_tiled_labeled_scoring_matches_combinations(intents, block_size):
+    matrix, codes = labeled_matrix(intents)
+    expected = combinations_reference(matrix, 0.4, codes)
+    actual = block_pairs(scoring.iter_pair_blocks(matrix, 0.4, codes, block_size))
+    assert expected
+    assert_same_pairs(actual, expected)
+
+
+@pytest.mark.parametrize("block_size", [5, 1024])
+def test_tiled_unlabeled_scoring_matches_combinations(intents, block_size):
+    dataset = intents.dataset
+    matrix = intents.batch_embed(dataset.texts.take(dataset.unlabeled_order))
+    expected = combinations_reference(matrix, 0.3)
+    actual = block_pairs(scoring.iter_pair_blocks(matrix, 0.3, block_size=block_size))
+    assert expected
+    assert_same_pairs(actual, expected)
+
+
+def test_compute_labeled_scores_fast_matches_deprecated_loop(intents):
+    expected = intents.compute_labeled_scores(0.4)
+    actual = intents.compute_labeled_scores_fast(0.4, block_size=32)
+    assert [{key: value for key, value in pair.items() if key != "score"}
+            for pair in actual] == [{key: value for key, value in pair.items()
+                                     if key != "score"} for pair in expected]
+    np.testing.assert_allclose([pair["score"] for pair in actual],
+                               [pair["score"] for pair in expected], atol=1e-5)
+
+
+def test_compute_unlabeled_scores_matches_combinations(intents):
+    dataset = intents.dataset
+    sentences = dataset.texts.take(dataset.unlabeled_order)
+    matrix = intents.batch_embed(sentences)
+    expected = [(sentences[i], sentences[j], score)
+                for i, j, score in combinations_reference(matrix, 0.3)]
+    actual = intents.compute_unlabeled_scores(0.3, block_size=16)
+    assert [pair[:2] for pair in actual] == [pair[:2] for pair in expected]
+    np.testing.assert_allclose([pair[2] for pair in actual],
+                               [pair[2] for pair in expected], atol=1e-5)
+
+
+def test_empty_and_single_row_matrices():
+    for n in (0, 1):
+        matrix = np.ones((n, 4), dtype=np.float32)
+        assert block_pairs(scoring.iter_pair_blocks(matrix, 0.0)) == []
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from modules import scoring
+from tests.conftest import block_pairs
+from tests.test_scoring import labeled_matrix
+
+
+def top_k_reference(matrix, k, min_score, codes=None):
+    scores = matrix.astype(np.float64) @ matrix.T.astype(np.float64)
+    np.fill_diagonal(scores, -np.inf)
+    if codes is not None:
+        scores[codes[:, None] == codes[None, :]] = -np.inf
+    rows = []
+    for i, row in enumerate(scores):
+        order = np.argsort(-row, kind="stable")[:k]
+        rows.append([(i, j, row[j]) for j in order.tolist()
+                     if row[j] > -np.inf and row[j] >= min_score])
+    return rows
+
+
+@pytest.mark.parametrize("k, min_score, block_size", [
+    (1, -np.inf, 1024), (5, -np.inf, 17), (5, 0.4, 17), (500, 0.3, 64)])
+def test_top_k_matches_full_sort(intents, k, min_score, block_size):
+    matrix, codes = labeled_matrix(intents)
+    expected = top_k_reference(matrix, k, min_score, codes)
+    actual = block_pairs(scoring.iter_top_k_blocks(matrix, k, min_score, codes,
+                                                   block_size))
+    by_row = [[] for _ in expected]
+    for pair in actual:
+        by_row[pair[0]].append(pair)
+    for row, reference in zip(by_row, expected):
+        assert len(row) == len(reference)
+        # Descending scores, equal to the k best up to ties.
+        scores = [pair[2] for pair in row]
+        assert scores == sorted(scores, reverse=True)
+        np.testing.assert_allclose(scores, [pair[2] for pair in reference],
+                                   atol=1e-5)
+        for i, j, score in row:
+            assert codes[i] != codes[j]
+            assert score == pytest.approx(float(np.inner(matrix[i], matrix[j])),
+                                          abs=1e-5)
+
+
+def test_top_k_validates_options(intents):
+    with pytest.raises(ValueError):
+        intents.compute_labeled_scores_fast(0.4, top_k=0)
+    with pytest.raises(ValueError):
+        intents.compute_unlabeled_scores(0.4, approximate=True, top_k=3)